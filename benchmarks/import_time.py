@@ -0,0 +1,64 @@
+import argparse
+import statistics
+import subprocess
+import sys
+
+# Cumulative import time budgets in milliseconds, measured in a fresh interpreter
+BUDGETS_MS = {
+    "utils.settings": 20,
+    "utils.character_index": 20,
+    "utils.world_extractor": 50,
+    "utils.conversation_manager": 300,
+    "main": 300,
+}
+# Modules that must only be imported when a client is first used
+LAZY_MODULES = ["groq", "httpx", "tqdm", "numpy"]
+
+
+def measure(module):
+    """
+    Import a module in a fresh interpreter.
+
+    Args:
+        module (str): The module to import.
+
+    Returns:
+        tuple: The cumulative import time in milliseconds and the lazy modules that were imported with it.
+    """
+    code = f"import sys, {module}; print(','.join(name for name in {LAZY_MODULES!r} if name in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+    for line in reversed(result.stderr.splitlines()):
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000, [name for name in result.stdout.strip().split(",") if name]
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the game's modules against a budget.")
+    parser.add_argument("--runs", type=int, default=5, help="Imports per module; the median is compared.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every budget, for slower machines.")
+    args = parser.parse_args()
+
+    failures = []
+    for module, budget in BUDGETS_MS.items():
+        timings = []
+        for _ in range(args.runs):
+            elapsed, lazy_imported = measure(module)
+            timings.append(elapsed)
+        median = statistics.median(timings)
+        budget *= args.scale
+        status = "ok" if median <= budget and not lazy_imported else "FAIL"
+        print(f"[{status}] {module}: {median:.1f} ms (budget {budget:.0f} ms)")
+        if median > budget:
+            failures.append(f"{module} took {median:.1f} ms, over its {budget:.0f} ms budget")
+        if lazy_imported:
+            failures.append(f"{module} imported {', '.join(lazy_imported)} eagerly")
+
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,542 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+from utils.characteragent_manager import CharacterAgent
+from utils.conversation_cache import ConversationCache
+from utils.conversation_manager import ConversationManager
+from utils.environment_manager import EnvironmentManager
+from utils.extraction_gate import ExtractionGate
+from utils.index_manager import IndexManager
+from utils.llm_backend import LLMBackend, make_chunk, make_response
+from utils.lore_memory import LoreMemory
+from utils.prompt_templates import prompts
+from utils.settings import env
+from utils.stats_manager import StatsGenerator
+from utils.turn_pipeline import TurnPipeline
+
+try:
+    import bson
+except ImportError:
+    bson = None
+
+PLACES = ["Avalon", "Eldergrove", "Duskmere", "Highspire", "Saltmarsh", "Emberfall", "Frostholm", "Mirewood"]
+RACES = ["Human", "Elf", "Dwarf", "Tiger", "Dragon", "Angel", "Orc", "Fox"]
+SYLLABLES = ["ka", "ri", "to", "el", "mor", "an", "sha", "dun"]
+FILLER = ("the wind carries the smell of rain across the old stones while lanterns sway above the road "
+          "and distant bells ring out over the rooftops as the crowd slowly gathers around you").split()
+PLAYER_SCRIPT = [
+    "I look around.",
+    "I walk towards the stranger and ask who they are.",
+    "I follow the road to the next town.",
+    "I draw my sword and stand ready.",
+    "I ask about the rumours in the tavern.",
+    "I rest for the night.",
+]
+STAT_NAMES = ["strength", "defense", "agility", "intelligence", "magic", "health"]
+
+
+def percentile(values, q):
+    """
+    Return the nearest-rank percentile of a list of numbers.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)), 1) - 1]
+
+
+def summarize(values):
+    """
+    Return the count, mean and p50/p95/p99 of a list of numbers.
+    """
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def character_name(number):
+    """
+    Build a distinct, pronounceable character name from a number.
+    """
+    number += len(SYLLABLES) + 1
+    syllables = []
+    while number:
+        number, digit = divmod(number, len(SYLLABLES))
+        syllables.append(SYLLABLES[digit])
+    return "".join(syllables).capitalize()
+
+
+class ScriptedLLM(LLMBackend):
+    """
+    A fake streaming language model that answers every prompt the managers send with deterministic text.
+    Narration introduces a new character every few turns and revisits earlier ones otherwise, and the
+    extraction, stats and summary answers are derived from the text they are asked about.
+    """
+
+    def __init__(self, first_token_latency=0.0, token_latency=0.0, words=120, new_character_every=3):
+        """
+        Initialize the ScriptedLLM.
+
+        Args:
+            first_token_latency (float): Seconds to wait before the first chunk of every response.
+            token_latency (float): Seconds to wait before each following chunk.
+            words (int): The approximate length of a narrative reply, in words.
+            new_character_every (int): Introduce a new character every this many replies.
+        """
+        super().__init__()
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.words = words
+        self.new_character_every = new_character_every
+        self.calls = {}
+        self._narratives = 0
+        self._lock = threading.Lock()
+
+    def create(self, **params):
+        kind, text = self._respond(params)
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+        chunks = re.findall(r"\S+\s*", text) or [text]
+        if params.get("stream"):
+            return self._stream(chunks)
+        time.sleep(self.first_token_latency + self.token_latency * (len(chunks) - 1))
+        return make_response(text)
+
+    def _stream(self, chunks):
+        for position, content in enumerate(chunks):
+            delay = self.first_token_latency if position == 0 else self.token_latency
+            if delay:
+                time.sleep(delay)
+            yield make_chunk(content)
+
+    def _respond(self, params):
+        """
+        Recognize the request from its prompt and return its kind with the response text.
+        """
+        messages = params["messages"]
+        system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+        user = next((message["content"] for message in reversed(messages) if message["role"] == "user"), "")
+
+        if "game master" in system:
+            return "narrative", self._narrate()
+        if "extract the place it describes" in system:
+            return "world_state", json.dumps(self._world_state(user))
+        if "identifying names of characters" in system:
+            return "characters", json.dumps(self._world_state(user)["characters"])
+        if "descriptions of places" in system:
+            location = self._world_state(user.rsplit('Input: "', 1)[-1])["location"]
+            return "environment", location["name"] if location else "False"
+        if "character stats" in system:
+            return "stats", json.dumps(self._stats(user))
+        if "summary" in system.lower() or "summarize" in system.lower():
+            return "summary", "The player travelled between towns and met " + " ".join(FILLER[:20])
+        return "other", "False"
+
+    def _narrate(self):
+        with self._lock:
+            turn = self._narratives
+            self._narratives += 1
+        introduced = turn // self.new_character_every
+        number = introduced if turn % self.new_character_every == 0 else (turn * 7) % (introduced + 1)
+        filler = " ".join(FILLER[(turn + position) % len(FILLER)] for position in range(self.words))
+        return (f"You arrive at {PLACES[turn % len(PLACES)]}, where {filler}. "
+                f"A {RACES[number % len(RACES)].lower()} named {character_name(number)} steps forward and greets you.")
+
+    def _world_state(self, text):
+        location = re.search(r"arrive at (\w+)", text)
+        characters = [
+            {"name": name, "titles": [], "race": race.capitalize(), "role": None, "owner": None,
+             "description": f"A {race} met on the road."}
+            for race, name in re.findall(r"A (\w+) named (\w+)", text)
+        ]
+        return {"location": {"name": location.group(1)} if location else None,
+                "characters": characters, "relationships": []}
+
+    def _stats(self, prompt):
+        details = prompt.split("Character Details:", 1)[-1]
+        stats = {}
+        for name in re.findall(r'"name": "([^"]+)"', details):
+            digest = hashlib.sha256(name.encode("utf-8")).digest()
+            stats[name] = {stat: 100 + digest[position] * 20 for position, stat in enumerate(STAT_NAMES)}
+        return stats
+
+
+def document_size(document):
+    """
+    Return the size of a document as it would cross the wire.
+    """
+    if bson is not None:
+        try:
+            return len(bson.encode(document))
+        except Exception:
+            pass
+    return len(json.dumps(document, default=str))
+
+
+class DatabaseCounters:
+    """
+    Thread-safe counters of database round-trips and bytes read.
+    """
+
+    def __init__(self):
+        self.round_trips = 0
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+
+    def add(self, round_trips=0, bytes_read=0):
+        with self._lock:
+            self.round_trips += round_trips
+            self.bytes_read += bytes_read
+
+    def snapshot(self):
+        with self._lock:
+            return self.round_trips, self.bytes_read
+
+
+class CountingCursor:
+    """
+    Wrap a cursor so the documents it returns are counted as bytes read.
+    """
+
+    def __init__(self, cursor, counters):
+        self._cursor = cursor
+        self._counters = counters
+
+    def __iter__(self):
+        for document in self._cursor:
+            self._counters.add(bytes_read=document_size(document))
+            yield document
+
+    def __next__(self):
+        document = next(self._cursor)
+        self._counters.add(bytes_read=document_size(document))
+        return document
+
+    def __getattr__(self, name):
+        attribute = getattr(self._cursor, name)
+        if not callable(attribute):
+            return attribute
+
+        def chained(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            # Keep counting through sort(), limit() and the other chained cursor methods
+            return self if result is self._cursor else result
+        return chained
+
+
+class CountingCollection:
+    """
+    Wrap a collection so every operation counts as one round-trip and every returned document as bytes read.
+    """
+
+    CURSOR_METHODS = {"find", "aggregate"}
+    DOCUMENT_METHODS = {"find_one", "find_one_and_update", "find_one_and_replace", "find_one_and_delete"}
+    COUNTED_METHODS = {
+        "insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one", "delete_many",
+        "bulk_write", "count_documents", "estimated_document_count", "distinct", "create_index", "create_indexes",
+    }
+
+    def __init__(self, collection, counters):
+        self._collection = collection
+        self._counters = counters
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name in self.CURSOR_METHODS:
+            def counted(*args, **kwargs):
+                self._counters.add(round_trips=1)
+                return CountingCursor(attribute(*args, **kwargs), self._counters)
+            return counted
+        if name in self.DOCUMENT_METHODS:
+            def counted(*args, **kwargs):
+                document = attribute(*args, **kwargs)
+                self._counters.add(round_trips=1, bytes_read=document_size(document) if document else 0)
+                return document
+            return counted
+        if name in self.COUNTED_METHODS:
+            def counted(*args, **kwargs):
+                self._counters.add(round_trips=1)
+                return attribute(*args, **kwargs)
+            return counted
+        return attribute
+
+
+class CountingDatabase:
+    """
+    Wrap a database so the collections it hands out are counting collections.
+    """
+
+    def __init__(self, db, counters):
+        self._db = db
+        self._counters = counters
+
+    def __getitem__(self, name):
+        return CountingCollection(self._db[name], self._counters)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+class StageTimings:
+    """
+    Collect durations per stage. Stages run on the turn thread and on background threads alike.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, fn):
+        """
+        Return fn timed under the given stage name.
+        """
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def wrap_stream(self, stage, fn):
+        """
+        Return a generator function timed under the given stage name, with its time to first piece recorded
+        under "<stage>_first_token".
+        """
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            first = True
+            for piece in fn(*args, **kwargs):
+                if first:
+                    self.record(f"{stage}_first_token", time.perf_counter() - start)
+                    first = False
+                yield piece
+            self.record(stage, time.perf_counter() - start)
+        return timed
+
+
+def open_database(mongo_uri, db_name):
+    """
+    Open the database the campaign runs against: a local mongod if a URI is given, otherwise mongomock.
+    """
+    if mongo_uri:
+        from pymongo import MongoClient
+        return MongoClient(mongo_uri)[db_name]
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock is not installed; install it or pass --mongo-uri for a local mongod.")
+    return mongomock.MongoClient()[db_name]
+
+
+def run_campaign(args):
+    """
+    Play a scripted campaign through the turn pipeline used by main.py and collect its measurements.
+
+    Args:
+        args (Namespace): The parsed command line arguments.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    raw_db = open_database(args.mongo_uri, args.db)
+    collection_name = f"bench_{uuid.uuid4().hex[:8]}"
+    counters = DatabaseCounters()
+    db = CountingDatabase(raw_db, counters)
+    llm = ScriptedLLM(args.first_token_latency, args.token_latency, args.words)
+    timings = StageTimings()
+    gate = ExtractionGate.from_preset(args.gate)
+    cache = ConversationCache(args.cache_size)
+    # A memory-only lore index, so runs neither read nor grow the shared one on disk
+    lore_memory = LoreMemory() if env("LORE_MEMORY", "1") != "0" else None
+
+    # mongomock ignores partial index filters, which would turn the pending-job index into a plain unique one
+    if args.mongo_uri:
+        IndexManager(raw_db, collection_name).ensure_indexes()
+
+    conversation_id = "benchmark"
+    conversation_manager = ConversationManager(args.db, collection_name, db=db, cache=cache, storage=args.storage,
+                                               llm_client=llm, lore_memory=lore_memory)
+    conversation_manager.create_conversation(conversation_id)
+    environment_manager = EnvironmentManager(args.db, collection_name, conversation_id, db=db, cache=cache,
+                                             storage=args.storage, gate=gate, llm_client=llm, lore_memory=lore_memory)
+    character_manager = CharacterAgent(args.db, collection_name, conversation_id, db=db, cache=cache,
+                                       storage=args.storage, gate=gate, llm_client=llm, lore_memory=lore_memory)
+    stats_agent = StatsGenerator(args.db, collection_name, db=db, llm_client=llm)
+    pipeline = TurnPipeline(conversation_manager, environment_manager, character_manager, stats_agent,
+                            conversation_id, llm, extraction_mode=args.extraction)
+
+    conversation_manager.add_user_message = timings.wrap("add_user_message", conversation_manager.add_user_message)
+    conversation_manager.stream_assistant_response = timings.wrap_stream(
+        "reply", conversation_manager.stream_assistant_response)
+    conversation_manager._retrieve_lore = timings.wrap("lore_search", conversation_manager._retrieve_lore)
+    conversation_manager.summary_worker.summarize = timings.wrap("summary", conversation_manager.summary_worker.summarize)
+    pipeline.world_extractor.extract = timings.wrap("world_extraction", pipeline.world_extractor.extract)
+    environment_manager.process_latest_environment_description = timings.wrap(
+        "environment_extraction", environment_manager.process_latest_environment_description)
+    environment_manager.store_extracted_environment = timings.wrap(
+        "store_environment", environment_manager.store_extracted_environment)
+    character_manager.process_latest_message_for_characters = timings.wrap(
+        "character_extraction", character_manager.process_latest_message_for_characters)
+    character_manager.store_characters = timings.wrap("store_characters", character_manager.store_characters)
+    stats_agent.check_for_new_characters = timings.wrap("stats", stats_agent.check_for_new_characters)
+
+    per_turn = []
+    try:
+        for turn in range(args.turns):
+            round_trips, bytes_read = counters.snapshot()
+            start = time.perf_counter()
+            for _ in pipeline.stream_turn(PLAYER_SCRIPT[turn % len(PLAYER_SCRIPT)]):
+                pass
+            timings.record("turn_visible", time.perf_counter() - start)
+            for error in pipeline.join():
+                print(f"Background extraction failed on turn {turn + 1}: {error!r}")
+            timings.record("turn", time.perf_counter() - start)
+            after_round_trips, after_bytes_read = counters.snapshot()
+            per_turn.append((after_round_trips - round_trips, after_bytes_read - bytes_read))
+    finally:
+        pipeline.close()
+        if args.mongo_uri:
+            for name in raw_db.list_collection_names():
+                if name == collection_name or name.endswith(f"_{collection_name}"):
+                    raw_db.drop_collection(name)
+
+    # Bytes read per turn, in windows of the campaign, shows how reads grow with the history
+    window = max(args.turns // 10, 1)
+    history = []
+    for first in range(0, len(per_turn), window):
+        turns = per_turn[first:first + window]
+        history.append({
+            "turns": f"{first + 1}-{first + len(turns)}",
+            "round_trips": sum(trips for trips, _ in turns) / len(turns),
+            "bytes_read": sum(read for _, read in turns) / len(turns),
+        })
+
+    return {
+        "config": {
+            "turns": args.turns, "storage": args.storage or env("MESSAGE_STORAGE", "embedded"),
+            "extraction": pipeline.extraction_mode, "gate": args.gate, "backend": "mongod" if args.mongo_uri else "mongomock",
+            "first_token_latency": args.first_token_latency, "token_latency": args.token_latency, "words": args.words,
+        },
+        "latency_ms": {stage: summarize([seconds * 1000 for seconds in durations])
+                       for stage, durations in sorted(timings.durations.items())},
+        "per_turn": {
+            "round_trips": summarize([trips for trips, _ in per_turn]),
+            "bytes_read": summarize([read for _, read in per_turn]),
+        },
+        "history": history,
+        "llm_calls": dict(sorted(llm.calls.items())),
+        "gate": gate.stats(),
+        "extraction_fallbacks": pipeline.extraction_fallbacks,
+        "prompts": {name: stats for name, stats in prompts.stats().items() if stats["calls"]},
+    }
+
+
+def print_results(results):
+    print(f"{results['config']['turns']} turns, {results['config']['storage']} storage, "
+          f"{results['config']['extraction']} extraction, {results['config']['backend']}")
+    print(f"{'stage':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, summary in results["latency_ms"].items():
+        print(f"{stage:<28}{summary['count']:>7}{summary['p50']:>10.2f}{summary['p95']:>10.2f}{summary['p99']:>10.2f}")
+    for metric, summary in results["per_turn"].items():
+        print(f"{metric} per turn: p50 {summary['p50']:.0f}, p95 {summary['p95']:.0f}, p99 {summary['p99']:.0f}")
+    print("As history grows:")
+    for window in results["history"]:
+        print(f"  turns {window['turns']:>9}: {window['round_trips']:.1f} round-trips, "
+              f"{window['bytes_read']:.0f} bytes read per turn")
+    print(f"LLM calls: {results['llm_calls']}")
+    print(f"{'prompt':<28}{'calls':>7}{'static':>10}{'per call':>10}{'static %':>10}")
+    for name, stats in results.get("prompts", {}).items():
+        print(f"{name:<28}{stats['calls']:>7}{stats['static_tokens']:>10}{stats['dynamic_tokens_avg']:>10.0f}"
+              f"{stats['static_share'] * 100:>10.0f}")
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """
+    Compare results against a saved baseline.
+
+    Args:
+        results (dict): The results of this run.
+        baseline (dict): The results of the baseline run.
+        tolerance (float): The allowed relative increase, e.g. 0.2 for 20%.
+        min_delta_ms (float): Latency increases smaller than this are treated as noise.
+
+    Returns:
+        list: A description of every metric that regressed.
+    """
+    regressions = []
+    for stage, summary in results["latency_ms"].items():
+        previous = baseline["latency_ms"].get(stage)
+        if not previous:
+            continue
+        for q in ("p50", "p95", "p99"):
+            delta = summary[q] - previous[q]
+            if delta > min_delta_ms and summary[q] > previous[q] * (1 + tolerance):
+                regressions.append(f"{stage} {q}: {previous[q]:.2f} ms -> {summary[q]:.2f} ms")
+    for metric, summary in results["per_turn"].items():
+        previous = baseline["per_turn"].get(metric)
+        if previous and summary["p50"] > previous["p50"] * (1 + tolerance):
+            regressions.append(f"{metric} per turn p50: {previous['p50']:.0f} -> {summary['p50']:.0f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scripted campaigns through the game's turn pipeline.")
+    parser.add_argument("--turns", type=int, default=300, help="The number of turns to play.")
+    parser.add_argument("--mongo-uri", help="Run against this local mongod instead of mongomock.")
+    parser.add_argument("--db", default="genai_rpg_benchmark", help="The database the campaign runs in.")
+    parser.add_argument("--storage", choices=["embedded", "bucketed"], help="The message storage mode.")
+    parser.add_argument("--extraction", choices=["unified", "separate"], help="The extraction mode.")
+    parser.add_argument("--gate", default="recall", help="The extraction gate preset, or off.")
+    parser.add_argument("--cache-size", type=int, default=64, help="Conversations held by the message cache.")
+    parser.add_argument("--words", type=int, default=120, help="The length of a narrative reply, in words.")
+    parser.add_argument("--first-token-latency", type=float, default=0.0, help="Simulated seconds to the first token.")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Simulated seconds between tokens.")
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", metavar="PATH", help="Compare the results against this baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="The allowed relative regression.")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="Latency changes below this are noise.")
+    args = parser.parse_args()
+
+    results = run_campaign(args)
+    print_results(results)
+
+    if args.save_baseline:
+        directory = os.path.dirname(args.save_baseline)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.save_baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("config") != results["config"]:
+            print(f"Note: the baseline was run with a different configuration: {baseline.get('config')}")
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
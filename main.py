@@ -1,30 +1,40 @@
-from utils.imports import *
+from utils import settings
 from utils.conversation_manager import ConversationManager
 from utils.environment_manager import EnvironmentManager
 from utils.characteragent_manager import CharacterAgent
 from utils.stats_manager import StatsGenerator
+from utils.turn_pipeline import TurnPipeline
+from utils.mongo_registry import resolve_database, close_all
+from utils.index_manager import IndexManager
 
 
 def main():
-    conversation_manager = ConversationManager(DATABASE_NAME, COLLECTION_NAME)
+    database_name = settings.DATABASE_NAME
+    collection_name = settings.COLLECTION_NAME
+    IndexManager(resolve_database(database_name), collection_name).ensure_indexes()
+    conversation_manager = ConversationManager(database_name, collection_name)
     conversation_id = "test_1"
-    environment_manager = EnvironmentManager(DATABASE_NAME, COLLECTION_NAME, conversation_id)
-    character_manager = CharacterAgent(DATABASE_NAME, COLLECTION_NAME, "test_1")
+    environment_manager = EnvironmentManager(database_name, collection_name, conversation_id)
+    character_manager = CharacterAgent(database_name, collection_name, "test_1")
     conversation_manager.create_conversation(conversation_id)
-    stats_agent = StatsGenerator(DATABASE_NAME, COLLECTION_NAME)
+    stats_agent = StatsGenerator(database_name, collection_name)
+    pipeline = TurnPipeline(conversation_manager, environment_manager, character_manager, stats_agent,
+                            conversation_id, settings.get_llm_client())
 
-    while True:
-        user_input = input("You: ").strip()
-        if user_input.lower() == "exit":
-            print("Exiting conversation.")
-            break
+    try:
+        while True:
+            user_input = input("You: ").strip()
+            if user_input.lower() == "exit":
+                print("Exiting conversation.")
+                break
 
-        conversation_manager.add_user_message(conversation_id, user_input)
-
-        conversation_manager.generate_assistant_response(conversation_id, llm_client)
-        environment_manager.process_latest_environment_description()
-        character_manager.process_latest_message_for_characters()
-        stats_agent.check_for_new_characters()
+            print("Game Master: ", end="", flush=True)
+            for delta in pipeline.stream_turn(user_input):
+                print(delta, end="", flush=True)
+            print()
+    finally:
+        pipeline.close()
+        close_all()
         
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
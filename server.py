@@ -0,0 +1,139 @@
+import argparse
+import json
+
+from aiohttp import web
+
+from utils import settings
+from utils.conversation_manager import ConversationManager
+from utils.game_sessions import GameSessions, ServerBusy
+from utils.index_manager import IndexManager
+from utils.mongo_registry import resolve_database, close_all
+from utils.stats_manager import StatsGenerator
+from utils.telemetry import telemetry
+
+routes = web.RouteTableDef()
+
+
+def _event(name, data):
+    """
+    Encode one server-sent event.
+    """
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+@routes.post("/conversations/{conversation_id}/turns")
+async def post_turn(request):
+    """
+    Run a turn and stream the reply as server-sent events. The body is {"input": "..."}.
+    """
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="The body must be JSON.")
+    user_input = (body.get("input") or "").strip() if isinstance(body, dict) else ""
+    if not user_input:
+        raise web.HTTPBadRequest(text='The body must have a non-empty "input".')
+
+    events = request.app["sessions"].stream_turn(request.match_info["conversation_id"], user_input)
+    try:
+        name, data = await anext(events)
+    except ServerBusy as error:
+        raise web.HTTPServiceUnavailable(text=str(error), headers={"Retry-After": "1"})
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    try:
+        await response.write(_event(name, data))
+        async for name, data in events:
+            await response.write(_event(name, data))
+        await response.write_eof()
+    except ConnectionResetError:
+        # The player left; closing the events below still lets the turn finish and be stored
+        pass
+    except Exception as error:
+        await response.write(_event("error", {"message": str(error)}))
+        await response.write_eof()
+    finally:
+        await events.aclose()
+    return response
+
+
+@routes.get("/conversations/{conversation_id}/messages")
+async def get_messages(request):
+    """
+    Return one page of a conversation's messages. Query parameters: page (default 0) and page_size.
+    """
+    try:
+        page = int(request.query.get("page", 0))
+        page_size = int(request.query["page_size"]) if "page_size" in request.query else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="page and page_size must be integers.")
+    messages = await request.app["sessions"].get_messages(request.match_info["conversation_id"], page, page_size)
+    return web.json_response({"page": page, "messages": messages}, dumps=lambda data: json.dumps(data, default=str))
+
+
+@routes.get("/health")
+async def health(request):
+    return web.json_response(request.app["sessions"].stats())
+
+
+@routes.get("/metrics")
+async def metrics(request):
+    return web.Response(text=telemetry.render_prometheus(), content_type="text/plain")
+
+
+def create_app(db_name, collection_name, db=None, llm_client=None, **session_options):
+    """
+    Create the web application serving the game.
+
+    Args:
+        db_name (str): The name of the MongoDB database.
+        collection_name (str): The name of the MongoDB collection storing conversations.
+        db (Database, optional): A database to use instead of the shared client's.
+        llm_client (LLMBackend, optional): The language model backend. Defaults to the shared backend.
+        **session_options: Options passed to GameSessions, such as llm_concurrency.
+
+    Returns:
+        web.Application: The application.
+    """
+    app = web.Application()
+    app.add_routes(routes)
+
+    async def start(app):
+        database = resolve_database(db_name, db=db)
+        IndexManager(database, collection_name).ensure_indexes()
+        client = llm_client or settings.get_llm_client()
+        app["sessions"] = GameSessions(
+            db_name, collection_name,
+            ConversationManager(db_name, collection_name, db=database, llm_client=client),
+            StatsGenerator(db_name, collection_name, db=database, llm_client=client),
+            client,
+            db=database,
+            **session_options
+        )
+        telemetry.register_stats("game_sessions", app["sessions"].stats)
+
+    async def stop(app):
+        await app["sessions"].close()
+        close_all()
+
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve many concurrent game conversations over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="The interface to listen on.")
+    parser.add_argument("--port", type=int, default=8080, help="The port to listen on.")
+    parser.add_argument("--llm-concurrency", type=int, help="The number of replies generated at once.")
+    parser.add_argument("--max-pending-turns", type=int, help="The number of admitted turns before refusing more.")
+    args = parser.parse_args()
+
+    app = create_app(settings.DATABASE_NAME, settings.COLLECTION_NAME,
+                     llm_concurrency=args.llm_concurrency, max_pending_turns=args.max_pending_turns)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+import time
+
+from utils import settings
+from utils.characteragent_manager import CharacterAgent
+from utils.environment_manager import EnvironmentManager
+from utils.extraction_gate import ExtractionGate, shared_gate
+from utils.lore_memory import get_lore_memory
+from utils.message_store import get_message_store
+from utils.mongo_registry import resolve_database, close_all
+from utils.settings import env
+from utils.stats_manager import StatsGenerator
+from utils.world_extractor import WorldStateExtractor
+
+
+class Backfill:
+    """
+    Re-run extraction over every message of stored conversations, to rebuild their environments, characters
+    and stats after the extraction prompts change. Every message is also added to the lore memory.
+
+    The language model calls run on a bounded thread pool, while the results are applied in message order,
+    one bulk write per batch. After each batch the position reached is checkpointed per conversation, so an
+    interrupted run resumes from the last applied batch.
+    """
+
+    def __init__(self, db, collection_name, llm_client, workers=8, batch_size=20, extraction_mode=None,
+                 roles=("assistant",), gate=None, storage=None):
+        """
+        Initialize the Backfill.
+
+        Args:
+            db (Database): The database handle.
+            collection_name (str): The name of the MongoDB collection storing conversations.
+            llm_client (LLMBackend): The language model backend.
+            workers (int): The number of extraction calls made at once.
+            batch_size (int): The number of messages applied per bulk write and checkpoint.
+            extraction_mode (str, optional): "unified" or "separate". Defaults to EXTRACTION_MODE.
+            roles (tuple): The roles of the messages extracted from. Other messages are skipped.
+            gate (ExtractionGate, optional): The gate that skips messages with nothing new. Defaults to the
+                shared gate.
+            storage (str, optional): The message storage mode. Defaults to MESSAGE_STORAGE.
+        """
+        self.db = db
+        self.collection_name = collection_name
+        self.llm_client = llm_client
+        self.workers = workers
+        self.batch_size = batch_size
+        self.extraction_mode = extraction_mode or env("EXTRACTION_MODE", "unified")
+        self.roles = set(roles)
+        self.gate = gate or shared_gate
+        self.storage = storage
+        self.message_store = get_message_store(db, collection_name, storage)
+        self.checkpoints = db[f"backfill_{collection_name}"]
+        self.world_extractor = WorldStateExtractor(llm_client=llm_client)
+        self.stats_agent = StatsGenerator(None, collection_name, db=db, llm_client=llm_client)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill")
+        self.lore_memory = get_lore_memory()
+        self.extraction_fallbacks = 0
+        # Guards the counters updated from the worker threads
+        self._lock = threading.Lock()
+
+    def conversation_ids(self):
+        """
+        Return every stored conversation.
+        """
+        return self.message_store.collection.distinct("conversation_id")
+
+    def reset(self, conversation_id):
+        """
+        Delete the checkpoint of a conversation, so the next run starts from its first message.
+        """
+        self.checkpoints.delete_one({"conversation_id": conversation_id})
+
+    def _clear_extracted(self, conversation_id):
+        """
+        Delete the environments, characters and stats extracted so far from a conversation, and its lore.
+        """
+        for prefix in ("environments", "characters", "stats"):
+            self.db[f"{prefix}_{self.collection_name}"].delete_many({"conversation_id": conversation_id})
+        if self.lore_memory:
+            self.lore_memory.remove(self.db[self.collection_name].full_name, conversation_id)
+
+    def _extract(self, environment_manager, character_manager, message):
+        """
+        Extract the location and characters of one message. Runs on the worker pool.
+
+        Returns:
+            dict: The location (or None), characters and relationships. Messages kept from extraction by the
+                gate have no location, but may have the known place they mention as "mentioned".
+        """
+        content = message["content"]
+
+        def is_known(name):
+            return character_manager.is_known_character(name) or environment_manager.is_known_environment(name)
+
+        if self.extraction_mode == "unified":
+            if not self.gate.should_extract("world_state", content, is_known):
+                return {"location": None, "characters": [], "relationships": [],
+                        "mentioned": environment_manager.known_mention(content)}
+            try:
+                return self.world_extractor.extract(content)
+            except ValueError:
+                self._count_fallback()
+
+        env_name = mentioned = False
+        if self.gate.should_extract("environment", content, environment_manager.is_known_environment):
+            env_name = environment_manager._is_environment_description(content)
+        else:
+            mentioned = environment_manager.known_mention(content)
+        characters = []
+        if self.gate.should_extract("character", content, character_manager.is_known_character):
+            try:
+                characters = character_manager._is_character(content)
+            except ValueError:
+                # The reply was not JSON: the message counts as having no characters rather than failing the run
+                self._count_fallback()
+        return {"location": {"name": env_name} if env_name else None, "characters": characters, "relationships": [],
+                "mentioned": mentioned}
+
+    def _count_fallback(self):
+        """
+        Count a reply that could not be parsed. Called from the worker threads.
+        """
+        with self._lock:
+            self.extraction_fallbacks += 1
+
+    def _iter_extracted(self, environment_manager, character_manager, messages):
+        """
+        Extract the messages on the worker pool, keeping at most twice as many calls in flight as there are
+        workers, and yield the results in message order.
+
+        Yields:
+            tuple: The message index, the message and its extraction result.
+        """
+        in_flight = deque()
+        try:
+            for index, message in messages:
+                in_flight.append((index, message, self.executor.submit(
+                    self._extract, environment_manager, character_manager, message
+                )))
+                if len(in_flight) >= 2 * self.workers:
+                    index, message, future = in_flight.popleft()
+                    yield index, message, future.result()
+            while in_flight:
+                index, message, future = in_flight.popleft()
+                yield index, message, future.result()
+        finally:
+            for _, _, future in in_flight:
+                future.cancel()
+
+    def _apply(self, conversation_id, environment_manager, character_manager, batch, next_index):
+        """
+        Store the results of a batch of messages in order, then checkpoint the position reached.
+        """
+        environment_manager.store_extracted_environments([
+            (result["location"]["name"] if result["location"] else False, message) for message, result in batch
+        ])
+        # A known place mentioned after the last extracted one is where the story is now
+        locations = [environment_manager.registry.resolve(result["location"]["name"]) if result["location"]
+                     else result.get("mentioned") for _, result in batch]
+        environment_manager.set_current_location(next((name for name in reversed(locations) if name), False))
+        character_manager.store_characters(
+            [character for _, result in batch for character in result["characters"]],
+            relationships=[relationship for _, result in batch for relationship in result["relationships"]]
+        )
+        self.checkpoints.update_one(
+            {"conversation_id": conversation_id},
+            {"$set": {"next_index": next_index, "updated_at": datetime.utcnow()}}
+        )
+
+    def run_conversation(self, conversation_id, rebuild=False):
+        """
+        Extract every message of a conversation not yet covered by its checkpoint, then generate the stats
+        of the new characters.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            rebuild (bool): If True, the checkpoint and the previously extracted data are deleted, and the
+                conversation is started again from its first message.
+
+        Returns:
+            tuple: The number of messages read and the number sent to extraction.
+        """
+        if rebuild:
+            self.reset(conversation_id)
+        checkpoint = self.checkpoints.find_one({"conversation_id": conversation_id})
+        if checkpoint and checkpoint.get("done"):
+            return 0, 0
+        if checkpoint is None:
+            if rebuild:
+                self._clear_extracted(conversation_id)
+            self.checkpoints.insert_one({
+                "conversation_id": conversation_id,
+                "next_index": 0,
+                "done": False,
+                "started_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow()
+            })
+        start = checkpoint["next_index"] if checkpoint else 0
+
+        environment_manager = EnvironmentManager(None, self.collection_name, conversation_id, db=self.db,
+                                                 storage=self.storage, gate=self.gate, llm_client=self.llm_client)
+        character_manager = CharacterAgent(None, self.collection_name, conversation_id, db=self.db,
+                                           storage=self.storage, gate=self.gate, llm_client=self.llm_client)
+
+        read = 0
+
+        def selected_messages():
+            nonlocal read
+            for index, message in enumerate(self.message_store.iter_messages(conversation_id, start), start):
+                read += 1
+                if self.lore_memory and message.get("role") != "system" and message.get("content"):
+                    # Keyed by position, so re-running the backfill replaces rather than repeats messages
+                    self.lore_memory.add(self.db[self.collection_name].full_name, conversation_id, "message",
+                                         message["content"], key=index, role=message["role"])
+                if message.get("role") in self.roles and message.get("content"):
+                    yield index, message
+
+        extracted = 0
+        batch = []
+        for index, message, result in self._iter_extracted(environment_manager, character_manager,
+                                                           selected_messages()):
+            batch.append((message, result))
+            extracted += 1
+            if len(batch) >= self.batch_size:
+                self._apply(conversation_id, environment_manager, character_manager, batch, index + 1)
+                batch = []
+        self._apply(conversation_id, environment_manager, character_manager, batch, start + read)
+
+        self.stats_agent.check_for_new_characters(conversation_id)
+        self.checkpoints.update_one({"conversation_id": conversation_id},
+                                    {"$set": {"done": True, "updated_at": datetime.utcnow()}})
+        return read, extracted
+
+    def run(self, conversation_ids, rebuild=False):
+        """
+        Backfill several conversations one after the other, reporting the throughput of each.
+
+        Args:
+            conversation_ids (list): The conversations to backfill.
+            rebuild (bool): If True, every conversation is started again from its first message, with its
+                previously extracted data deleted.
+
+        Returns:
+            dict: The conversations that failed, with the error.
+        """
+        failures = {}
+        total_read = total_extracted = 0
+        started = time.perf_counter()
+        for conversation_id in conversation_ids:
+            conversation_started = time.perf_counter()
+            try:
+                read, extracted = self.run_conversation(conversation_id, rebuild)
+            except Exception as error:
+                # The checkpoint keeps the last applied batch, so the next run resumes from there
+                failures[conversation_id] = error
+                print(f"{conversation_id}: failed, will resume on the next run: {error!r}")
+                continue
+            if read:
+                elapsed = time.perf_counter() - conversation_started
+                print(f"{conversation_id}: {read} messages ({extracted} extracted) in {elapsed:.1f} s, "
+                      f"{read / elapsed:.1f} messages/s")
+            total_read += read
+            total_extracted += extracted
+
+        elapsed = time.perf_counter() - started
+        rate = total_read / elapsed if elapsed else 0.0
+        print(f"Backfilled {total_read} messages ({total_extracted} extracted) from "
+              f"{len(conversation_ids) - len(failures)} conversations in {elapsed:.1f} s, {rate:.1f} messages/s.")
+        return failures
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-extract environments, characters and stats from every message of stored conversations."
+    )
+    parser.add_argument("--db", default=settings.DATABASE_NAME, help="The MongoDB database name.")
+    parser.add_argument("--collection", default=settings.COLLECTION_NAME, help="The conversation collection name.")
+    parser.add_argument("--conversation-id", action="append", dest="conversation_ids",
+                        help="A conversation to backfill. Can be repeated. Defaults to every conversation.")
+    parser.add_argument("--workers", type=int, default=8, help="The number of extraction calls made at once.")
+    parser.add_argument("--batch-size", type=int, default=20,
+                        help="The number of messages applied per bulk write and checkpoint.")
+    parser.add_argument("--extraction", choices=["unified", "separate"], help="Defaults to EXTRACTION_MODE.")
+    parser.add_argument("--roles", default="assistant",
+                        help="Comma-separated roles of the messages to extract from.")
+    parser.add_argument("--gate", choices=["recall", "balanced", "precision", "off"],
+                        help="The extraction gate preset. Defaults to EXTRACTION_GATE.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Delete the checkpoint and previously extracted data of every conversation and start "
+                             "it again from its first message. Implies --restart.")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignore the checkpoints and start every conversation from its first message.")
+    args = parser.parse_args()
+
+    db = resolve_database(args.db)
+    backfill = Backfill(
+        db, args.collection, settings.get_llm_client(),
+        workers=args.workers,
+        batch_size=args.batch_size,
+        extraction_mode=args.extraction,
+        roles=tuple(role.strip() for role in args.roles.split(",") if role.strip()),
+        gate=ExtractionGate.from_preset(args.gate) if args.gate else None,
+    )
+    conversation_ids = args.conversation_ids or backfill.conversation_ids()
+    if args.restart:
+        for conversation_id in conversation_ids:
+            backfill.reset(conversation_id)
+    try:
+        failures = backfill.run(conversation_ids, rebuild=args.rebuild)
+    finally:
+        backfill.close()
+        close_all()
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
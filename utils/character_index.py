@@ -0,0 +1,170 @@
+import re
+import threading
+
+_TITLE_WORDS = {
+    "the", "a", "an", "king", "queen", "prince", "princess", "lord", "lady", "sir", "dame", "emperor", "empress",
+    "duke", "duchess", "count", "countess", "baron", "baroness", "captain", "general", "commander", "master",
+    "mistress", "mr", "mrs", "ms", "miss", "dr", "doctor", "saint", "st", "father", "mother", "brother", "sister",
+}
+_WORD_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)?")
+
+
+def normalize_alias(name):
+    """
+    Normalize a character name for matching: case-folded, punctuation removed and leading titles dropped,
+    so "Queen Elaine" and "elaine" resolve to the same key.
+
+    Args:
+        name (str): The name or title to normalize.
+
+    Returns:
+        str: The normalized key, or an empty string if nothing is left.
+    """
+    words = _WORD_PATTERN.findall((name or "").casefold())
+    while len(words) > 1 and words[0] in _TITLE_WORDS:
+        words.pop(0)
+    return " ".join(words)
+
+
+def character_aliases(character):
+    """
+    Return every name a character can be referred to by: its name, alternate names and titles.
+
+    Args:
+        character (dict): The character document or extracted character data.
+
+    Returns:
+        list: The names, in the order they were given.
+    """
+    names = [character.get("name")]
+    names.extend(character.get("alternate_names") or [])
+    names.extend(character.get("titles") or [])
+    return [name for name in names if name]
+
+
+class CharacterAliasIndex:
+    """
+    In-memory map from normalized alias to character name for one conversation, loaded once and kept in sync
+    as characters are written, so known characters resolve without a database round-trip.
+    """
+
+    def __init__(self):
+        self._aliases = {}
+        self._lock = threading.Lock()
+
+    def load(self, characters_collection, conversation_id):
+        """
+        Load the aliases of every character of a conversation.
+
+        Args:
+            characters_collection (Collection): The collection storing characters.
+            conversation_id (str): The unique identifier for the conversation.
+        """
+        cursor = characters_collection.find(
+            {"conversation_id": conversation_id},
+            {"name": 1, "alternate_names": 1, "titles": 1, "_id": 0}
+        )
+        for character in cursor:
+            self.add(character)
+
+    def add(self, character):
+        """
+        Map every alias of a character to its name. Aliases already taken by another character are kept.
+
+        Args:
+            character (dict): The character document.
+        """
+        self.add_aliases(character["name"], character_aliases(character))
+
+    def add_aliases(self, name, aliases):
+        """
+        Map extra aliases to an existing character.
+
+        Args:
+            name (str): The stored name of the character.
+            aliases (list): The aliases to add.
+        """
+        with self._lock:
+            for alias in aliases:
+                key = normalize_alias(alias)
+                if key:
+                    self._aliases.setdefault(key, name)
+
+    def merge(self, other):
+        """
+        Add the aliases of another index, such as the characters staged for a write that has succeeded.
+        Aliases already taken by another character are kept.
+
+        Args:
+            other (CharacterAliasIndex): The index to merge in.
+        """
+        with other._lock:
+            aliases = list(other._aliases.items())
+        with self._lock:
+            for key, name in aliases:
+                self._aliases.setdefault(key, name)
+
+    def resolve(self, character_data):
+        """
+        Find the stored character matching any alias of the extracted character.
+
+        Args:
+            character_data (dict): The extracted character data.
+
+        Returns:
+            str: The stored name of the matching character, or None if the character is new.
+        """
+        with self._lock:
+            for alias in character_aliases(character_data):
+                name = self._aliases.get(normalize_alias(alias))
+                if name is not None:
+                    return name
+        return None
+
+    def unknown_aliases(self, character_data):
+        """
+        Return the aliases of an extracted character that are not yet in the index.
+        """
+        with self._lock:
+            return [alias for alias in character_aliases(character_data)
+                    if normalize_alias(alias) and normalize_alias(alias) not in self._aliases]
+
+    def __contains__(self, alias):
+        return normalize_alias(alias) in self._aliases
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_alias_index(characters_collection, conversation_id):
+    """
+    Return the alias index of a conversation, loading it from the database the first time it is requested.
+
+    Args:
+        characters_collection (Collection): The collection storing characters.
+        conversation_id (str): The unique identifier for the conversation.
+
+    Returns:
+        CharacterAliasIndex: The shared alias index.
+    """
+    key = (characters_collection.full_name, conversation_id)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = CharacterAliasIndex()
+            index.load(characters_collection, conversation_id)
+            _indexes[key] = index
+        return index
+
+
+def release_alias_index(characters_collection, conversation_id):
+    """
+    Drop the cached alias index of a conversation, so the next request loads it from the database again.
+
+    Args:
+        characters_collection (Collection): The collection storing characters.
+        conversation_id (str): The unique identifier for the conversation.
+    """
+    with _indexes_lock:
+        _indexes.pop((characters_collection.full_name, conversation_id), None)
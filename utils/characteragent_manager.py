@@ -1,12 +1,248 @@
-from utils.imports import *
+from pymongo import InsertOne, UpdateOne
+
+from datetime import datetime
+
+from utils.settings import get_llm_client
+from utils.mongo_registry import resolve_database
+from utils.conversation_cache import shared_cache
+from utils.message_store import get_message_store
+from utils.character_index import CharacterAliasIndex, get_alias_index, normalize_alias, release_alias_index
+from utils.extraction_gate import shared_gate
+from utils.json_stream import completion_text, iter_json_items
+from utils.llm_cache import discard_cached
+from utils.lore_memory import get_lore_memory
+from utils.telemetry import traced
+from utils.prompt_templates import prompts
+
+CHARACTER_PROMPT = prompts.register("characters", """
+    You are an expert in identifying names of characters, such as people or animals, in a text.
+    Description is mandatory, short and sweet.
+    Only output names as list as mentioned
+
+    Example 1:
+    Input: "John and his dog Max walked through the forest."
+    Output: [{
+        "name": "John",
+        "titles": [],
+        "race": "Human",
+        "role": null,
+        "owner": null,
+        "description": "Main character in the story."
+    },
+    {
+        "name": "Max",
+        "titles": [],
+        "race": "Dog",
+        "role": null,
+        "owner": "John",
+        "description": "John's faithful dog."
+    }]
+
+    Example 2:
+    Input: "The kingdom of Avalon was ruled by Queen Elaine, who had a fierce tiger named Rajah."
+    Output: [{
+        "name": "Elaine",
+        "titles": [],
+        "race": "Human",
+        "role": "Queen of Avalon",
+        "owner": null,
+        "description": "Ruler of the kingdom of Avalon."
+    },
+    {
+        "name": "Rajah",
+        "titles": [],
+        "race": "Tiger",
+        "role": null,
+        "owner": "Elaine",
+        "description": "Elaine's fierce tiger."
+    }]
+
+    Example 3:
+    Input: "The Night Killer, The Archangel, Weilder of Susanoo, Sasonki, is the heavenly King of Eden."
+    Output: [{
+        "name": "Sasonki",
+        "titles": ["The Night Killer", "The Archangel", "Weilder of Susanoo"],
+        "race": "Angel",
+        "role": "King of Eden.",
+        "owner": null,
+        "description": "Sasonki, known by many titles including The Night Killer, The Archangel, and Weilder of Susanoo, is the heavenly King of Eden."
+    }]
+
+    Example 4:
+    Input: "The city streets were bustling with people, but none stood out."
+    Output: []
+""")
+
+
+class CharacterBatch:
+    """
+    The characters of one extraction. Each character is resolved against the alias index of the conversation
+    and the characters before it as soon as it arrives, and the batch is written with a single bulk write once
+    the extraction has ended. The shared alias index only learns the new aliases once that write has
+    succeeded.
+    """
+
+    def __init__(self, agent):
+        """
+        Initialize the CharacterBatch.
+
+        Args:
+            agent (CharacterAgent): The agent of the conversation the characters belong to.
+        """
+        self.agent = agent
+        # Aliases added by this batch, so duplicates within it resolve to the same character
+        self.staged = CharacterAliasIndex()
+        self.new_characters = {}
+        # The stored name of each extracted name, for the relationships
+        self._names = {}
+        self._updates = {}
+        self._relationships = []
+
+    def add(self, character_data):
+        """
+        Resolve an extracted character and stage it: a new character is inserted, and the new aliases or
+        titles of a known one are added to it.
+
+        Args:
+            character_data (dict): The extracted character data.
+        """
+        if not isinstance(character_data, dict) or not character_data.get("name"):
+            return
+        alias_index = self.agent.alias_index
+        existing_name = alias_index.resolve(character_data) or self.staged.resolve(character_data)
+        if existing_name is None:
+            character = {
+                "conversation_id": self.agent.conversation_id,
+                "name": character_data["name"],
+                "alternate_names": list(character_data.get("alternate_names") or []),
+                "titles": character_data.get("titles", []),
+                "race": character_data.get("race", ""),
+                "role": character_data.get("role", ""),
+                "owner": character_data.get("owner", ""),
+                "description": character_data.get("description", ""),
+                "relationships": [],
+                "stats_pending": True,
+                "timestamp": datetime.utcnow()
+            }
+            self.staged.add(character)
+            self.new_characters[character["name"]] = character
+            self._names[character_data["name"]] = character["name"]
+            return
+
+        self._names[character_data["name"]] = existing_name
+        new_aliases = [alias for alias in alias_index.unknown_aliases(character_data) if alias not in self.staged]
+        if not new_aliases:
+            return
+        self.staged.add_aliases(existing_name, new_aliases)
+        if existing_name in self.new_characters:
+            self.new_characters[existing_name]["alternate_names"].extend(new_aliases)
+        else:
+            self._updates.setdefault(existing_name, {}).setdefault("alternate_names", []).extend(new_aliases)
+
+    def add_relationships(self, relationships):
+        """
+        Stage extracted relationships, as source/target/type dictionaries. They are attached to their source
+        character when the batch is written.
+        """
+        self._relationships.extend(relationships)
+
+    def _resolve_name(self, name):
+        """
+        Return the stored name of a character named in a relationship, whether it was extracted in this batch
+        or is already known to the conversation, or None if it is unknown.
+        """
+        return (self._names.get(name) or self.agent.alias_index.resolve({"name": name})
+                or self.staged.resolve({"name": name}))
+
+    def _attach_relationships(self):
+        """
+        Attach the staged relationships to their source character, naming both sides by their stored name.
+        """
+        for relationship in self._relationships:
+            name = self._resolve_name(relationship["source"])
+            if name is None:
+                continue
+            target = self._resolve_name(relationship["target"]) or relationship["target"]
+            entry = {"target": target, "type": relationship["type"]}
+            if name in self.new_characters:
+                self.new_characters[name]["relationships"].append(entry)
+            else:
+                self._updates.setdefault(name, {}).setdefault("relationships", []).append(entry)
+
+    @traced("characters.store")
+    def commit(self, on_characters_inserted=None):
+        """
+        Write the staged characters, aliases and relationships with a single bulk write.
+
+        Args:
+            on_characters_inserted (callable, optional): Called with the list of newly inserted character documents.
+
+        Returns:
+            list: The newly inserted character documents.
+        """
+        agent = self.agent
+        self._attach_relationships()
+        new_characters = list(self.new_characters.values())
+        operations = [InsertOne(character) for character in new_characters]
+        operations.extend(
+            UpdateOne({"conversation_id": agent.conversation_id, "name": name},
+                      {"$addToSet": {field: {"$each": values} for field, values in update.items()}})
+            for name, update in self._updates.items()
+        )
+
+        if operations:
+            try:
+                agent.characters_collection.bulk_write(operations, ordered=False)
+            except Exception:
+                # Part of the write may have been applied: reload the index from the database next time
+                agent.release()
+                raise
+            agent.alias_index.merge(self.staged)
+        if agent.lore_memory:
+            for character in new_characters:
+                agent.lore_memory.add(agent.collection.full_name, agent.conversation_id, "character",
+                                      agent._lore_text(character), key=normalize_alias(character["name"]))
+        if on_characters_inserted and new_characters:
+            on_characters_inserted(new_characters)
+        return new_characters
+
 
 class CharacterAgent:
-    def __init__(self, db_name, collection_name, conversation_id):
-        self.client = MongoClient(MONGO_URI)
-        self.db = self.client[db_name]
+    def __init__(self, db_name, collection_name, conversation_id, client=None, db=None, cache=None, storage=None,
+                 gate=None, llm_client=None, lore_memory=None):
+        self.db = resolve_database(db_name, client, db)
+        self.llm_client = llm_client or get_llm_client()
+        self.client = self.db.client
         self.collection = self.db[collection_name]
         self.conversation_id = conversation_id
+        self.cache = cache or shared_cache
+        self.message_store = get_message_store(self.db, collection_name, storage)
         self.characters_collection = self.db[f"characters_{collection_name}"]
+        self._alias_index = None
+        self.gate = gate or shared_gate
+        self.lore_memory = lore_memory or get_lore_memory()
+
+    @property
+    def alias_index(self):
+        """
+        The alias index of this conversation, loaded from the database on first use.
+        """
+        if self._alias_index is None:
+            self._alias_index = get_alias_index(self.characters_collection, self.conversation_id)
+        return self._alias_index
+
+    def release(self):
+        """
+        Drop the cached alias index of this conversation, once its session is no longer in memory.
+        """
+        release_alias_index(self.characters_collection, self.conversation_id)
+        self._alias_index = None
+
+    def is_known_character(self, name):
+        """
+        Check whether a name, alternate name or title belongs to a stored character of this conversation.
+        """
+        return name in self.alias_index
 
     def _retrieve_latest_message(self):
         """
@@ -16,9 +252,7 @@ class CharacterAgent:
             dict: The latest message document, or None if no messages are found.
         """
 
-        conversation = self.collection.find_one({"conversation_id": self.conversation_id})
-
-        latest_message = conversation["messages"][-1]
+        latest_message = self.cache.latest_message(self.message_store, self.conversation_id)
 
         return latest_message
     
@@ -32,124 +266,100 @@ class CharacterAgent:
         Returns:
             list: A list of names identified as characters, or an empty list if no names are found.
         """
-        multi_shot_prompt = """
-        You are an expert in identifying names of characters, such as people or animals, in a text.
-        Description is mandatory, short and sweet.
-        Only output names as list as mentioned
-
-        Example 1:
-        Input: "John and his dog Max walked through the forest."
-        Output: [{
-            "name": "John",
-            "titles": [],
-            "race": "Human",
-            "role": null,
-            "owner": null,
-            "description": "Main character in the story."
-        },
-        {
-            "_id": ObjectId("..."),
-            "name": "Max",
-            "titles": [],
-            "race": "Dog",
-            "role": null,
-            "owner": "John",
-            "description": "John's faithful dog."
-        }]
-
-        Example 2:
-        Input: "The kingdom of Avalon was ruled by Queen Elaine, who had a fierce tiger named Rajah."
-        Output: [{
-            "name": "Elaine",
-            "titles": [],
-            "race": "Human",
-            "role": "Queen of Avalon",
-            "owner": null,
-            "description": "Ruler of the kingdom of Avalon."
-        },
-        {
-            "name": "Rajah",
-            "titles": [],
-            "race": "Tiger",
-            "role": null,
-            "owner": "Elaine",
-            "description": "Elaine's fierce tiger."
-        }]
-
-
-        Example 3:
-        Input: "The Night Killer, The Archangel, Weilder of Susanoo, Sasonki, is the heavenly King of Eden."
-        Output: [{
-            "name": "Sasonki",
-            "titles": ["The Night Killer", "The Archangel", "Weilder of Susanoo"],
-            "race": "Angel",
-            "role": "King of Eden.",
-            "owner": null,
-            "description": "Sasonki, known by many titles including The Night Killer, The Archangel, and Weilder of Susanoo, is the heavenly King of Eden."
-        }]
-
-        Example 4:
-        Input: "The city streets were bustling with people, but none stood out."
-        Output: []
-
-        """
-
-        # Fill the prompt with the actual input
-        #filled_prompt = multi_shot_prompt.format()
-
-        # Call the LLM to generate the output
-        completion = llm_client.chat.completions.create(
+        return list(self._iter_characters(message_content))
+
+    def _iter_characters(self, message_content):
+        """
+        Stream the characters identified in a message, yielding each one as soon as the model has finished it.
+
+        Args:
+            message_content (str): The content of the message.
+
+        Yields:
+            dict: The data of each character, in the order the model wrote them.
+        """
+        params = dict(
             model="gemma2-9b-it",
-            messages=[{"role": "system", "content": multi_shot_prompt},
-                      {"role": "user", "content": message_content}],
+            messages=CHARACTER_PROMPT.messages(input=message_content),
             temperature=1,
             max_tokens=1024,
             top_p=1,
             stream=True,
             stop=None,
         )
+        completion = self.llm_client.chat.completions.create(**params)
 
-        char_data = ""
-        for chunk in completion:
-            char_data += chunk.choices[0].delta.content or ""
-
-        #print(char_data)
-        char_data = json.loads(char_data)
-        return char_data
+        try:
+            for character_data in iter_json_items(completion_text(completion)):
+                if isinstance(character_data, dict):
+                    yield character_data
+        except ValueError:
+            # An unparseable reply must not be served from the cache on the next attempt
+            discard_cached(self.llm_client, params)
+            raise
 
-    def process_latest_message_for_characters(self):
+    @traced("extraction.characters")
+    def process_latest_message_for_characters(self, latest_message=None, on_characters_inserted=None):
         """
         Process the latest message to determine if it contains character names and store them in the characters collection.
+
+        Args:
+            latest_message (dict, optional): The message to process. Defaults to the latest stored message.
+            on_characters_inserted (callable, optional): Called with the list of newly inserted character documents.
         """
-        latest_message = self._retrieve_latest_message()
+        if latest_message is None:
+            latest_message = self._retrieve_latest_message()
         if not latest_message:
             return
         
-        character_datas = self._is_character(latest_message["content"])
-        for character_data in character_datas:
-            if not character_data:
-                continue
+        # Skip the extraction call when the message cannot name a new character
+        if not self.gate.should_extract("character", latest_message["content"], self.is_known_character):
+            return
 
-            existing_character = self.characters_collection.find_one({
-                "$or": [
-                    {"name": character_data["name"]},
-                    {"alternate_names": character_data["name"]}
-                ]
-            })
+        # Resolve each character as soon as it is streamed, and write them all once the stream ends
+        batch = self.batch()
+        for character_data in self._iter_characters(latest_message["content"]):
+            batch.add(character_data)
+        batch.commit(on_characters_inserted)
 
-            if existing_character:
-                continue
-            
-            new_character_data = {
-                "conversation_id": self.conversation_id,
-                "name": character_data["name"],
-                "alternate_names": character_data.get("alternate_names", []),
-                "race": character_data.get("race", ""),
-                "role": character_data.get("role", ""),
-                "owner": character_data.get("owner", ""),
-                "description": character_data.get("description", ""),
-                "timestamp": datetime.utcnow()
-            }
-            self.characters_collection.insert_one(new_character_data)
+    def batch(self):
+        """
+        Start a batch of extracted characters, resolved as they are added and written together on commit.
 
-    
+        Returns:
+            CharacterBatch: The empty batch.
+        """
+        return CharacterBatch(self)
+
+    def store_characters(self, character_datas, on_characters_inserted=None, relationships=None):
+        """
+        Resolve extracted characters against the alias index and write the new ones in a single bulk write.
+        New aliases or titles and new relationships of known characters are added in the same write.
+
+        Args:
+            character_datas (list): The extracted character data.
+            on_characters_inserted (callable, optional): Called with the list of newly inserted character documents.
+            relationships (list, optional): Extracted relationships, as source/target/type dictionaries.
+
+        Returns:
+            list: The newly inserted character documents.
+        """
+        batch = self.batch()
+        for character_data in character_datas:
+            batch.add(character_data)
+        batch.add_relationships(relationships or [])
+        return batch.commit(on_characters_inserted)
+
+    @staticmethod
+    def _lore_text(character):
+        """
+        Describe a character in one line for the lore memory.
+        """
+        details = ", ".join(str(detail) for detail in (character.get("race"), character.get("role")) if detail)
+        titles = ", ".join(character.get("titles") or [])
+        text = character["name"]
+        if titles:
+            text += f", {titles}"
+        if details:
+            text += f" ({details})"
+        return f"{text}: {character.get('description') or ''}".rstrip(": ")
@@ -0,0 +1,109 @@
+import re
+
+from utils.settings import env
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens in a text without calling a tokenizer service.
+    Every word or punctuation mark counts as one token, with long words counting as several.
+
+    Args:
+        text (str): The text to measure.
+
+    Returns:
+        int: The estimated token count.
+    """
+    return sum(1 + len(piece) // 8 for piece in _TOKEN_PATTERN.findall(text or ""))
+
+
+def message_tokens(message, overhead=4):
+    """
+    Return the token count of a message, caching it on the message document under 'token_count'.
+
+    Args:
+        message (dict): The message document.
+        overhead (int): The tokens the chat format adds around every message.
+
+    Returns:
+        int: The estimated token count, including the per-message overhead.
+    """
+    if "token_count" not in message:
+        message["token_count"] = estimate_tokens(message["content"])
+    return message["token_count"] + overhead
+
+
+class ContextBuilder:
+    """
+    Assemble the prompt for the game master within a token budget: the system prompt first, then the
+    latest summary, then the lore relevant to the latest messages, then as many of the most recent messages
+    as fit.
+    """
+
+    def __init__(self, token_budget=None, message_overhead=4, lore_token_budget=None):
+        """
+        Initialize the ContextBuilder.
+
+        Args:
+            token_budget (int, optional): The maximum prompt size in tokens. Defaults to CONTEXT_TOKEN_BUDGET.
+            message_overhead (int): The tokens the chat format adds around every message.
+            lore_token_budget (int, optional): The share of the budget retrieved lore may use.
+                Defaults to LORE_TOKEN_BUDGET or 800.
+        """
+        self.token_budget = token_budget or int(env("CONTEXT_TOKEN_BUDGET", 6000))
+        self.message_overhead = message_overhead
+        self.lore_token_budget = lore_token_budget or int(env("LORE_TOKEN_BUDGET", 800))
+
+    def build(self, system_message, summary, messages, max_messages=None, lore=None):
+        """
+        Build the list of chat messages sent to the language model.
+
+        Args:
+            system_message (dict): The system message, or None.
+            summary (str): The latest conversation summary, or None.
+            messages (list): The recent non-system messages, oldest first.
+            max_messages (int, optional): An upper bound on the number of recent messages.
+            lore (list, optional): Passages retrieved from earlier in the story, most relevant first.
+                As many as fit in the lore budget are sent.
+
+        Returns:
+            list: The chat messages, as role/content dictionaries.
+        """
+        context = []
+        used = 0
+        if system_message:
+            context.append({"role": "system", "content": system_message["content"]})
+            used += message_tokens(system_message, self.message_overhead)
+        if summary:
+            summary_message = {"role": "system", "content": f"Summary of the story so far:\n{summary}"}
+            context.append(summary_message)
+            used += estimate_tokens(summary_message["content"]) + self.message_overhead
+        if lore:
+            passages = []
+            lore_used = self.message_overhead
+            for passage in lore:
+                tokens = estimate_tokens(passage) + 1
+                if lore_used + tokens > self.lore_token_budget:
+                    continue
+                passages.append(f"- {passage}")
+                lore_used += tokens
+            if passages:
+                lore_message = {"role": "system", "content": "Relevant lore from earlier in the story:\n" + "\n".join(passages)}
+                context.append(lore_message)
+                used += lore_used
+
+        if max_messages:
+            messages = messages[-max_messages:]
+
+        selected = []
+        for message in reversed(messages):
+            tokens = message_tokens(message, self.message_overhead)
+            # The latest message is always sent, even if it alone exceeds the budget
+            if selected and used + tokens > self.token_budget:
+                break
+            selected.append({"role": message["role"], "content": message["content"]})
+            used += tokens
+
+        return context + selected[::-1]
@@ -0,0 +1,159 @@
+from collections import deque
+import threading
+
+from utils.settings import env
+from utils.telemetry import telemetry
+
+
+class CachedConversation:
+    """
+    The cached tail of one conversation: the system message, a ring buffer of the most recent
+    non-system messages and the message counters.
+    """
+
+    def __init__(self, capacity):
+        self.system_message = None
+        self.recent_messages = deque(maxlen=capacity)
+        self.message_count = 0
+        self.non_system_count = 0
+
+    def append(self, message):
+        """
+        Record a message that has just been written to the database.
+
+        Args:
+            message (dict): The stored message document.
+        """
+        message.setdefault("index", self.message_count)
+        self.message_count += 1
+        if message["role"] == "system":
+            if self.system_message is None:
+                self.system_message = message
+            return
+        self.non_system_count += 1
+        self.recent_messages.append(message)
+
+
+class ConversationCache:
+    """
+    Write-through cache of recent messages per conversation, shared by the managers so that per-turn reads
+    do not grow with the length of the conversation.
+    """
+
+    def __init__(self, capacity=64):
+        """
+        Initialize the cache.
+
+        Args:
+            capacity (int): The number of recent non-system messages kept per conversation.
+        """
+        self.capacity = capacity
+        self._conversations = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, store, conversation_id):
+        """
+        Return the cached conversation, loading its tail from the message store on a miss.
+
+        Args:
+            store (EmbeddedMessageStore | BucketedMessageStore): The store holding the conversation.
+            conversation_id (str): The unique identifier for the conversation.
+
+        Returns:
+            CachedConversation: The cached conversation.
+        """
+        key = (store.collection.full_name, conversation_id)
+        with self._lock:
+            cached = self._conversations.get(key)
+            if cached is None:
+                self.misses += 1
+                cached = self._load(store, conversation_id)
+                self._conversations[key] = cached
+            else:
+                self.hits += 1
+            return cached
+
+    def _load(self, store, conversation_id):
+        """
+        Load the tail of a conversation without reading the whole history.
+        """
+        cached = CachedConversation(self.capacity)
+        tail, first_message, message_count = store.load_tail(conversation_id, self.capacity)
+        if first_message and first_message["role"] == "system":
+            cached.system_message = first_message
+
+        first_index = message_count - len(tail)
+        for position, message in enumerate(tail):
+            message.setdefault("index", first_index + position)
+            if message["role"] != "system":
+                cached.recent_messages.append(message)
+        cached.message_count = message_count
+        cached.non_system_count = message_count - (1 if cached.system_message else 0)
+        return cached
+
+    def append(self, store, conversation_id, message):
+        """
+        Record a message that has just been written to the database.
+
+        Args:
+            store (EmbeddedMessageStore | BucketedMessageStore): The store holding the conversation.
+            conversation_id (str): The unique identifier for the conversation.
+            message (dict): The stored message document.
+        """
+        with self._lock:
+            self.get(store, conversation_id).append(message)
+
+    def recent_messages(self, store, conversation_id, n=None):
+        """
+        Return the most recent non-system messages of a conversation.
+
+        Args:
+            store (EmbeddedMessageStore | BucketedMessageStore): The store holding the conversation.
+            conversation_id (str): The unique identifier for the conversation.
+            n (int, optional): The number of messages to return. Defaults to everything cached.
+
+        Returns:
+            list: The messages, oldest first.
+        """
+        with self._lock:
+            messages = list(self.get(store, conversation_id).recent_messages)
+        return messages[-n:] if n else messages
+
+    def latest_message(self, store, conversation_id):
+        """
+        Return the latest message of a conversation, or None if it has no messages.
+        """
+        with self._lock:
+            cached = self.get(store, conversation_id)
+            if cached.recent_messages:
+                return cached.recent_messages[-1]
+            return cached.system_message
+
+    def invalidate(self, store, conversation_id):
+        """
+        Drop a conversation from the cache so the next read reloads it from the database.
+        """
+        with self._lock:
+            self._conversations.pop((store.collection.full_name, conversation_id), None)
+
+    def stats(self):
+        """
+        Return the hit and miss counters.
+
+        Returns:
+            dict: The counters, the number of cached conversations and the hit rate.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "conversations": len(self._conversations),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+shared_cache = ConversationCache(capacity=int(env("CONVERSATION_CACHE_SIZE", 64)))
+telemetry.register_stats("conversation_cache", shared_cache.stats)
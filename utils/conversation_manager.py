@@ -1,19 +1,68 @@
-from utils.imports import *
+from datetime import datetime
+
+from utils.settings import env, get_llm_client
+from utils.mongo_registry import resolve_database
+from utils.conversation_cache import shared_cache
+from utils.message_store import get_message_store
+from utils.summary_worker import get_summary_worker
+from utils.summary_store import SummaryStore, summary_context
+from utils.context_builder import ContextBuilder, estimate_tokens
+from utils.lore_memory import get_lore_memory
+from utils.llm_cache import uncached
+from utils.telemetry import traced
+from utils.prompt_templates import prompts
+
+CHAPTER_SUMMARY_PROMPT = prompts.register("summary.chapter", """
+    Summarize the conversation given by the user, keeping the important information and ignoring irrelevant details. If a summary of the previous part is given, use it for context only and do not repeat it. The summary should not exceed 150 words.
+""", "{previous}{conversation}")
+ARC_SUMMARY_PROMPT = prompts.register("summary.arc", """
+    Combine the consecutive summaries of a story given by the user into a single summary of the arc. Keep the characters, places, goals and unresolved threads, and drop details that no longer matter. The summary should not exceed 300 words.
+""", "{summaries}")
+CAMPAIGN_SUMMARY_PROMPT = prompts.register("summary.campaign", """
+    Combine the consecutive summaries of a story given by the user into a single summary of the campaign. Keep the characters, places, goals and unresolved threads, and drop details that no longer matter. The summary should not exceed 500 words.
+""", "{summaries}")
+
+# The latest summary of each conversation, per summary collection. Shared by the managers of a process,
+# since the shared summary worker updates it through whichever manager created the worker.
+_latest_summaries = {}
+
 
 class ConversationManager:
-    def __init__(self, db_name, collection_name):
+    def __init__(self, db_name, collection_name, client=None, db=None, cache=None, storage=None, context_builder=None,
+                 llm_client=None, lore_memory=None, lore_top_k=None):
         """
         Initialize the ConversationManager with a connection to the MongoDB database and collections.
         
         Args:
             db_name (str): The name of the MongoDB database.
             collection_name (str): The name of the MongoDB collection to store conversations.
+            client (MongoClient, optional): A client to use instead of the shared pooled client.
+            db (Database, optional): A database to use instead of opening one from the client.
+            cache (ConversationCache, optional): The message cache. Defaults to the cache shared by all managers.
+            storage (str, optional): The message storage mode, "embedded" or "bucketed". Defaults to MESSAGE_STORAGE.
+            context_builder (ContextBuilder, optional): Assembles the prompt within a token budget.
+            llm_client (LLMBackend, optional): The language model backend. Defaults to the shared backend.
+            lore_memory (LoreMemory, optional): The retrieval index of earlier messages, places and characters.
+                Defaults to the shared lore memory, if enabled.
+            lore_top_k (int, optional): The passages retrieved for each reply. Defaults to LORE_TOP_K or 4.
         """
-        self.client = MongoClient(MONGO_URI)
-        self.db = self.client[db_name]
+        self.db = resolve_database(db_name, client, db)
+        self.llm_client = llm_client or get_llm_client()
+        self.client = self.db.client
         self.collection = self.db[collection_name]
         self.summary_collection = self.db[f"summary_{collection_name}"]
+        self.summary_store = SummaryStore(self.summary_collection, self.db[f"summary_heads_{collection_name}"])
+        self.cache = cache or shared_cache
+        self.message_store = get_message_store(self.db, collection_name, storage)
+        self.summary_worker = get_summary_worker(self.db[f"summary_jobs_{collection_name}"],
+                                                 self._summarize_conversation)
+        self.context_builder = context_builder or ContextBuilder()
+        self.lore_memory = lore_memory or get_lore_memory()
+        self.lore_top_k = lore_top_k or int(env("LORE_TOP_K", 4))
+        self.lore_min_score = float(env("LORE_MIN_SCORE", 0.15))
+        self._latest_summaries = _latest_summaries.setdefault(self.summary_collection.full_name, {})
 
+    @traced("conversation.store_message")
     def _store_message(self, conversation_id, role, content):
         """
         Store a message in the MongoDB collection, and check if a summary needs to be created.
@@ -29,15 +78,17 @@ class ConversationManager:
         message_data = {
             "role": role,
             "content": content,
+            "token_count": estimate_tokens(content),
             "timestamp": datetime.utcnow()
         }
-        result = self.collection.update_one(
-            {"conversation_id": conversation_id},
-            {"$push": {"messages": message_data}},
-            upsert=True
-        )
+        # Load the cached tail before writing so the new message is counted exactly once
+        self.cache.get(self.message_store, conversation_id)
+        result = self.message_store.append(conversation_id, message_data)
+        self.cache.append(self.message_store, conversation_id, message_data)
+        if self.lore_memory and role != "system":
+            self.lore_memory.add(self.collection.full_name, conversation_id, "message", content, key=message_data["index"], role=role)
         self._check_and_create_summary(conversation_id)
-        return result.upserted_id or conversation_id
+        return result
 
     def _retrieve_messages(self, conversation_id):
         """
@@ -49,10 +100,7 @@ class ConversationManager:
         Returns:
             list: A list of messages in the conversation.
         """
-        conversation = self.collection.find_one({"conversation_id": conversation_id})
-        if conversation and "messages" in conversation:
-            return conversation["messages"]
-        return []
+        return list(self.message_store.iter_messages(conversation_id))
 
     def _conversation_exists(self, conversation_id):
         """
@@ -64,7 +112,7 @@ class ConversationManager:
         Returns:
             bool: True if the conversation exists, False otherwise.
         """
-        return self.collection.find_one({"conversation_id": conversation_id}) is not None
+        return self.cache.get(self.message_store, conversation_id).message_count > 0
 
     def create_conversation(self, conversation_id):
         """
@@ -86,50 +134,91 @@ class ConversationManager:
         """
         self._store_message(conversation_id, "user", user_input)
 
-    def _get_conversation_messages(self, conversation_id, n=10):
+    def _get_latest_summary(self, conversation_id):
         """
-        Retrieve the last n messages from the conversation, including the system message if it exists.
+        Return the summary of the story so far, reading the conversation's summary head only on the first call.
         
         Args:
             conversation_id (str): The unique identifier for the conversation.
-            n (int): The number of recent messages to retrieve (excluding the system message).
         
         Returns:
-            list: A list of the most recent messages, including the system message if present.
+            str: The campaign summary followed by the arcs and chapters not yet rolled up into it, or None if
+                the conversation has not been summarized yet.
         """
-        all_messages = self._retrieve_messages(conversation_id)
+        if conversation_id not in self._latest_summaries:
+            self._latest_summaries[conversation_id] = summary_context(self.summary_store.head(conversation_id))
+        return self._latest_summaries[conversation_id]
 
-        system_message = None
-        for msg in all_messages:
-            if msg['role'] == 'system':
-                system_message = {"role": msg['role'], "content": msg['content']}
-                break
+    @traced("conversation.build_context")
+    def _get_conversation_messages(self, conversation_id, n=None):
+        """
+        Build the context for the next response within the token budget: the system message, the latest
+        summary, then as many recent messages as fit.
+        
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            n (int, optional): An upper bound on the number of recent messages (excluding the system message).
+        
+        Returns:
+            list: A list of the most recent messages, preceded by the system message and summary if present.
+        """
+        cached = self.cache.get(self.message_store, conversation_id)
+        recent_messages = self.cache.recent_messages(self.message_store, conversation_id)
+        return self.context_builder.build(
+            cached.system_message,
+            self._get_latest_summary(conversation_id),
+            recent_messages,
+            max_messages=n,
+            lore=self._retrieve_lore(conversation_id, recent_messages)
+        )
 
-        recent_messages = [
-            {"role": msg['role'], "content": msg['content']}
-            for msg in all_messages if msg['role'] != 'system'
-        ][-n:]
+    def _retrieve_lore(self, conversation_id, recent_messages):
+        """
+        Retrieve the messages, places and characters from earlier in the story most relevant to the latest
+        exchange, leaving out the messages already in the context.
 
-        if system_message:
-            return [system_message] + recent_messages
-        else:
-            return recent_messages
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            recent_messages (list): The recent messages sent with the prompt, oldest first.
+
+        Returns:
+            list: The passages, most relevant first.
+        """
+        if not self.lore_memory or not recent_messages:
+            return []
+        query = " ".join(message["content"] for message in recent_messages[-2:])
+        results = self.lore_memory.search(
+            self.collection.full_name, conversation_id, query, k=self.lore_top_k, min_score=self.lore_min_score,
+            exclude=[("message", message.get("index")) for message in recent_messages]
+        )
+        passages = []
+        for _, item in results:
+            if item["kind"] == "message":
+                passages.append(f"{item['role'].capitalize()}: {item['text']}")
+            elif item["kind"] == "environment":
+                passages.append(f"{item['name']}: {item['text']}")
+            else:
+                passages.append(item["text"])
+        return passages
 
-    def generate_assistant_response(self, conversation_id, llm_client, n=10):
+    def stream_assistant_response(self, conversation_id, llm_client=None, n=None):
         """
-        Generate a response from the assistant using the conversation history and store it in the database.
+        Stream a response from the assistant, yielding each delta as it arrives, and store the full
+        response in the database once the stream ends.
         
         Args:
             conversation_id (str): The unique identifier for the conversation.
-            llm_client (obj): The client object for interacting with the language model.
-            n (int): The number of recent messages to use for generating the response.
+            llm_client (obj, optional): The client object for interacting with the language model.
+                Defaults to the manager's backend.
+            n (int, optional): An upper bound on the number of recent messages used for the response.
         
-        Returns:
-            str: The assistant's generated response.
+        Yields:
+            str: The next piece of the assistant's response.
         """
         conversation_messages = self._get_conversation_messages(conversation_id, n)
 
-        completion = llm_client.chat.completions.create(
+        # Narrative replies should differ each time, so they always bypass the response cache
+        completion = uncached(llm_client or self.llm_client).chat.completions.create(
             model="llama3-8b-8192",
             messages=conversation_messages,
             temperature=1,
@@ -138,69 +227,131 @@ class ConversationManager:
             stream=True,
             stop=None,
         )
-        assistant_response = ""
+        response_parts = []
         for chunk in completion:
-            assistant_response += chunk.choices[0].delta.content or ""
-        self._store_message(conversation_id, "assistant", assistant_response)
-        return assistant_response
+            delta = chunk.choices[0].delta.content
+            if delta:
+                response_parts.append(delta)
+                yield delta
+        self._store_message(conversation_id, "assistant", "".join(response_parts))
+
+    def generate_assistant_response(self, conversation_id, llm_client=None, n=None):
+        """
+        Generate a response from the assistant using the conversation history and store it in the database.
+        
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            llm_client (obj, optional): The client object for interacting with the language model.
+                Defaults to the manager's backend.
+            n (int, optional): An upper bound on the number of recent messages used for the response.
+        
+        Returns:
+            str: The assistant's generated response.
+        """
+        return "".join(self.stream_assistant_response(conversation_id, llm_client, n))
 
     def _check_and_create_summary(self, conversation_id, n=10):
         """
-        Check if a summary needs to be created based on the number of messages and create it if necessary.
+        Check if a summary needs to be created based on the number of messages and queue it if necessary.
+        The summary is created by the background summary worker, so this never waits on the language model.
         
         Args:
             conversation_id (str): The unique identifier for the conversation.
             n (int): The number of messages after which a summary should be created.
         """
-        messages = self._retrieve_messages(conversation_id)
-        if len([msg for msg in messages if msg['role'] != 'system']) % n == 1:
-            summary_prompt, user_prompt = self._create_summary_prompt(messages, conversation_id)
-            summary_text = self._generate_summary(summary_prompt, user_prompt)
-            self._store_summary(conversation_id, summary_text)
+        cached = self.cache.get(self.message_store, conversation_id)
+        if cached.non_system_count % n == 1:
+            self.summary_worker.enqueue(conversation_id, cached.message_count)
 
-    def _create_summary_prompt(self, messages, conversation_id):
+    @traced("summary.generate")
+    def _summarize_conversation(self, conversation_id, upto_index, n=10):
         """
-        Create the prompt used for generating the conversation summary.
+        Summarize the messages added since the last summary as a new chapter, then roll the chapters and arcs
+        up if enough have accumulated. Run by the summary worker.
         
         Args:
-            messages (list): The list of all messages in the conversation.
             conversation_id (str): The unique identifier for the conversation.
+            upto_index (int): The index after the last message the summary should cover.
+            n (int): The number of messages to summarize when the previous summary has no recorded range.
+        """
+        # Finishes a write interrupted by a crash, so the chain picks up where it left off
+        head = self.summary_store.repair(conversation_id)
+        if head["last_message_index"] is not None:
+            start = head["last_message_index"] + 1
+        elif head["campaign"]:
+            start = max(upto_index - n, 0)
+        else:
+            start = 0
+
+        if start < upto_index:
+            messages = list(self.message_store.iter_messages(conversation_id, start, upto_index))
+            previous_chapter = head["chapters"][-1] if head["chapters"] else None
+            summary_messages = self._create_summary_prompt(messages, previous_chapter)
+            if summary_messages:
+                summary_text = self._generate_summary(summary_messages)
+                head = self.summary_store.append(head, "chapter", summary_text, start, upto_index - 1)
+
+        while True:
+            rollup = self.summary_store.pending_rollup(head)
+            if rollup is None:
+                break
+            level, entries = rollup
+            if level == "campaign" and head["campaign"]:
+                entries = [head["campaign"]] + entries
+            summary_text = self._generate_summary(self._create_rollup_prompt(level, entries))
+            head = self.summary_store.append(head, level, summary_text, entries[0]["first_message_index"],
+                                             entries[-1]["last_message_index"])
+        self._latest_summaries[conversation_id] = summary_context(head)
+
+    def _create_summary_prompt(self, messages, previous_chapter=None):
+        """
+        Create the prompt used for summarizing a chapter of the conversation.
+        
+        Args:
+            messages (list): The messages added since the previous summary.
+            previous_chapter (dict, optional): The previous chapter, given for continuity.
         
         Returns:
-            tuple: A tuple containing the summary prompt and user prompt.
+            list: The system and user messages, or None if there is nothing to summarize.
         """
-        relevant_messages = [msg for msg in messages if msg['role'] != 'system'][-10:]
-        summary_prompt = "Summarize the following conversation, keeping the important information and ignoring irrelevant details. The summary should not exceed 1024 tokens:\n\n"
-        previous_summary = self.summary_collection.find_one({"conversation_id": conversation_id})
-        
-        if previous_summary:
-            summary_prompt = (
-                "This is the previous summary of the conversation:\n"
-                f"{previous_summary['summary']}\n\n"
-                "Using the information above, create a new summary incorporating only the most relevant details from the conversation below:\n\n"
-            )
+        relevant_messages = [msg for msg in messages if msg['role'] != 'system']
+        if not relevant_messages:
+            return None
+        previous = ""
+        if previous_chapter:
+            previous = ("This is the summary of the previous part of the conversation, for context only:\n"
+                        f"{previous_chapter['summary']}\n\nConversation to summarize:\n")
+        conversation = "".join(f"{msg['role'].capitalize()}: {msg['content']}\n" for msg in relevant_messages)
+        return CHAPTER_SUMMARY_PROMPT.messages(previous=previous, conversation=conversation)
+
+    def _create_rollup_prompt(self, level, entries):
+        """
+        Create the prompt used for rolling chapters up into an arc, or arcs into the campaign summary.
         
-        user_prompt = ""
-        for msg in relevant_messages:
-            user_prompt += f"{msg['role'].capitalize()}: {msg['content']}\n"
+        Args:
+            level (str): "arc" or "campaign".
+            entries (list): The summaries rolled up, oldest first.
         
-        return summary_prompt, user_prompt
+        Returns:
+            list: The system and user messages.
+        """
+        template = ARC_SUMMARY_PROMPT if level == "arc" else CAMPAIGN_SUMMARY_PROMPT
+        return template.messages(summaries="\n\n".join(entry["summary"] for entry in entries))
 
-    def _generate_summary(self, summary_prompt, user_prompt):
+    def _generate_summary(self, messages):
         """
         Generate the summary text using the language model.
-        
+
         Args:
-            summary_prompt (str): The prompt containing the summary instructions.
-            user_prompt (str): The prompt containing the conversation messages to summarize.
-        
+            messages (list): The system message with the summary instructions and the user message with the
+                text to summarize.
+
         Returns:
             str: The generated summary text.
         """
-        completion = llm_client.chat.completions.create(
+        completion = self.llm_client.chat.completions.create(
             model="llama3-8b-8192",
-            messages=[{"role": "system", "content": summary_prompt},
-                       {"role": "user", "content": user_prompt}],
+            messages=messages,
             temperature=0.7,
             max_tokens=1024,
             top_p=1,
@@ -213,30 +364,56 @@ class ConversationManager:
             summary += chunk.choices[0].delta.content or ""
         return summary
 
-    def _store_summary(self, conversation_id, summary_text):
+    def summary_versions(self, conversation_id, level=None):
         """
-        Store the generated summary in the summary collection in MongoDB.
+        Return the stored summary versions of a conversation, with the level and message range of each.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            level (str, optional): Only return "chapter", "arc" or "campaign" summaries.
+
+        Returns:
+            list: The summary versions, newest first.
+        """
+        return self.summary_store.versions(conversation_id, level)
+
+    def summary_status(self, conversation_id):
+        """
+        Return the status of the most recent summary job of a conversation.
         
         Args:
             conversation_id (str): The unique identifier for the conversation.
-            summary_text (str): The summary text to store.
+        
+        Returns:
+            dict: The job's status ("pending", "running", "done" or "failed"), or None if there is no job.
         """
-        summary_data = {
-            "conversation_id": conversation_id,
-            "summary": summary_text,
-            "timestamp": datetime.utcnow()
-        }
-        self.summary_collection.insert_one(summary_data)
+        return self.summary_worker.job_status(conversation_id)
+
+    def release(self, conversation_id):
+        """
+        Drop the cached messages and summary of a conversation, once its session is no longer in memory.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+        """
+        self._latest_summaries.pop(conversation_id, None)
+        self.cache.invalidate(self.message_store, conversation_id)
+
+    def close(self):
+        """
+        Stop the background summary worker. Pending summary jobs stay persisted and resume on the next start.
+        """
+        self.summary_worker.close()
 
     def display_conversation(self, conversation_id):
         """
         Display the entire conversation by printing each message with its timestamp and role.
+        Messages are streamed page by page rather than loaded all at once.
         
         Args:
             conversation_id (str): The unique identifier for the conversation.
         """
-        messages = self._retrieve_messages(conversation_id)
-        for message in messages:
+        for message in self.message_store.iter_messages(conversation_id):
             print(f"[{message['timestamp']}] {message['role']}: {message['content']}")
 
 
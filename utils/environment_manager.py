@@ -1,12 +1,83 @@
-from utils.imports import *
+from datetime import datetime
+
+from utils.settings import get_llm_client
+from utils.mongo_registry import resolve_database
+from utils.conversation_cache import shared_cache
+from utils.message_store import get_message_store
+from utils.extraction_gate import shared_gate
+from utils.environment_registry import get_environment_registry, normalize_place, release_environment_registry
+from utils.lore_memory import get_lore_memory
+from utils.telemetry import traced
+from utils.prompt_templates import prompts
+
+ENVIRONMENT_PROMPT = prompts.register("environment", """
+    You are an expert in understanding descriptions of places. Given a description, identify and extract the name of that place. If it does not describe a place, return 'False'. Output only single word.
+
+    Example 1:
+    Input: "The kingdom of Avalon was vast and beautiful, filled with green pastures."
+    Output: "Avalon"
+
+    Example 2:
+    Input: "She walked through the bustling city streets, admiring the architecture."
+    Output: "False"
+
+    Example 3:
+    Input: "The conference room was filled with people discussing the project."
+    Output: False
+
+    Example 4:
+    Input: "They explored the dense forest of Eldergrove, where ancient trees stood tall."
+    Output: "Eldergrove"
+""", """
+    Example 5:
+    Input: "{input_text}"
+    Output:
+""")
+
 
 class EnvironmentManager:
-    def __init__(self, db_name, collection_name, conversation_id):
-        self.client = MongoClient(MONGO_URI)
-        self.db = self.client[db_name]
+    def __init__(self, db_name, collection_name, conversation_id, client=None, db=None, cache=None, storage=None,
+                 gate=None, llm_client=None, lore_memory=None):
+        self.db = resolve_database(db_name, client, db)
+        self.llm_client = llm_client or get_llm_client()
+        self.client = self.db.client
         self.collection = self.db[collection_name]
         self.conversation_id = conversation_id
+        self.cache = cache or shared_cache
+        self.message_store = get_message_store(self.db, collection_name, storage)
         self.environments_collection = self.db[f"environments_{collection_name}"]
+        self.gate = gate or shared_gate
+        self._registry = None
+        self._current_location = None
+        self.lore_memory = lore_memory or get_lore_memory()
+
+    @property
+    def registry(self):
+        """
+        The environment registry of this conversation, loaded from the database on first use.
+        """
+        if self._registry is None:
+            self._registry = get_environment_registry(self.environments_collection, self.conversation_id)
+        return self._registry
+
+    def release(self):
+        """
+        Drop the cached environment registry of this conversation, once its session is no longer in memory.
+        """
+        release_environment_registry(self.environments_collection, self.conversation_id)
+        self._registry = None
+
+    def is_known_environment(self, env_name):
+        """
+        Check whether a place of this conversation is already stored, under this or an equivalent name.
+
+        Args:
+            env_name (str): The name of the place.
+
+        Returns:
+            bool: True if the environment is already stored.
+        """
+        return env_name in self.registry
 
     def _retrieve_latest_message(self):
         """
@@ -15,9 +86,7 @@ class EnvironmentManager:
         Returns:
             dict: The latest message document, or None if no messages are found.
         """
-        conversation = self.collection.find_one({"conversation_id": self.conversation_id})
-
-        latest_message = conversation["messages"][-1]
+        latest_message = self.cache.latest_message(self.message_store, self.conversation_id)
 
         return latest_message
 
@@ -31,38 +100,10 @@ class EnvironmentManager:
         Returns:
             str: The name of the place if it describes an environment, otherwise False.
         """
-        # Multi-shot prompt for the LLM
-        multi_shot_prompt = """
-        You are an expert in understanding descriptions of places. Given a description, identify and extract the name of that place. If it does not describe a place, return 'False'. Output only single word.
-
-        Example 1:
-        Input: "The kingdom of Avalon was vast and beautiful, filled with green pastures."
-        Output: "Avalon"
-
-        Example 2:
-        Input: "She walked through the bustling city streets, admiring the architecture."
-        Output: "False"
-
-        Example 3:
-        Input: "The conference room was filled with people discussing the project."
-        Output: False
-
-        Example 4:
-        Input: "They explored the dense forest of Eldergrove, where ancient trees stood tall."
-        Output: "Eldergrove"
-
-        Example 5:
-        Input: "{input_text}"
-        Output:
-        """
-
-        # Fill the prompt with the actual input
-        filled_prompt = multi_shot_prompt.format(input_text=message_content)
-
         # Call the LLM to generate the output
-        completion = llm_client.chat.completions.create(
+        completion = self.llm_client.chat.completions.create(
             model="gemma-7b-it",
-            messages=[{"role": "system", "content": filled_prompt}],
+            messages=ENVIRONMENT_PROMPT.messages(input_text=message_content),
             temperature=0.7,
             max_tokens=1024,
             top_p=1,
@@ -80,46 +121,111 @@ class EnvironmentManager:
         #print(env_name)
         return env_name if env_name.lower() != "false" else False
 
-    
-    def _store_environment(self, env_name, description, is_update=False):
+    def _store_environment(self, env_name, description):
         """
-        Store or update the environment in the collection.
-        
+        Store a place with a single upsert: inserted with 'description_original' if new, or given
+        'description_updated' if it is known and its description changed.
+
         Args:
             env_name (str): The name of the environment.
             description (str): The description of the environment.
-            is_update (bool): If True, store the description as 'description_updated', otherwise 'description_original'.
+
+        Returns:
+            str: "inserted", "updated", "unchanged" or "ignored".
         """
-        update_field = "description_updated" if is_update else "description_original"
-        existing_env = self.environments_collection.find_one({"env_name": env_name})
-        
-        if existing_env:
-            self.environments_collection.update_one(
-                {"env_name": env_name},
-                {"$set": {update_field: description, "timestamp": datetime.utcnow()}}
-            )
-        else:
-            env_data = {
-                "env_name": env_name,
-                update_field: description,
-                "timestamp": datetime.utcnow()
-            }
-            self.environments_collection.insert_one(env_data)
-
-    def process_latest_environment_description(self):
+        result = self.registry.record(env_name, description, datetime.utcnow())
+        self._remember(env_name, description, result)
+        return result
+
+    def _remember(self, env_name, description, result):
+        """
+        Add a new or changed place description to the lore memory, replacing the place's previous one.
+        """
+        if self.lore_memory and result in ("inserted", "updated"):
+            self.lore_memory.add(self.collection.full_name, self.conversation_id, "environment", description,
+                                 key=normalize_place(env_name), name=env_name)
+
+    def known_mention(self, message_content):
+        """
+        Return the known place a message mentions, if it mentions exactly one. Used for messages the gate
+        keeps from extraction, to follow the current location without a language model call. The message is
+        not known to describe the place, so the place's stored description is left as it is.
+
+        Args:
+            message_content (str): The content of the message.
+
+        Returns:
+            str: The stored name of the place, otherwise False.
+        """
+        places = {self.registry.resolve(candidate) for candidate in self.gate.candidates(message_content)}
+        places.discard(None)
+        return places.pop() if len(places) == 1 else False
+
+    def set_current_location(self, env_name):
+        """
+        Record the place the story is at on the conversation document. Only written when it changes.
+
+        Args:
+            env_name (str): The name of a stored place, or False to leave the location as it is.
+        """
+        if not env_name or env_name == self._current_location:
+            return
+        self.collection.update_one({"conversation_id": self.conversation_id},
+                                   {"$set": {"current_location": env_name}})
+        self._current_location = env_name
+
+    @traced("extraction.environment")
+    def process_latest_environment_description(self, latest_message=None):
         """
         Process the latest message to determine if it describes an environment and store or update the environment.
+
+        Args:
+            latest_message (dict, optional): The message to process. Defaults to the latest stored message.
         """
-        latest_message = self._retrieve_latest_message()
+        if latest_message is None:
+            latest_message = self._retrieve_latest_message()
         if not latest_message:
             return
         
+        # Skip the extraction call when the message cannot name a new place
+        if not self.gate.should_extract("environment", latest_message["content"], self.is_known_environment):
+            self.set_current_location(self.known_mention(latest_message["content"]))
+            return
+
         #print(latest_message)
         env_name = self._is_environment_description(latest_message["content"])
+        self.store_extracted_environment(env_name, latest_message)
 
+    @traced("environment.store")
+    def store_extracted_environment(self, env_name, latest_message):
+        """
+        Store an environment extracted from a message and make it the current location. A known place is only
+        updated if its description changed.
+
+        Args:
+            env_name (str): The name of the place, or False if the message does not describe one.
+            latest_message (dict): The message the environment was extracted from.
+        """
         if env_name != False:
-            existing_env = self.environments_collection.find_one({"env_name": env_name})
-            if existing_env:
-                pass
-            else:
-                self._store_environment(env_name, latest_message["content"], is_update=False)
\ No newline at end of file
+            self._store_environment(env_name, latest_message["content"])
+            self.set_current_location(self.registry.resolve(env_name))
+
+    @traced("environments.store")
+    def store_extracted_environments(self, extracted):
+        """
+        Store the environments extracted from several messages in a single bulk write, in message order, and
+        make the last one the current location. A known place is only updated if its description changed.
+
+        Args:
+            extracted (list): (env_name, message) tuples, in message order.
+
+        Returns:
+            list: The names of the newly stored environments.
+        """
+        places = [(env_name, message["content"]) for env_name, message in extracted if env_name != False]
+        results = self.registry.record_many(places, datetime.utcnow())
+        for (env_name, description), result in zip(places, results):
+            self._remember(env_name, description, result)
+        if places:
+            self.set_current_location(self.registry.resolve(places[-1][0]))
+        return [env_name for (env_name, _), result in zip(places, results) if result == "inserted"]
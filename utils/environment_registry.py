@@ -0,0 +1,283 @@
+import hashlib
+import re
+import threading
+
+from pymongo import UpdateOne
+
+from utils.settings import env
+
+_ARTICLES = {"the", "a", "an"}
+# Words naming the kind of place, dropped from "Kingdom of Avalon" so that it and "Avalon" share a key
+_PLACE_KINDS = {
+    "kingdom", "empire", "realm", "republic", "duchy", "county", "land", "lands", "city", "town", "village",
+    "forest", "woods", "isle", "island", "islands", "mountains", "valley", "lake", "river", "sea", "desert",
+    "castle", "fortress", "tower", "temple", "ruins", "cave", "caves", "port", "plains", "swamp",
+}
+_WORD_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)?")
+_SIMHASH_BITS = 64
+
+
+def normalize_place(name):
+    """
+    Normalize a place name for matching: case-folded, punctuation removed, and leading articles and
+    "<kind> of" dropped, so "the Kingdom of Avalon" and "Avalon" resolve to the same key.
+
+    Args:
+        name (str): The name of the place.
+
+    Returns:
+        str: The normalized key, or an empty string if nothing is left.
+    """
+    words = _WORD_PATTERN.findall((name or "").casefold())
+    while len(words) > 1 and words[0] in _ARTICLES:
+        words.pop(0)
+    if len(words) > 2 and words[0] in _PLACE_KINDS and words[1] == "of":
+        words = words[2:]
+        while len(words) > 1 and words[0] in _ARTICLES:
+            words.pop(0)
+    return " ".join(words)
+
+
+def description_fingerprint(description):
+    """
+    Fingerprint a description: a hash of its normalized words, equal only for the same text up to case,
+    spacing and punctuation, and a 64-bit SimHash of its word pairs, close for similar texts.
+
+    Args:
+        description (str): The description.
+
+    Returns:
+        tuple: The content hash and the SimHash, both as hexadecimal strings.
+    """
+    words = _WORD_PATTERN.findall((description or "").casefold())
+    content_hash = hashlib.sha1(" ".join(words).encode("utf-8")).hexdigest()
+
+    shingles = [" ".join(pair) for pair in zip(words, words[1:])] or [" ".join(words)]
+    # Each shingle hash as a row of bits; a bit of the SimHash is set where most rows have it set
+    rows = [format(int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big"),
+                   f"0{_SIMHASH_BITS}b") for shingle in shingles]
+    bits = "".join("1" if 2 * column.count("1") > len(rows) else "0" for column in zip(*rows))
+    return content_hash, format(int(bits, 2), "016x")
+
+
+def similarity(simhash, other_simhash):
+    """
+    Return the similarity of two SimHashes, from 0.0 to 1.0, as the share of their bits that agree.
+    """
+    differing = bin(int(simhash, 16) ^ int(other_simhash, 16)).count("1")
+    return 1.0 - differing / _SIMHASH_BITS
+
+
+class EnvironmentRegistry:
+    """
+    In-memory index of the places of one conversation, keyed by normalized name, with the fingerprint of
+    each place's current description. It is loaded once and kept in sync as places are written, so known
+    places resolve without a database round-trip and every write is a single atomic upsert or update.
+    The index only changes once a write has succeeded.
+
+    A revisited place is only written back if its new description changed: its content hash differs and
+    its SimHash similarity to the stored description is below the change threshold.
+    """
+
+    def __init__(self, environments_collection, conversation_id, change_threshold=None):
+        """
+        Initialize the EnvironmentRegistry.
+
+        Args:
+            environments_collection (Collection): The collection storing environments.
+            conversation_id (str): The unique identifier for the conversation.
+            change_threshold (float, optional): The similarity at or above which a new description counts as
+                unchanged. Defaults to ENVIRONMENT_CHANGE_THRESHOLD or 0.8.
+        """
+        self.collection = environments_collection
+        self.conversation_id = conversation_id
+        self.change_threshold = change_threshold or float(env("ENVIRONMENT_CHANGE_THRESHOLD", 0.8))
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self._places = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the places of the conversation. Places stored before keys and fingerprints existed get them now,
+        in a single bulk write. When several old rows share a key, only the first is given it.
+        """
+        cursor = self.collection.find(
+            {"conversation_id": self.conversation_id},
+            {"env_name": 1, "env_key": 1, "description_hash": 1, "description_simhash": 1,
+             "description_original": 1, "description_updated": 1}
+        ).sort("_id", 1)
+        operations = []
+        for place in cursor:
+            key = place.get("env_key") or normalize_place(place["env_name"])
+            if not key or key in self._places:
+                continue
+            content_hash, simhash = place.get("description_hash"), place.get("description_simhash")
+            if "env_key" not in place or content_hash is None or simhash is None:
+                description = place.get("description_updated") or place.get("description_original")
+                content_hash, simhash = description_fingerprint(description)
+                operations.append(UpdateOne({"_id": place["_id"]}, {"$set": {
+                    "env_key": key, "description_hash": content_hash, "description_simhash": simhash
+                }}))
+            self._places[key] = {"env_name": place["env_name"], "hash": content_hash, "simhash": simhash}
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+    def resolve(self, name):
+        """
+        Return the stored name of a place, or None if it is not known.
+        """
+        place = self._places.get(normalize_place(name))
+        return place["env_name"] if place else None
+
+    def __contains__(self, name):
+        return normalize_place(name) in self._places
+
+    def _plan(self, env_name, description, timestamp, staged):
+        """
+        Work out the write a place seen in a description needs, if any. The index entry it leads to is put in
+        staged, and only applied to the index once the write succeeds. Must be called with the lock held.
+
+        Returns:
+            tuple: "inserted", "updated", "unchanged" or "ignored", and the filter, update and upsert flag
+                of the write, or None.
+        """
+        key = normalize_place(env_name)
+        if not key:
+            return "ignored", None
+        content_hash, simhash = description_fingerprint(description)
+        place = staged.get(key) or self._places.get(key)
+        if place is None:
+            staged[key] = {"env_name": env_name, "hash": content_hash, "simhash": simhash}
+            return "inserted", (
+                {"conversation_id": self.conversation_id, "env_key": key},
+                {"$setOnInsert": {
+                    "env_name": env_name,
+                    "description_original": description,
+                    "description_hash": content_hash,
+                    "description_simhash": simhash,
+                    "timestamp": timestamp
+                }},
+                True
+            )
+
+        if place["hash"] == content_hash or similarity(place["simhash"], simhash) >= self.change_threshold:
+            return "unchanged", None
+        staged[key] = {**place, "hash": content_hash, "simhash": simhash}
+        return "updated", (
+            {"conversation_id": self.conversation_id, "env_key": key},
+            {"$set": {
+                "description_updated": description,
+                "description_hash": content_hash,
+                "description_simhash": simhash,
+                "timestamp": timestamp
+            }},
+            False
+        )
+
+    def _commit(self, staged, results):
+        """
+        Apply the staged index entries and count the results, once their writes have succeeded.
+        Must be called with the lock held.
+        """
+        self._places.update(staged)
+        for result in results:
+            if result == "inserted":
+                self.inserted += 1
+            elif result == "updated":
+                self.updated += 1
+            elif result == "unchanged":
+                self.unchanged += 1
+
+    def record(self, env_name, description, timestamp):
+        """
+        Store a place seen in a description: inserted if new, updated if its description changed.
+
+        Args:
+            env_name (str): The name of the place.
+            description (str): The description of the place.
+            timestamp (datetime): The time of the write.
+
+        Returns:
+            str: "inserted", "updated", "unchanged", or "ignored" if the name is empty.
+        """
+        staged = {}
+        with self._lock:
+            result, write = self._plan(env_name, description, timestamp, staged)
+            if write is not None:
+                self.collection.update_one(*write)
+            self._commit(staged, [result])
+        return result
+
+    def record_many(self, places, timestamp):
+        """
+        Store several places in a single bulk write, in order. If the write fails, the index is left as it
+        was. The writes are upserts, so storing the same places again is safe.
+
+        Args:
+            places (list): (env_name, description) tuples.
+            timestamp (datetime): The time of the writes.
+
+        Returns:
+            list: "inserted", "updated", "unchanged" or "ignored" for each place.
+        """
+        results = []
+        operations = []
+        staged = {}
+        with self._lock:
+            for env_name, description in places:
+                result, write = self._plan(env_name, description, timestamp, staged)
+                results.append(result)
+                if write is not None:
+                    operations.append(UpdateOne(*write))
+            if operations:
+                self.collection.bulk_write(operations, ordered=True)
+            self._commit(staged, results)
+        return results
+
+    def stats(self):
+        """
+        Return the number of known places and how many writes were inserts, updates or skipped.
+        """
+        return {"places": len(self._places), "inserted": self.inserted, "updated": self.updated,
+                "unchanged": self.unchanged}
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_environment_registry(environments_collection, conversation_id):
+    """
+    Return the environment registry of a conversation, loading it from the database the first time it is
+    requested.
+
+    Args:
+        environments_collection (Collection): The collection storing environments.
+        conversation_id (str): The unique identifier for the conversation.
+
+    Returns:
+        EnvironmentRegistry: The shared registry.
+    """
+    key = (environments_collection.full_name, conversation_id)
+    with _registries_lock:
+        registry = _registries.get(key)
+        if registry is None:
+            registry = EnvironmentRegistry(environments_collection, conversation_id)
+            registry.load()
+            _registries[key] = registry
+        return registry
+
+
+def release_environment_registry(environments_collection, conversation_id):
+    """
+    Drop the cached environment registry of a conversation, so the next request loads it from the database
+    again.
+
+    Args:
+        environments_collection (Collection): The collection storing environments.
+        conversation_id (str): The unique identifier for the conversation.
+    """
+    with _registries_lock:
+        _registries.pop((environments_collection.full_name, conversation_id), None)
@@ -0,0 +1,137 @@
+import re
+import threading
+
+from utils.settings import env
+from utils.telemetry import telemetry
+
+# Capitalized words that start sentences or name no one in particular
+_COMMON_WORDS = {
+    "a", "an", "the", "i", "you", "he", "she", "it", "we", "they", "me", "him", "her", "us", "them",
+    "my", "your", "his", "its", "our", "their", "this", "that", "these", "those", "there", "here",
+    "what", "when", "where", "who", "whom", "why", "how", "which", "yes", "no", "not", "ok", "okay",
+    "and", "but", "or", "so", "if", "then", "as", "at", "by", "for", "from", "in", "into", "of", "on",
+    "to", "with", "without", "after", "before", "while", "suddenly", "meanwhile", "finally", "now",
+    "let", "look", "go", "take", "use", "attack", "run", "walk", "talk", "ask", "tell", "give",
+    "hello", "hi", "hey", "thanks", "please", "well", "oh", "ah",
+}
+_CANDIDATE_PATTERN = re.compile(r"[A-Z][\w'-]*(?:\s+(?:of\s+|the\s+)?[A-Z][\w'-]*)*")
+_SENTENCE_START_PATTERN = re.compile(r"(?:^|[.!?:\"\n]\s*)$")
+
+PRESETS = {
+    # Only skip messages that are short or name nothing new; never miss a sentence-initial name
+    "recall": {"min_length": 12, "min_new_candidates": 1, "include_sentence_initial": True},
+    "balanced": {"min_length": 24, "min_new_candidates": 1, "include_sentence_initial": True},
+    # Ignore sentence-initial words and require two new names before paying for extraction
+    "precision": {"min_length": 40, "min_new_candidates": 2, "include_sentence_initial": False},
+}
+
+
+class ExtractionGate:
+    """
+    Decide locally, without any network call, whether a message could mention a new entity and is worth
+    sending to an extraction model. Counts how many extraction calls it skipped.
+    """
+
+    def __init__(self, min_length=12, min_new_candidates=1, include_sentence_initial=True, enabled=True):
+        """
+        Initialize the ExtractionGate.
+
+        Args:
+            min_length (int): Messages shorter than this many characters are skipped.
+            min_new_candidates (int): The number of unknown proper-noun candidates needed to extract.
+            include_sentence_initial (bool): Whether capitalized words at the start of a sentence count as
+                candidates. Counting them raises recall at the cost of precision.
+            enabled (bool): If False, every message is extracted.
+        """
+        self.min_length = min_length
+        self.min_new_candidates = min_new_candidates
+        self.include_sentence_initial = include_sentence_initial
+        self.enabled = enabled
+        self.checked = {}
+        self.skipped = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_preset(cls, preset):
+        """
+        Create a gate from a named recall/precision preset, or a disabled gate for "off".
+
+        Args:
+            preset (str): "recall", "balanced", "precision" or "off".
+
+        Returns:
+            ExtractionGate: The configured gate.
+        """
+        if preset == "off":
+            return cls(enabled=False)
+        if preset not in PRESETS:
+            raise ValueError(f"Unknown extraction gate preset: {preset}")
+        return cls(**PRESETS[preset])
+
+    def candidates(self, text):
+        """
+        Return the proper-noun candidates of a text: runs of capitalized words such as "Queen Elaine" or
+        "Kingdom of Avalon".
+
+        Args:
+            text (str): The message content.
+
+        Returns:
+            list: The candidate names.
+        """
+        candidates = []
+        for match in _CANDIDATE_PATTERN.finditer(text):
+            words = match.group().split()
+            if _SENTENCE_START_PATTERN.search(text[:match.start()]):
+                if words[0].lower() in _COMMON_WORDS or not self.include_sentence_initial:
+                    words = words[1:]
+            while words and words[0].lower() in ("of", "the"):
+                words = words[1:]
+            if words and not (len(words) == 1 and words[0].lower() in _COMMON_WORDS):
+                candidates.append(" ".join(words).removesuffix("'s"))
+        return candidates
+
+    def should_extract(self, kind, text, is_known=None):
+        """
+        Decide whether a message should go to the extraction model.
+
+        Args:
+            kind (str): The extraction the decision is for, used to group the counters.
+            text (str): The message content.
+            is_known (callable, optional): Returns True for candidates already stored in the database.
+
+        Returns:
+            bool: True if the message may mention something new.
+        """
+        text = text or ""
+        if not self.enabled:
+            extract = True
+        elif len(text.strip()) < self.min_length:
+            extract = False
+        else:
+            new_candidates = [candidate for candidate in self.candidates(text)
+                              if not (is_known and is_known(candidate))]
+            extract = len(new_candidates) >= self.min_new_candidates
+
+        with self._lock:
+            self.checked[kind] = self.checked.get(kind, 0) + 1
+            if not extract:
+                self.skipped[kind] = self.skipped.get(kind, 0) + 1
+        return extract
+
+    def stats(self):
+        """
+        Return how many messages were checked and how many extraction calls were skipped, per kind.
+
+        Returns:
+            dict: The counters keyed by kind.
+        """
+        with self._lock:
+            return {
+                kind: {"checked": checked, "skipped": self.skipped.get(kind, 0)}
+                for kind, checked in self.checked.items()
+            }
+
+
+shared_gate = ExtractionGate.from_preset(env("EXTRACTION_GATE", "recall"))
+telemetry.register_stats("extraction_gate", shared_gate.stats, label="kind")
@@ -0,0 +1,264 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+
+from utils.characteragent_manager import CharacterAgent
+from utils.environment_manager import EnvironmentManager
+from utils.llm_backend import LimitedLLMClient
+from utils.llm_cache import CachedLLMClient
+from utils.settings import env
+from utils.turn_pipeline import TurnPipeline
+
+_DONE = object()
+
+
+class ServerBusy(Exception):
+    """
+    Raised when a turn cannot be queued because too many turns are already waiting for the language model.
+    """
+
+
+class GameSession:
+    """
+    The per-conversation state of the server: the managers scoped to the conversation, its turn pipeline
+    and the lock that keeps its turns in order.
+    """
+
+    def __init__(self, conversation_id, pipeline):
+        self.conversation_id = conversation_id
+        self.pipeline = pipeline
+        self.lock = asyncio.Lock()
+        self.turns = 0
+
+
+class GameSessions:
+    """
+    Host many conversations in one asyncio process. Turns of one conversation run one at a time and in order,
+    while turns of different conversations run in parallel up to the language model concurrency limit.
+    Turns beyond that limit wait in a bounded queue, and are refused with ServerBusy once it is full.
+
+    The managers are synchronous, so their database and language model calls run on bounded thread pools:
+    one for reply streams, sized to the concurrency limit, and one shared by every pipeline for background
+    extraction. Replies, extraction, stats and summaries share the same limit of language model requests in
+    flight, so background work cannot exceed it while replies are generated.
+    """
+
+    def __init__(self, db_name, collection_name, conversation_manager, stats_agent, llm_client, db=None,
+                 llm_concurrency=None, max_pending_turns=None, max_sessions=None, extraction_workers=None):
+        """
+        Initialize the GameSessions.
+
+        Args:
+            db_name (str): The name of the MongoDB database.
+            collection_name (str): The name of the MongoDB collection storing conversations.
+            conversation_manager (ConversationManager): The conversation manager shared by all sessions.
+            stats_agent (StatsGenerator): The stats generator shared by all sessions.
+            llm_client (LLMBackend): The language model backend used for replies.
+            db (Database, optional): A database to use instead of the shared client's.
+            llm_concurrency (int, optional): The number of replies generated at once, and of language model requests
+                in flight across replies and background work. Defaults to LLM_CONCURRENCY or 32.
+            max_pending_turns (int, optional): The number of turns admitted at once, running or waiting for a reply
+                slot. Further turns are refused. Defaults to MAX_PENDING_TURNS or 512.
+            max_sessions (int, optional): The number of idle sessions kept in memory. Defaults to MAX_SESSIONS or 1000.
+            extraction_workers (int, optional): The threads shared by all pipelines for background extraction.
+                Defaults to EXTRACTION_WORKERS or 16.
+        """
+        self.db_name = db_name
+        self.collection_name = collection_name
+        self.db = db
+        self.llm_concurrency = llm_concurrency or int(env("LLM_CONCURRENCY", 32))
+        self._llm_requests = threading.BoundedSemaphore(self.llm_concurrency)
+        self.conversation_manager = conversation_manager
+        self.stats_agent = stats_agent
+        # Every language model call of the sessions' managers goes through the same limit
+        self.llm_client = self._limit(llm_client)
+        conversation_manager.llm_client = self._limit(conversation_manager.llm_client)
+        stats_agent.llm_client = self._limit(stats_agent.llm_client)
+        self.max_pending_turns = max_pending_turns or int(env("MAX_PENDING_TURNS", 512))
+        self.max_sessions = max_sessions or int(env("MAX_SESSIONS", 1000))
+        self.stream_executor = ThreadPoolExecutor(max_workers=self.llm_concurrency, thread_name_prefix="reply")
+        self.extraction_executor = ThreadPoolExecutor(
+            max_workers=extraction_workers or int(env("EXTRACTION_WORKERS", 16)), thread_name_prefix="turn"
+        )
+        self._llm_slots = asyncio.Semaphore(self.llm_concurrency)
+        self._sessions = OrderedDict()
+        self.pending_turns = 0
+        self.active_turns = 0
+        self.refused_turns = 0
+
+    def _limit(self, client):
+        """
+        Wrap a language model client in the shared request limit. A response cache stays outermost, so cached
+        responses take no slot and uncached() still reaches the model.
+        """
+        if isinstance(client, CachedLLMClient):
+            return CachedLLMClient(LimitedLLMClient(client.client, self._llm_requests), client.cache)
+        return LimitedLLMClient(client, self._llm_requests)
+
+    def _create_session(self, conversation_id):
+        """
+        Create the managers and pipeline of a conversation. Runs on a worker thread, as it reads the database.
+        """
+        self.conversation_manager.create_conversation(conversation_id)
+        environment_manager = EnvironmentManager(self.db_name, self.collection_name, conversation_id, db=self.db,
+                                                 llm_client=self.conversation_manager.llm_client)
+        character_manager = CharacterAgent(self.db_name, self.collection_name, conversation_id, db=self.db,
+                                           llm_client=self.conversation_manager.llm_client)
+        pipeline = TurnPipeline(self.conversation_manager, environment_manager, character_manager, self.stats_agent,
+                                conversation_id, self.llm_client, executor=self.extraction_executor)
+        return GameSession(conversation_id, pipeline)
+
+    async def get_session(self, conversation_id):
+        """
+        Return the session of a conversation, creating it on first use. Concurrent first requests for the same
+        conversation share one creation.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+
+        Returns:
+            GameSession: The session.
+        """
+        task = self._sessions.get(conversation_id)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(self._create_session, conversation_id))
+            self._sessions[conversation_id] = task
+            self._evict_idle_sessions()
+        self._sessions.move_to_end(conversation_id)
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            if self._sessions.get(conversation_id) is task:
+                del self._sessions[conversation_id]
+            raise
+
+    def _evict_idle_sessions(self):
+        """
+        Drop the least recently used sessions beyond max_sessions, skipping sessions with a turn in progress or
+        background extraction still running, so a session is never recreated while its previous extraction
+        writes the same data. The conversation's entries in the shared caches are released with it.
+        """
+        for conversation_id in list(self._sessions):
+            if len(self._sessions) <= self.max_sessions:
+                return
+            task = self._sessions[conversation_id]
+            if self._is_idle(task):
+                del self._sessions[conversation_id]
+                pipeline = task.result().pipeline
+                # Every task has finished, so this only collects their errors
+                pipeline.report_errors(pipeline.join())
+                pipeline.release()
+
+    @staticmethod
+    def _is_idle(task):
+        if not task.done() or task.cancelled() or task.exception() is not None:
+            return False
+        session = task.result()
+        return session.turns == 0 and not session.pipeline.has_pending()
+
+    async def stream_turn(self, conversation_id, user_input):
+        """
+        Run a turn and stream its events: "queued" once the turn is accepted, "delta" for each piece of the
+        reply, then "done". Raises ServerBusy before anything is yielded if the turn queue is full.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            user_input (str): The content of the user's message.
+
+        Yields:
+            tuple: The event name and its data.
+        """
+        if self.pending_turns >= self.max_pending_turns:
+            self.refused_turns += 1
+            raise ServerBusy(f"{self.pending_turns} turns are already waiting")
+
+        self.pending_turns += 1
+        try:
+            yield "queued", {"pending_turns": self.pending_turns}
+            session = await self.get_session(conversation_id)
+            session.turns += 1
+            try:
+                async with session.lock:
+                    # The previous turn's extraction must finish before this turn, without holding a reply slot
+                    session.pipeline.report_errors(await asyncio.to_thread(session.pipeline.join))
+                    async with self._llm_slots:
+                        self.active_turns += 1
+                        try:
+                            async with aclosing(self._iterate_in_thread(session.pipeline.stream_turn(user_input))) as deltas:
+                                async for delta in deltas:
+                                    yield "delta", {"content": delta}
+                        finally:
+                            self.active_turns -= 1
+            finally:
+                session.turns -= 1
+        finally:
+            self.pending_turns -= 1
+        yield "done", {}
+
+    async def _iterate_in_thread(self, generator):
+        """
+        Consume a blocking generator on the stream executor and yield its items on the event loop.
+        If the consumer stops early, the generator still runs to the end so the turn is stored, and the
+        conversation lock is held until it has.
+        """
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+
+        def produce():
+            try:
+                for item in generator:
+                    loop.call_soon_threadsafe(items.put_nowait, (item, None))
+            except BaseException as error:
+                loop.call_soon_threadsafe(items.put_nowait, (_DONE, error))
+            else:
+                loop.call_soon_threadsafe(items.put_nowait, (_DONE, None))
+
+        producer = loop.run_in_executor(self.stream_executor, produce)
+        try:
+            while True:
+                item, error = await items.get()
+                if error is not None:
+                    raise error
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            await asyncio.shield(producer)
+
+    async def get_messages(self, conversation_id, page, page_size=None):
+        """
+        Return one page of a conversation's messages.
+        """
+        return await asyncio.to_thread(
+            self.conversation_manager.message_store.get_page, conversation_id, page, page_size
+        )
+
+    def stats(self):
+        """
+        Return the session and turn counters.
+
+        Returns:
+            dict: The counters.
+        """
+        return {
+            "sessions": len(self._sessions),
+            "pending_turns": self.pending_turns,
+            "active_turns": self.active_turns,
+            "refused_turns": self.refused_turns,
+        }
+
+    async def close(self):
+        """
+        Wait for every session's background work, then shut the thread pools and the shared managers down.
+        """
+        sessions = [task.result() for task in self._sessions.values()
+                    if task.done() and not task.cancelled() and task.exception() is None]
+        for session in sessions:
+            async with session.lock:
+                session.pipeline.report_errors(await asyncio.to_thread(session.pipeline.join))
+        self._sessions.clear()
+        self.stream_executor.shutdown(wait=True)
+        self.extraction_executor.shutdown(wait=True)
+        self.conversation_manager.close()
@@ -0,0 +1,210 @@
+import argparse
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from utils import settings
+from utils.mongo_registry import resolve_database, close_all
+
+
+def index_specs(collection_name):
+    """
+    Declare the indexes of every collection used by the managers. Every index includes conversation_id,
+    except the job status index scanned once when the summary worker starts.
+
+    Args:
+        collection_name (str): The name of the MongoDB collection storing conversations.
+
+    Returns:
+        dict: Index models keyed by collection name.
+    """
+    return {
+        collection_name: [
+            IndexModel([("conversation_id", ASCENDING)], unique=True, name="conversation_id_unique"),
+        ],
+        f"messages_{collection_name}": [
+            IndexModel([("conversation_id", ASCENDING), ("seq", ASCENDING)], unique=True),
+        ],
+        f"summary_{collection_name}": [
+            # Only read for conversations summarized before versions existed
+            IndexModel([("conversation_id", ASCENDING), ("timestamp", DESCENDING)]),
+            # Each version is written once. Summaries stored before versions existed have none.
+            IndexModel([("conversation_id", ASCENDING), ("version", DESCENDING)], unique=True,
+                       partialFilterExpression={"version": {"$exists": True}}),
+        ],
+        f"summary_heads_{collection_name}": [
+            IndexModel([("conversation_id", ASCENDING)], unique=True),
+        ],
+        f"summary_jobs_{collection_name}": [
+            IndexModel([("conversation_id", ASCENDING), ("status", ASCENDING)]),
+            IndexModel([("conversation_id", ASCENDING), ("updated_at", DESCENDING)]),
+            IndexModel([("status", ASCENDING)]),
+            # At most one pending job per conversation
+            IndexModel([("conversation_id", ASCENDING)], unique=True, name="one_pending_job_per_conversation",
+                       partialFilterExpression={"status": "pending"}),
+        ],
+        f"environments_{collection_name}": [
+            # One row per normalized place name. Rows stored before keys existed may lack one.
+            IndexModel([("conversation_id", ASCENDING), ("env_key", ASCENDING)], unique=True,
+                       partialFilterExpression={"env_key": {"$exists": True}}),
+        ],
+        f"characters_{collection_name}": [
+            IndexModel([("conversation_id", ASCENDING), ("name", ASCENDING)]),
+            # Multikey index for the alternate name lookup
+            IndexModel([("conversation_id", ASCENDING), ("alternate_names", ASCENDING)]),
+            # Serves both the per-conversation and the global pending-stats lookups
+            IndexModel([("stats_pending", ASCENDING), ("conversation_id", ASCENDING)]),
+        ],
+        f"stats_{collection_name}": [
+            IndexModel([("conversation_id", ASCENDING), ("name", ASCENDING)]),
+            IndexModel([("conversation_id", ASCENDING), ("created_at", DESCENDING)]),
+        ],
+        f"backfill_{collection_name}": [
+            IndexModel([("conversation_id", ASCENDING)], unique=True),
+        ],
+    }
+
+
+def superseded_indexes(collection_name):
+    """
+    Declare the indexes that earlier versions created and that no query uses any more, so they can be dropped.
+
+    Args:
+        collection_name (str): The name of the MongoDB collection storing conversations.
+
+    Returns:
+        dict: Index names keyed by collection name.
+    """
+    return {
+        # Replaced by the unique (conversation_id, env_key) index
+        f"environments_{collection_name}": ["conversation_id_1_env_name_1"],
+        # A global name index, only used by the stats history lookup across conversations
+        f"characters_{collection_name}": ["name_1"],
+    }
+
+
+def hot_queries(collection_name, conversation_id):
+    """
+    The queries run on every turn, as (collection, filter, sort) tuples, for the explain() audit.
+
+    Args:
+        collection_name (str): The name of the MongoDB collection storing conversations.
+        conversation_id (str): The conversation used to fill in the query filters.
+
+    Returns:
+        list: The hot queries.
+    """
+    return [
+        (collection_name, {"conversation_id": conversation_id}, None),
+        (f"messages_{collection_name}", {"conversation_id": conversation_id, "seq": {"$gte": 0}}, [("seq", ASCENDING)]),
+        (f"summary_heads_{collection_name}", {"conversation_id": conversation_id}, None),
+        (f"summary_jobs_{collection_name}", {"conversation_id": conversation_id, "status": "pending"}, None),
+        (f"summary_jobs_{collection_name}", {"conversation_id": conversation_id}, [("updated_at", DESCENDING)]),
+        (f"environments_{collection_name}", {"conversation_id": conversation_id, "env_key": ""}, None),
+        (f"characters_{collection_name}", {
+            "conversation_id": conversation_id,
+            "$or": [{"name": ""}, {"alternate_names": ""}]
+        }, None),
+        (f"stats_{collection_name}", {"conversation_id": conversation_id}, [("created_at", DESCENDING)]),
+        (f"stats_{collection_name}", {"conversation_id": conversation_id, "name": ""}, None),
+        (f"characters_{collection_name}", {"stats_pending": True, "conversation_id": conversation_id}, None),
+    ]
+
+
+def _plan_stages(plan):
+    """
+    Yield every stage name in an explain() plan tree.
+    """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+
+class IndexManager:
+    """
+    Create the indexes the managers rely on and audit the hot queries for collection scans.
+    """
+
+    def __init__(self, db, collection_name):
+        """
+        Initialize the IndexManager.
+
+        Args:
+            db (Database): The database handle.
+            collection_name (str): The name of the MongoDB collection storing conversations.
+        """
+        self.db = db
+        self.collection_name = collection_name
+
+    def ensure_indexes(self):
+        """
+        Create every declared index, then drop the superseded indexes still present. Existing indexes are left
+        untouched, so this is cheap to run at startup.
+
+        Returns:
+            list: The collections whose indexes could not be created or dropped, with the error.
+        """
+        failures = []
+        for name, indexes in index_specs(self.collection_name).items():
+            try:
+                self.db[name].create_indexes(indexes)
+            except OperationFailure as error:
+                failures.append((name, error))
+                print(f"Could not create indexes on {name}: {error}")
+        for name, index_names in superseded_indexes(self.collection_name).items():
+            try:
+                existing = self.db[name].index_information()
+                for index_name in index_names:
+                    if index_name in existing:
+                        self.db[name].drop_index(index_name)
+            except OperationFailure as error:
+                failures.append((name, error))
+                print(f"Could not drop superseded indexes on {name}: {error}")
+        return failures
+
+    def audit(self, conversation_id="audit"):
+        """
+        Run explain() on each hot query and report those that still scan a whole collection.
+
+        Args:
+            conversation_id (str): The conversation used to fill in the query filters.
+
+        Returns:
+            list: The unindexed queries, as (collection, filter) tuples.
+        """
+        unindexed = []
+        for name, query, sort in hot_queries(self.collection_name, conversation_id):
+            cursor = self.db[name].find(query).limit(1)
+            if sort:
+                cursor = cursor.sort(sort)
+            stages = set(_plan_stages(cursor.explain().get("queryPlanner", {})))
+            status = "COLLSCAN" if "COLLSCAN" in stages else "indexed"
+            print(f"[{status}] {name} {query}")
+            if status == "COLLSCAN":
+                unindexed.append((name, query))
+        return unindexed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the game's MongoDB indexes and audit the hot queries.")
+    parser.add_argument("--db", default=settings.DATABASE_NAME, help="The MongoDB database name.")
+    parser.add_argument("--collection", default=settings.COLLECTION_NAME, help="The conversation collection name.")
+    parser.add_argument("--audit", action="store_true", help="Explain each hot query and report collection scans.")
+    parser.add_argument("--conversation-id", default="audit", help="The conversation used in audited queries.")
+    args = parser.parse_args()
+
+    index_manager = IndexManager(resolve_database(args.db), args.collection)
+    index_manager.ensure_indexes()
+    if args.audit:
+        unindexed = index_manager.audit(args.conversation_id)
+        print(f"{len(unindexed)} unindexed hot queries.")
+    close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import json
+import re
+import threading
+
+_STRING = re.compile(r'("(?:[^"\\]|\\.)*")')
+# The start of an object member, up to the colon before its value
+_MEMBER_KEY = re.compile(r'^,?\s*"((?:[^"\\]|\\.)*)"\s*:\s*$')
+# Repairs tried, in order, on an item that does not decode as it is. A quote inside a string literal is
+# escaped, so the ObjectId pattern cannot match there; the others are only applied outside string literals.
+_REPAIRS = [
+    ("object_id", re.compile(r'(?:ObjectId|ISODate)\(\s*("(?:[^"\\]|\\.)*")\s*\)'), r"\1", False),
+    ("trailing_comma", re.compile(r",(\s*[}\]])"), r"\1", True),
+    ("python_literal", re.compile(r"\b(None|True|False)\b"),
+     lambda match: {"None": "null", "True": "true", "False": "false"}[match.group(1)], True),
+]
+
+# Marks an item that could not be decoded
+_INVALID = object()
+
+
+class RecoveryStats:
+    """
+    Thread-safe counters of how often model output needed recovery to parse, by kind of recovery.
+    """
+
+    def __init__(self):
+        self.parsed = 0
+        self.recoveries = {}
+        self._lock = threading.Lock()
+
+    def record(self, recoveries):
+        with self._lock:
+            self.parsed += 1
+            for kind, count in recoveries.items():
+                self.recoveries[kind] = self.recoveries.get(kind, 0) + count
+
+    def stats(self):
+        """
+        Return the number of parsed outputs and the recovery counters.
+        """
+        with self._lock:
+            return {"parsed": self.parsed, **{f"recovered_{kind}": count for kind, count in self.recoveries.items()}}
+
+
+# Counters shared by every parser. They are exported by the turn pipeline, so this module stays cheap to import.
+shared_stats = RecoveryStats()
+
+
+class StreamingJSONParser:
+    """
+    Parse a JSON array or object from a model's streamed output, emitting each top-level item as soon as it
+    is complete: every element of an array, or every (key, value) member of an object.
+
+    Text before the first bracket (prose or a code fence) and after the closing bracket is ignored, and items
+    with ObjectId("...") artifacts, trailing commas or Python literals are repaired. Items that still do not
+    decode are dropped. Every recovery is counted.
+
+    The elements of array members of an object can be streamed too: each one is passed to on_element as
+    soon as it is complete, before the member itself is emitted.
+    """
+
+    def __init__(self, stats=None, stream_keys=(), on_element=None):
+        """
+        Initialize the StreamingJSONParser.
+
+        Args:
+            stats (RecoveryStats, optional): Where the recoveries are counted. Defaults to the shared counters.
+            stream_keys (iterable): The keys of the object members whose array elements are streamed.
+            on_element (callable, optional): Called with (key, element) for each streamed element.
+        """
+        self.stats = stats or shared_stats
+        self.stream_keys = set(stream_keys)
+        self.on_element = on_element
+        self._child = None
+        self._child_key = None
+        self.recoveries = {}
+        self.container = None
+        self.items = []
+        self.complete = False
+        self._skipped = []
+        self._member = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._closed = False
+
+    def _recover(self, kind):
+        self.recoveries[kind] = self.recoveries.get(kind, 0) + 1
+
+    def feed(self, text):
+        """
+        Consume the next chunk of the stream.
+
+        Args:
+            text (str): The chunk.
+
+        Returns:
+            list: The items completed by this chunk. Elements for an array, (key, value) tuples for an object.
+        """
+        completed = []
+        for char in text or "":
+            if self.complete:
+                self._skipped.append(char)
+            elif self.container is None:
+                if char in "[{":
+                    self.container = char
+                    self._depth = 1
+                    self._note_skipped("leading_text")
+                else:
+                    self._skipped.append(char)
+            else:
+                self._consume(char, completed)
+        return completed
+
+    def _consume(self, char, completed):
+        """
+        Advance the scanner by one character inside the top-level container.
+        """
+        if self._child is not None:
+            for element in self._child.feed(char):
+                self.on_element(self._child_key, element)
+            if self._child.complete:
+                self._child = None
+
+        if self._in_string:
+            self._member.append(char)
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+            return
+
+        if char == '"':
+            self._in_string = True
+        elif char in "[{":
+            self._depth += 1
+            if char == "[" and self._depth == 2 and self.container == "{" and self.stream_keys:
+                self._start_child()
+        elif char in "]}":
+            self._depth -= 1
+            if self._depth == 0:
+                self._emit(completed)
+                self.complete = True
+                return
+            if self._depth == 1:
+                self._member.append(char)
+                self._emit(completed)
+                return
+        elif char == "," and self._depth == 1:
+            self._emit(completed)
+            return
+        self._member.append(char)
+
+    def _start_child(self):
+        """
+        Start streaming the elements of the member being scanned, if its key is one of stream_keys.
+        """
+        match = _MEMBER_KEY.match("".join(self._member).strip())
+        if not match:
+            return
+        try:
+            key = json.loads(f'"{match.group(1)}"')
+        except json.JSONDecodeError:
+            return
+        if key in self.stream_keys:
+            # The member is decoded again once complete, so the elements' recoveries are not counted twice
+            self._child = StreamingJSONParser(stats=RecoveryStats())
+            self._child_key = key
+            self._child.feed("[")
+
+    def _emit(self, completed):
+        """
+        Decode the member scanned so far, if any, and add it to the completed items.
+        """
+        text = "".join(self._member).strip().lstrip(",").strip()
+        self._member = []
+        if not text:
+            return
+        value = self._decode(text if self.container == "[" else "{" + text + "}")
+        if value is _INVALID:
+            self._recover("dropped_item")
+            return
+        if self.container == "[":
+            item = value
+        elif isinstance(value, dict) and len(value) == 1:
+            item = next(iter(value.items()))
+        else:
+            self._recover("dropped_item")
+            return
+        self.items.append(item)
+        completed.append(item)
+
+    def _decode(self, text):
+        """
+        Decode one item, applying the repairs in turn until it decodes.
+        """
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            pass
+        for kind, pattern, replacement, outside_strings in _REPAIRS:
+            if outside_strings:
+                # Splitting on a capturing group puts the string literals at the odd positions
+                parts = _STRING.split(text)
+                parts[::2] = [pattern.sub(replacement, part) for part in parts[::2]]
+                repaired = "".join(parts)
+            else:
+                repaired = pattern.sub(replacement, text)
+            if repaired == text:
+                continue
+            text = repaired
+            self._recover(kind)
+            try:
+                return json.loads(text)
+            except json.JSONDecodeError:
+                continue
+        return _INVALID
+
+    def _note_skipped(self, kind):
+        skipped = "".join(self._skipped)
+        self._skipped = []
+        if skipped.strip():
+            self._recover("code_fence" if "```" in skipped else kind)
+
+    def close(self):
+        """
+        End the stream and return the parsed value, assembled from the items.
+
+        Returns:
+            list | dict: The elements of the array, or the members of the object.
+
+        Raises:
+            ValueError: If the stream contained no JSON array or object.
+        """
+        if not self._closed:
+            self._closed = True
+            if self.container is None:
+                self._skipped = []
+                self.stats.record(self.recoveries)
+                raise ValueError("No JSON array or object in the model output")
+            if not self.complete:
+                self._emit([])
+                self._recover("truncated")
+            else:
+                self._note_skipped("trailing_text")
+            self.stats.record(self.recoveries)
+        if self.container == "[":
+            return list(self.items)
+        return dict(self.items)
+
+
+def iter_json_items(chunks, parser=None):
+    """
+    Yield the top-level items of a streamed JSON array or object as they complete.
+
+    Args:
+        chunks (iterable): The streamed text chunks.
+        parser (StreamingJSONParser, optional): The parser to use, to read its value and recoveries afterwards.
+
+    Yields:
+        The elements of an array, or (key, value) tuples of an object.
+    """
+    parser = parser or StreamingJSONParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    parser.close()
+
+
+def parse_json_stream(chunks):
+    """
+    Parse a streamed JSON array or object tolerantly.
+
+    Args:
+        chunks (iterable): The streamed text chunks.
+
+    Returns:
+        list | dict: The parsed value.
+
+    Raises:
+        ValueError: If the stream contained no JSON array or object.
+    """
+    parser = StreamingJSONParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+def completion_text(completion):
+    """
+    Yield the text of each chunk of a streamed chat completion.
+    """
+    for chunk in completion:
+        yield chunk.choices[0].delta.content or ""
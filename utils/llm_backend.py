@@ -0,0 +1,249 @@
+from types import SimpleNamespace
+import hashlib
+import json
+import os
+import threading
+import time
+
+from utils.settings import env
+
+
+def make_chunk(content):
+    """
+    Build an object shaped like a streamed chat completion chunk.
+    """
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=None)])
+
+
+def make_response(content):
+    """
+    Build an object shaped like a non-streamed chat completion.
+    """
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content),
+                                                    finish_reason="stop")])
+
+
+def make_key(params):
+    """
+    Hash the model, messages and sampling parameters of a request into a key.
+    Whether the response is streamed does not change the key.
+
+    Args:
+        params (dict): The keyword arguments of the chat completion request.
+
+    Returns:
+        str: The hex digest of the request.
+    """
+    keyed = {name: value for name, value in params.items() if name != "stream"}
+    encoded = json.dumps(keyed, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class LLMBackend:
+    """
+    Interface of every language model backend. Backends expose `chat.completions.create` with the same
+    arguments and return shapes as the Groq client, so managers can use any of them interchangeably.
+    """
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **params):
+        """
+        Create a chat completion.
+
+        Args:
+            **params: The chat completion request.
+
+        Returns:
+            obj: A chat completion, or an iterator of chunks if stream=True.
+        """
+        raise NotImplementedError
+
+
+class GroqBackend(LLMBackend):
+    """
+    Send requests to the Groq API.
+    """
+
+    def __init__(self, api_key):
+        """
+        Initialize the GroqBackend.
+
+        Args:
+            api_key (str): The Groq API key.
+        """
+        super().__init__()
+        from groq import Groq
+        self.client = Groq(api_key=api_key)
+
+    def create(self, **params):
+        return self.client.chat.completions.create(**params)
+
+
+class RecordingBackend(LLMBackend):
+    """
+    Forward requests to another backend and append each request with its streamed chunks to a JSON-lines file,
+    for later replay with ReplayBackend.
+    """
+
+    def __init__(self, backend, path):
+        """
+        Initialize the RecordingBackend.
+
+        Args:
+            backend (LLMBackend): The backend that serves the requests.
+            path (str): The JSON-lines file recordings are appended to.
+        """
+        super().__init__()
+        self.backend = backend
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def create(self, **params):
+        completion = self.backend.create(**params)
+        if params.get("stream"):
+            return self._record_stream(params, completion)
+        self._write(params, [completion.choices[0].message.content or ""])
+        return completion
+
+    def _record_stream(self, params, completion):
+        """
+        Pass the chunks of a stream through and record them once the stream has been consumed.
+        """
+        chunks = []
+        for chunk in completion:
+            chunks.append(chunk.choices[0].delta.content or "")
+            yield chunk
+        self._write(params, chunks)
+
+    def _write(self, params, chunks):
+        """
+        Append one request and its chunks to the recording file.
+        """
+        record = {"key": make_key(params), "request": params, "chunks": chunks}
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as recording:
+                recording.write(json.dumps(record, default=str) + "\n")
+
+
+class ReplayBackend(LLMBackend):
+    """
+    Serve recorded responses without any network access, optionally simulating the latency of a live stream.
+    Identical requests recorded several times are replayed in recording order.
+    """
+
+    def __init__(self, path, token_latency=0.0, first_token_latency=0.0):
+        """
+        Initialize the ReplayBackend.
+
+        Args:
+            path (str): The JSON-lines file written by RecordingBackend.
+            token_latency (float): Seconds to wait before each chunk after the first.
+            first_token_latency (float): Seconds to wait before the first chunk.
+        """
+        super().__init__()
+        self.token_latency = token_latency
+        self.first_token_latency = first_token_latency
+        self._recordings = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+        with open(path, encoding="utf-8") as recording:
+            for line in recording:
+                if line.strip():
+                    record = json.loads(line)
+                    self._recordings.setdefault(record["key"], []).append(record["chunks"])
+
+    def _next_recording(self, params):
+        """
+        Return the chunks recorded for a request, cycling through repeated recordings of the same request.
+        """
+        key = make_key(params)
+        with self._lock:
+            recordings = self._recordings.get(key)
+            if not recordings:
+                raise KeyError(f"No recording for {params.get('model')} request {key}")
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            return recordings[position % len(recordings)]
+
+    def create(self, **params):
+        chunks = self._next_recording(params)
+        if params.get("stream"):
+            return self._replay_stream(chunks)
+        time.sleep(self.first_token_latency + self.token_latency * max(len(chunks) - 1, 0))
+        return make_response("".join(chunks))
+
+    def _replay_stream(self, chunks):
+        """
+        Yield recorded chunks with the configured simulated latency.
+        """
+        for position, content in enumerate(chunks):
+            delay = self.first_token_latency if position == 0 else self.token_latency
+            if delay:
+                time.sleep(delay)
+            yield make_chunk(content)
+
+
+class LimitedLLMClient(LLMBackend):
+    """
+    Wrap a language model client so that clients sharing a semaphore have at most its number of requests in
+    flight. A streamed request holds its slot from its first read until the stream has been consumed or
+    closed.
+    """
+
+    def __init__(self, client, semaphore):
+        """
+        Initialize the LimitedLLMClient.
+
+        Args:
+            client (obj): The language model client to wrap.
+            semaphore (threading.Semaphore): The slots shared with the other limited clients.
+        """
+        super().__init__()
+        self.client = client
+        self.semaphore = semaphore
+
+    def create(self, **params):
+        if params.get("stream"):
+            return self._limit_stream(params)
+        with self.semaphore:
+            return self.client.chat.completions.create(**params)
+
+    def _limit_stream(self, params):
+        """
+        Start a streamed request once the stream is first read, and release its slot once the stream ends,
+        so a stream that is never read holds no slot.
+        """
+        with self.semaphore:
+            yield from self.client.chat.completions.create(**params)
+
+
+def create_backend_from_env(api_key):
+    """
+    Create the backend selected by LLM_BACKEND: "groq" (default), "record" or "replay".
+    Recordings are read from and written to LLM_RECORDING_PATH, and replay latency is set by
+    LLM_REPLAY_FIRST_TOKEN_LATENCY and LLM_REPLAY_TOKEN_LATENCY, in seconds.
+
+    Args:
+        api_key (str): The Groq API key, used by the groq and record backends.
+
+    Returns:
+        LLMBackend: The backend.
+    """
+    backend = env("LLM_BACKEND", "groq")
+    path = env("LLM_RECORDING_PATH", "recordings/llm.jsonl")
+    if backend == "groq":
+        return GroqBackend(api_key)
+    if backend == "record":
+        return RecordingBackend(GroqBackend(api_key), path)
+    if backend == "replay":
+        return ReplayBackend(
+            path,
+            token_latency=float(env("LLM_REPLAY_TOKEN_LATENCY", 0)),
+            first_token_latency=float(env("LLM_REPLAY_FIRST_TOKEN_LATENCY", 0)),
+        )
+    raise ValueError(f"Unknown LLM backend: {backend}")
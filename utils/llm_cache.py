@@ -0,0 +1,260 @@
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+import time
+
+from utils.llm_backend import LLMBackend, make_chunk, make_key, make_response
+from utils.settings import env
+
+
+class LLMResponseCache:
+    """
+    Two-tier cache of language model responses: an in-memory LRU in front of a SQLite file.
+    Entries expire after a TTL and both tiers are bounded in size.
+    """
+
+    def __init__(self, path=None, max_entries=1024, disk_max_entries=50000, ttl=None):
+        """
+        Initialize the cache.
+
+        Args:
+            path (str, optional): The SQLite file backing the disk tier. No disk tier if not given.
+            max_entries (int): The maximum number of responses held in memory.
+            disk_max_entries (int): The maximum number of responses held on disk.
+            ttl (float, optional): Seconds after which a response expires. Never expires if not given.
+        """
+        self.max_entries = max_entries
+        self.disk_max_entries = disk_max_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._puts_since_eviction = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            self._connection.commit()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Create a cache configured by LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_DISK_MAX_ENTRIES and LLM_CACHE_TTL.
+        """
+        ttl = env("LLM_CACHE_TTL")
+        return cls(
+            path=env("LLM_CACHE_PATH", ".cache/llm_responses.sqlite3"),
+            max_entries=int(env("LLM_CACHE_MAX_ENTRIES", 1024)),
+            disk_max_entries=int(env("LLM_CACHE_DISK_MAX_ENTRIES", 50000)),
+            ttl=float(ttl) if ttl else None,
+        )
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def get(self, key):
+        """
+        Return the cached response for a key, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                response, created_at = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return response
+                del self._memory[key]
+
+            if self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._connection.commit()
+                    self._remember(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        """
+        Store a response in both tiers.
+        """
+        now = time.time()
+        with self._lock:
+            self._remember(key, response, now)
+            if self._connection is None:
+                return
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            self._puts_since_eviction += 1
+            # Trimming the disk tier scans the table, so only do it every so often
+            if self._puts_since_eviction >= 100:
+                self._evict_disk(now)
+            self._connection.commit()
+
+    def delete(self, key):
+        """
+        Drop a response from both tiers.
+        """
+        with self._lock:
+            self._memory.pop(key, None)
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+
+    def _remember(self, key, response, created_at):
+        """
+        Put a response in the memory tier, evicting the least recently used entries beyond the limit.
+        """
+        self._memory[key] = (response, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _evict_disk(self, now):
+        """
+        Drop expired responses and the least recently used ones beyond the disk limit.
+        """
+        self._puts_since_eviction = 0
+        if self.ttl is not None:
+            self._connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        cursor = self._connection.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_max_entries,)
+        )
+        self.evictions += max(cursor.rowcount, 0)
+
+    def stats(self):
+        """
+        Return the hit, miss and eviction counters.
+
+        Returns:
+            dict: The counters and the overall hit rate.
+        """
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """
+        Close the disk tier.
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class CachedLLMClient(LLMBackend):
+    """
+    Wrap a language model client so `chat.completions.create` is served from an LLMResponseCache.
+    Caching is on by default; pass cache=False, or call through `uncached(client)`, for non-deterministic
+    generation that should always reach the model.
+    """
+
+    def __init__(self, client, cache):
+        """
+        Initialize the CachedLLMClient.
+
+        Args:
+            client (obj): The language model client to wrap.
+            cache (LLMResponseCache): The response cache.
+        """
+        super().__init__()
+        self.client = client
+        self.cache = cache
+
+    def create(self, cache=True, **params):
+        """
+        Create a chat completion, serving identical requests from the cache.
+
+        Args:
+            cache (bool): If False, always call the model and do not store the response.
+            **params: The chat completion request.
+
+        Returns:
+            obj: A chat completion, or an iterator of chunks if stream=True.
+        """
+        if not cache:
+            return self.client.chat.completions.create(**params)
+
+        key = make_key(params)
+        cached_response = self.cache.get(key)
+        if cached_response is not None:
+            if params.get("stream"):
+                return iter([make_chunk(cached_response)])
+            return make_response(cached_response)
+
+        completion = self.client.chat.completions.create(**params)
+        if params.get("stream"):
+            return self._store_stream(key, completion)
+        self.cache.put(key, completion.choices[0].message.content or "")
+        return completion
+
+    def _store_stream(self, key, completion):
+        """
+        Pass the chunks of a stream through and cache the full response once the stream has been consumed.
+        """
+        response_parts = []
+        for chunk in completion:
+            response_parts.append(chunk.choices[0].delta.content or "")
+            yield chunk
+        self.cache.put(key, "".join(response_parts))
+
+    def discard(self, **params):
+        """
+        Drop the cached response of a request, such as one whose output could not be parsed, so that the
+        next identical request reaches the model again.
+
+        Args:
+            **params: The chat completion request.
+        """
+        self.cache.delete(make_key(params))
+
+
+def discard_cached(client, params):
+    """
+    Drop the cached response of a request if the client is a CachedLLMClient.
+
+    Args:
+        client (obj): The language model client the request was made with.
+        params (dict): The chat completion request.
+    """
+    if isinstance(client, CachedLLMClient):
+        client.discard(**params)
+
+
+def uncached(client):
+    """
+    Return the client underneath a CachedLLMClient, or the client itself if it is not cached.
+    """
+    return client.client if isinstance(client, CachedLLMClient) else client
@@ -0,0 +1,493 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+from utils import settings
+from utils.settings import env
+from utils.telemetry import telemetry
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+_WORD_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)?")
+# Words too common to tell two passages apart
+_STOP_WORDS = {
+    "the", "and", "you", "your", "are", "was", "were", "with", "that", "this", "for", "from", "his", "her", "its",
+    "their", "they", "them", "she", "him", "has", "have", "had", "into", "onto", "but", "not", "all", "out", "who",
+    "what", "where", "when", "which", "then", "than", "there", "here", "will", "would", "can", "could", "a", "an",
+}
+
+
+class LoreMemoryLocked(Exception):
+    """
+    Raised when the lore memory at a path is already open in another process.
+    """
+
+
+def _try_lock(lock_file):
+    """
+    Take an exclusive lock on an open file without waiting, returning False if another process holds it.
+    """
+    try:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _numpy():
+    """
+    Import NumPy on first use, so the game starts without it when lore memory is disabled.
+    """
+    import numpy
+    return numpy
+
+
+class HashingEmbedder:
+    """
+    Embed text locally as a signed hashing vector of its words and word pairs, L2-normalized, so the dot
+    product of two embeddings is their cosine similarity. No model or network call is involved.
+    """
+
+    def __init__(self, dim=1024):
+        """
+        Initialize the HashingEmbedder.
+
+        Args:
+            dim (int): The number of dimensions.
+        """
+        self.dim = dim
+
+    def features(self, text):
+        """
+        Return the words of a text that carry meaning, and each pair of consecutive ones.
+        """
+        words = [word for word in _WORD_PATTERN.findall((text or "").casefold())
+                 if len(word) > 2 and word not in _STOP_WORDS]
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+    def embed(self, text):
+        """
+        Embed a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            numpy.ndarray: The float32 embedding, all zeros if the text has no features.
+        """
+        np = _numpy()
+        vector = np.zeros(self.dim, dtype=np.float32)
+        hashes = np.fromiter((zlib.crc32(feature.encode("utf-8")) for feature in self.features(text)),
+                             dtype=np.uint32)
+        if not len(hashes):
+            return vector
+        # The top bit chooses the sign, so colliding features tend to cancel out rather than add up
+        signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, hashes % self.dim, signs)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class LoreMemory:
+    """
+    Retrieval index over the lore of every conversation: messages, environment descriptions and character
+    records. Embeddings are rows of a NumPy matrix, memory-mapped from a file when a path is given, and items
+    are added incrementally. Items added with a key replace the previous item with the same key.
+
+    Items belong to a namespace, the full name of the conversation collection, and a conversation, so
+    conversations of different databases or collections never share lore. A search only scores the rows of
+    one conversation, so it takes milliseconds even with many campaigns.
+
+    With a path, the texts stay in the items file and only their offsets are kept in memory, and the
+    embeddings are flushed at most flush_interval seconds after they change. A path is opened by one process
+    at a time, under an exclusive lock on its lock file. The items file is append-only, and is rewritten with
+    only the current items once replaced or removed items outnumber them.
+    """
+
+    def __init__(self, path=None, dim=1024, embedder=None, initial_capacity=1024, compact_min=None,
+                 flush_interval=None):
+        """
+        Initialize the LoreMemory.
+
+        Args:
+            path (str, optional): The directory holding the embeddings and items. Memory only if not given.
+            dim (int): The embedding dimensions.
+            embedder (HashingEmbedder, optional): Embeds the texts. Defaults to a hashing embedder.
+            initial_capacity (int): The rows allocated before the matrix first grows.
+            compact_min (int, optional): The replaced items below which the items file is never compacted.
+                Defaults to LORE_COMPACT_MIN or 1024.
+            flush_interval (float, optional): The most seconds added embeddings stay unflushed. Defaults to
+                LORE_FLUSH_INTERVAL or 5.
+
+        Raises:
+            LoreMemoryLocked: If another process has the path open.
+        """
+        np = _numpy()
+        self.path = path
+        self.dim = dim
+        self.embedder = embedder or HashingEmbedder(dim)
+        self.searches = 0
+        # Per row, the item without its text and extra fields, or None once removed
+        self._items = []
+        self._rows_by_conversation = {}
+        self._rows_by_key = {}
+        self._lock = threading.Lock()
+        self._items_file = None
+        self._reader = None
+        self._lock_file = None
+        # Lines of the items file that a later line replaced or removed, or that were cut short
+        self._superseded = 0
+        self.compact_min = compact_min or int(env("LORE_COMPACT_MIN", 1024))
+        self.flush_interval = flush_interval if flush_interval is not None else float(env("LORE_FLUSH_INTERVAL", 5))
+        self._flushed_at = time.monotonic()
+
+        if path:
+            self._open(initial_capacity)
+        else:
+            self._vectors = np.zeros((initial_capacity, dim), dtype=np.float32)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Create a lore memory configured by LORE_MEMORY_PATH and LORE_MEMORY_DIM.
+        """
+        return cls(path=env("LORE_MEMORY_PATH", ".cache/lore"), dim=int(env("LORE_MEMORY_DIM", 1024)))
+
+    def _open(self, initial_capacity):
+        """
+        Lock the path, open the memory-mapped embeddings and replay the items file.
+        """
+        np = _numpy()
+        os.makedirs(self.path, exist_ok=True)
+        self._lock_file = open(os.path.join(self.path, "lock"), "a+")
+        if not _try_lock(self._lock_file):
+            self._lock_file.close()
+            self._lock_file = None
+            raise LoreMemoryLocked(f"The lore memory at {self.path} is open in another process")
+
+        meta_path = os.path.join(self.path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as meta_file:
+                stored_dim = json.load(meta_file)["dim"]
+            if stored_dim != self.dim:
+                raise ValueError(f"The lore memory at {self.path} has {stored_dim} dimensions, not {self.dim}")
+        else:
+            with open(meta_path, "w", encoding="utf-8") as meta_file:
+                json.dump({"dim": self.dim}, meta_file)
+
+        self._items_path = os.path.join(self.path, "items.jsonl")
+        if os.path.exists(self._items_path):
+            offset = 0
+            with open(self._items_path, "r+b") as items_file:
+                for line in items_file:
+                    if not line.endswith(b"\n"):
+                        # A line cut short by a crash; its row is rewritten by the next add
+                        items_file.truncate(offset)
+                        break
+                    try:
+                        self._replay(json.loads(line), offset)
+                    except ValueError:
+                        self._superseded += 1
+                    offset += len(line)
+        self._items_file = open(self._items_path, "ab")
+        self._reader = open(self._items_path, "rb")
+        self._compact_if_needed()
+
+        self._vectors_path = os.path.join(self.path, "vectors.f32")
+        row_bytes = self.dim * 4
+        existing_rows = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+        capacity = max(existing_rows, initial_capacity, len(self._items))
+        with open(self._vectors_path, "ab") as vectors_file:
+            vectors_file.truncate(capacity * row_bytes)
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def _replay(self, item, offset):
+        """
+        Apply one line of the items file while loading.
+        """
+        # Items written before namespaces existed belong to the default conversation collection
+        item.setdefault("namespace", _legacy_namespace())
+        if item.get("removed"):
+            self._remove(item["namespace"], item["conversation_id"])
+            self._superseded += 1
+        else:
+            self._index(self._entry(item, offset))
+
+    def _entry(self, item, offset):
+        """
+        Return what is kept in memory of an item: everything but its text and extra fields once it is on disk.
+        """
+        if offset is None:
+            return item
+        return {"row": item["row"], "namespace": item["namespace"], "conversation_id": item["conversation_id"],
+                "kind": item["kind"], "key": item["key"], "offset": offset}
+
+    def _read(self, entry):
+        """
+        Return the full item of an entry, reading it from the items file if needed. Must be called with the
+        lock held.
+        """
+        if "offset" not in entry:
+            return entry
+        self._reader.seek(entry["offset"])
+        return json.loads(self._reader.readline())
+
+    def _write(self, item):
+        """
+        Append an item to the items file and return its offset. Must be called with the lock held.
+        """
+        offset = self._items_file.tell()
+        self._items_file.write((json.dumps(item) + "\n").encode("utf-8"))
+        self._items_file.flush()
+        return offset
+
+    def _index(self, entry):
+        """
+        Record an item's row in the lookup tables. Must be called with the lock held, or while loading.
+        """
+        row = entry["row"]
+        scope = (entry["namespace"], entry["conversation_id"])
+        if row == len(self._items):
+            self._items.append(entry)
+            self._rows_by_conversation.setdefault(scope, []).append(row)
+        else:
+            self._items.extend([None] * (row + 1 - len(self._items)))
+            if self._items[row] is None:
+                self._rows_by_conversation.setdefault(scope, []).append(row)
+            else:
+                self._superseded += 1
+            self._items[row] = entry
+        if entry.get("key") is not None:
+            self._rows_by_key[scope + (entry["kind"], entry["key"])] = row
+
+    def _remove(self, namespace, conversation_id):
+        """
+        Drop every item of a conversation from the lookup tables. Must be called with the lock held, or
+        while loading.
+
+        Returns:
+            int: The number of items removed.
+        """
+        rows = self._rows_by_conversation.pop((namespace, conversation_id), [])
+        for row in rows:
+            entry = self._items[row]
+            self._items[row] = None
+            if entry.get("key") is not None:
+                self._rows_by_key.pop((namespace, conversation_id, entry["kind"], entry["key"]), None)
+        self._superseded += len(rows)
+        return len(rows)
+
+    def _ensure_capacity(self, rows):
+        """
+        Grow the matrix to hold at least this many rows, doubling its size.
+        """
+        capacity = self._vectors.shape[0]
+        if rows <= capacity:
+            return
+        np = _numpy()
+        capacity = max(rows, capacity * 2)
+        if self.path:
+            self._vectors.flush()
+            self._flushed_at = time.monotonic()
+            del self._vectors
+            with open(self._vectors_path, "r+b") as vectors_file:
+                vectors_file.truncate(capacity * self.dim * 4)
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        else:
+            vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+            vectors[:len(self._items)] = self._vectors[:len(self._items)]
+            self._vectors = vectors
+
+    def add(self, namespace, conversation_id, kind, text, key=None, **fields):
+        """
+        Add an item to a conversation's lore.
+
+        Args:
+            namespace (str): The full name of the conversation collection.
+            conversation_id (str): The unique identifier for the conversation.
+            kind (str): The kind of item, such as "message", "environment" or "character".
+            text (str): The text that is embedded and returned by searches.
+            key (optional): Identifies the item within its kind. An item with the same key is replaced.
+            **fields: Extra JSON-serializable fields returned with the item.
+        """
+        vector = self.embedder.embed(text)
+        with self._lock:
+            row = self._rows_by_key.get((namespace, conversation_id, kind, key)) if key is not None else None
+            if row is None:
+                row = len(self._items)
+                self._ensure_capacity(row + 1)
+            self._vectors[row] = vector
+            item = {"row": row, "namespace": namespace, "conversation_id": conversation_id, "kind": kind,
+                    "key": key, "text": text, **fields}
+            self._index(self._entry(item, self._write(item) if self._items_file else None))
+            if self._items_file:
+                if time.monotonic() - self._flushed_at >= self.flush_interval:
+                    self._vectors.flush()
+                    self._flushed_at = time.monotonic()
+                self._compact_if_needed()
+
+    def remove(self, namespace, conversation_id):
+        """
+        Remove every item of a conversation, such as before its lore is rebuilt.
+
+        Args:
+            namespace (str): The full name of the conversation collection.
+            conversation_id (str): The unique identifier for the conversation.
+
+        Returns:
+            int: The number of items removed.
+        """
+        with self._lock:
+            removed = self._remove(namespace, conversation_id)
+            if removed and self._items_file:
+                self._write({"removed": True, "namespace": namespace, "conversation_id": conversation_id})
+                self._superseded += 1
+                self._compact_if_needed()
+            return removed
+
+    def _compact_if_needed(self):
+        """
+        Rewrite the items file with only the current items once replaced or removed lines outnumber them.
+        Must be called with the lock held, or while loading.
+        """
+        live = [entry for entry in self._items if entry is not None]
+        if self._superseded < max(self.compact_min, len(live)):
+            return
+        temporary_path = self._items_path + ".tmp"
+        offsets = []
+        with open(temporary_path, "wb") as items_file:
+            for entry in live:
+                offsets.append(items_file.tell())
+                items_file.write((json.dumps(self._read(entry)) + "\n").encode("utf-8"))
+            items_file.flush()
+            os.fsync(items_file.fileno())
+        self._items_file.close()
+        self._reader.close()
+        os.replace(temporary_path, self._items_path)
+        for entry, offset in zip(live, offsets):
+            entry["offset"] = offset
+        self._items_file = open(self._items_path, "ab")
+        self._reader = open(self._items_path, "rb")
+        self._superseded = 0
+
+    def search(self, namespace, conversation_id, query, k=4, min_score=0.0, exclude=()):
+        """
+        Return the items of a conversation most similar to a query.
+
+        Args:
+            namespace (str): The full name of the conversation collection.
+            conversation_id (str): The unique identifier for the conversation.
+            query (str): The text to match.
+            k (int): The maximum number of items returned.
+            min_score (float): The lowest cosine similarity returned.
+            exclude (iterable): (kind, key) pairs of items to leave out, such as messages already in the prompt.
+
+        Returns:
+            list: (score, item) tuples, best first. Items with the same text are returned once.
+        """
+        np = _numpy()
+        query_vector = self.embedder.embed(query)
+        exclude = set(exclude)
+        results = []
+        texts = set()
+        with self._lock:
+            self.searches += 1
+            rows = np.array(self._rows_by_conversation.get((namespace, conversation_id), []), dtype=np.int64)
+            if not len(rows) or not query_vector.any():
+                return []
+            if len(rows) * 4 > len(self._items):
+                # Most rows belong to this conversation: one pass over the matrix beats copying them out
+                scores = (self._vectors[:len(self._items)] @ query_vector)[rows]
+            else:
+                scores = self._vectors[rows] @ query_vector
+            # Extra candidates make up for excluded items and repeated texts
+            candidates = min(len(rows), 2 * k + len(exclude))
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            for position in top[np.argsort(-scores[top])]:
+                score, entry = float(scores[position]), self._items[rows[position]]
+                if score < min_score or len(results) == k:
+                    break
+                if (entry["kind"], entry["key"]) in exclude:
+                    continue
+                # Only the candidates returned are read from disk
+                item = self._read(entry)
+                if item["text"] in texts:
+                    continue
+                texts.add(item["text"])
+                results.append((score, item))
+        return results
+
+    def stats(self):
+        """
+        Return the number of items, conversations and searches.
+        """
+        with self._lock:
+            return {"items": sum(len(rows) for rows in self._rows_by_conversation.values()),
+                    "conversations": len(self._rows_by_conversation), "searches": self.searches}
+
+    def close(self):
+        """
+        Flush the embeddings to disk, close the items file and release the path.
+        """
+        with self._lock:
+            if self._items_file:
+                self._vectors.flush()
+                self._items_file.close()
+                self._items_file = None
+                self._reader.close()
+                self._reader = None
+            if self._lock_file:
+                # Closing the file releases the lock
+                self._lock_file.close()
+                self._lock_file = None
+
+
+def _legacy_namespace():
+    """
+    Return the namespace of items stored before namespaces existed: the default conversation collection.
+    """
+    return f"{settings.DATABASE_NAME}.{settings.COLLECTION_NAME}"
+
+
+_memory = None
+_memory_loaded = False
+_memory_lock = threading.Lock()
+
+
+def get_lore_memory():
+    """
+    Return the process-wide lore memory, created on first use, or None if LORE_MEMORY is 0, NumPy is not
+    installed or another process has LORE_MEMORY_PATH open.
+    """
+    global _memory, _memory_loaded
+    if _memory_loaded:
+        return _memory
+    with _memory_lock:
+        if not _memory_loaded:
+            if env("LORE_MEMORY", "1") != "0":
+                try:
+                    _numpy()
+                except ImportError:
+                    print("NumPy is not installed, so lore memory is disabled.")
+                else:
+                    try:
+                        _memory = LoreMemory.from_env()
+                    except LoreMemoryLocked as error:
+                        print(f"{error}, so lore memory is disabled. Set LORE_MEMORY_PATH to a separate path "
+                              "to give this process its own.")
+                    else:
+                        atexit.register(_memory.close)
+                        telemetry.register_stats("lore_memory", _memory.stats)
+            _memory_loaded = True
+    return _memory
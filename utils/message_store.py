@@ -0,0 +1,347 @@
+import threading
+
+from pymongo import ASCENDING, ReturnDocument
+
+from utils.settings import env
+
+# The (collection, mode) pairs whose stored layout was checked by this process
+_checked_layouts = set()
+_checked_layouts_lock = threading.Lock()
+
+
+class EmbeddedMessageStore:
+    """
+    Store every message of a conversation in the `messages` array of a single conversation document.
+    """
+
+    mode = "embedded"
+
+    def __init__(self, collection, page_size=100):
+        """
+        Initialize the store.
+
+        Args:
+            collection (Collection): The collection holding the conversation documents.
+            page_size (int): The number of messages read per round-trip when iterating.
+        """
+        self.collection = collection
+        self.page_size = page_size
+
+    def append(self, conversation_id, message):
+        """
+        Append a message to a conversation.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            message (dict): The message document.
+
+        Returns:
+            str: The conversation ID or upserted ID.
+        """
+        result = self.collection.update_one(
+            {"conversation_id": conversation_id},
+            {"$push": {"messages": message}, "$inc": {"message_count": 1}},
+            upsert=True
+        )
+        return result.upserted_id or conversation_id
+
+    def message_count(self, conversation_id):
+        """
+        Return the number of messages in a conversation, backfilling the counter for conversations written
+        before message counters existed.
+        """
+        conversation = self.collection.find_one({"conversation_id": conversation_id}, {"message_count": 1})
+        if conversation is None:
+            return 0
+        if "message_count" in conversation:
+            return conversation["message_count"]
+
+        result = list(self.collection.aggregate([
+            {"$match": {"conversation_id": conversation_id}},
+            {"$project": {"count": {"$size": {"$ifNull": ["$messages", []]}}}}
+        ]))
+        message_count = result[0]["count"] if result else 0
+        self.collection.update_one(
+            {"conversation_id": conversation_id, "message_count": {"$exists": False}},
+            {"$set": {"message_count": message_count}}
+        )
+        return message_count
+
+    def load_tail(self, conversation_id, n):
+        """
+        Load the last n messages of a conversation together with its first message and message count.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            n (int): The number of messages to load.
+
+        Returns:
+            tuple: The last n messages, the first message (or None) and the message count.
+        """
+        conversation = self.collection.find_one(
+            {"conversation_id": conversation_id},
+            {"messages": {"$slice": -n}, "message_count": 1}
+        )
+        if conversation is None:
+            return [], None, 0
+
+        tail = conversation.get("messages", [])
+        message_count = conversation.get("message_count")
+        if message_count is None:
+            message_count = self.message_count(conversation_id)
+
+        if message_count > len(tail):
+            head = self.collection.find_one({"conversation_id": conversation_id}, {"messages": {"$slice": 1}})
+            first_message = head["messages"][0] if head and head.get("messages") else None
+        else:
+            first_message = tail[0] if tail else None
+        return tail, first_message, message_count
+
+    def iter_messages(self, conversation_id, start=0, end=None):
+        """
+        Iterate over the messages of a conversation in order, one page per round-trip.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            start (int): The index of the first message to return.
+            end (int, optional): The index after the last message to return. Defaults to the end.
+
+        Yields:
+            dict: The next message.
+        """
+        position = start
+        while end is None or position < end:
+            limit = self.page_size if end is None else min(self.page_size, end - position)
+            conversation = self.collection.find_one(
+                {"conversation_id": conversation_id},
+                {"messages": {"$slice": [position, limit]}, "message_count": 1}
+            )
+            messages = conversation.get("messages", []) if conversation else []
+            yield from messages
+            if len(messages) < limit:
+                return
+            position += len(messages)
+
+    def get_page(self, conversation_id, page, page_size=None):
+        """
+        Return one page of messages.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            page (int): The zero-based page number.
+            page_size (int, optional): The number of messages per page. Defaults to the store page size.
+
+        Returns:
+            list: The messages of the page.
+        """
+        page_size = page_size or self.page_size
+        return list(self.iter_messages(conversation_id, page * page_size, (page + 1) * page_size))
+
+    def ensure_indexes(self):
+        """
+        The embedded layout needs no indexes beyond those of the conversation collection.
+        """
+
+
+class BucketedMessageStore:
+    """
+    Store messages in fixed-size bucket documents keyed by (conversation_id, seq), so no single document
+    grows with the length of the conversation. The conversation document only keeps the message counter.
+    """
+
+    mode = "bucketed"
+
+    def __init__(self, collection, bucket_collection, bucket_size=100):
+        """
+        Initialize the store.
+
+        Args:
+            collection (Collection): The collection holding the conversation documents.
+            bucket_collection (Collection): The collection holding the message buckets.
+            bucket_size (int): The number of messages per bucket.
+        """
+        self.collection = collection
+        self.bucket_collection = bucket_collection
+        self.bucket_size = bucket_size
+        self.page_size = bucket_size
+
+    def append(self, conversation_id, message):
+        """
+        Append a message to a conversation. The message counter is incremented atomically to allocate the
+        message index, which determines the bucket.
+
+        The counter and the bucket are two separate writes, not one transaction. If the process stops between
+        them, the index is allocated but the message is lost, and the conversation has a gap at that index.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            message (dict): The message document.
+
+        Returns:
+            str: The conversation ID or upserted ID.
+        """
+        conversation = self.collection.find_one_and_update(
+            {"conversation_id": conversation_id},
+            {"$inc": {"message_count": 1}, "$setOnInsert": {"storage": self.mode}},
+            projection={"message_count": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        index = conversation["message_count"] - 1
+        message["index"] = index
+        seq = index // self.bucket_size
+        self.bucket_collection.update_one(
+            {"conversation_id": conversation_id, "seq": seq},
+            {
+                "$push": {"messages": message},
+                "$inc": {"count": 1},
+                "$setOnInsert": {"first_index": seq * self.bucket_size}
+            },
+            upsert=True
+        )
+        return conversation_id
+
+    def message_count(self, conversation_id):
+        """
+        Return the number of messages in a conversation.
+        """
+        conversation = self.collection.find_one({"conversation_id": conversation_id}, {"message_count": 1})
+        return conversation.get("message_count", 0) if conversation else 0
+
+    def load_tail(self, conversation_id, n):
+        """
+        Load the last n messages of a conversation together with its first message and message count.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            n (int): The number of messages to load.
+
+        Returns:
+            tuple: The last n messages, the first message (or None) and the message count.
+        """
+        message_count = self.message_count(conversation_id)
+        if message_count == 0:
+            return [], None, 0
+
+        start = max(message_count - n, 0)
+        tail = list(self.iter_messages(conversation_id, start, message_count))
+        if start == 0:
+            first_message = tail[0] if tail else None
+        else:
+            head = self.bucket_collection.find_one(
+                {"conversation_id": conversation_id, "seq": 0},
+                {"messages": {"$slice": 1}}
+            )
+            first_message = head["messages"][0] if head and head.get("messages") else None
+        return tail, first_message, message_count
+
+    def iter_messages(self, conversation_id, start=0, end=None):
+        """
+        Iterate over the messages of a conversation in order, streaming the buckets from a cursor.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            start (int): The index of the first message to return.
+            end (int, optional): The index after the last message to return. Defaults to the end.
+
+        Yields:
+            dict: The next message.
+        """
+        seq_range = {"$gte": start // self.bucket_size}
+        if end is not None:
+            if end <= start:
+                return
+            seq_range["$lte"] = (end - 1) // self.bucket_size
+
+        cursor = self.bucket_collection.find(
+            {"conversation_id": conversation_id, "seq": seq_range},
+            {"messages": 1, "_id": 0}
+        ).sort("seq", ASCENDING).batch_size(4)
+
+        for bucket in cursor:
+            # Concurrent appends to one bucket can land out of order, so order by the allocated index
+            for message in sorted(bucket.get("messages", []), key=lambda msg: msg["index"]):
+                if message["index"] < start:
+                    continue
+                if end is not None and message["index"] >= end:
+                    return
+                yield message
+
+    def get_page(self, conversation_id, page, page_size=None):
+        """
+        Return one page of messages.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            page (int): The zero-based page number.
+            page_size (int, optional): The number of messages per page. Defaults to the bucket size.
+
+        Returns:
+            list: The messages of the page.
+        """
+        page_size = page_size or self.page_size
+        return list(self.iter_messages(conversation_id, page * page_size, (page + 1) * page_size))
+
+    def ensure_indexes(self):
+        """
+        Create the unique (conversation_id, seq) index the bucket reads rely on.
+        """
+        self.bucket_collection.create_index([("conversation_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+
+
+def check_layout(store):
+    """
+    Check that the conversations of a collection are stored in the layout of the store, so switching
+    MESSAGE_STORAGE cannot make existing conversations look empty or mix the two layouts silently.
+
+    Args:
+        store (EmbeddedMessageStore | BucketedMessageStore): The store about to be used.
+
+    Raises:
+        ValueError: If a conversation is stored in the other layout.
+    """
+    if store.mode == "bucketed":
+        mismatch = store.collection.find_one({"messages": {"$exists": True}}, {"conversation_id": 1})
+        remedy = "Run python -m utils.migrate_messages to move them into buckets, or set MESSAGE_STORAGE=embedded."
+    else:
+        mismatch = store.collection.find_one({"storage": "bucketed"}, {"conversation_id": 1})
+        remedy = "Set MESSAGE_STORAGE=bucketed."
+    if mismatch is not None:
+        other = "embedded" if store.mode == "bucketed" else "bucketed"
+        raise ValueError(f"Conversation {mismatch.get('conversation_id')} in {store.collection.full_name} is stored "
+                         f"{other}, but MESSAGE_STORAGE is {store.mode}. {remedy}")
+
+
+def get_message_store(db, collection_name, mode=None, bucket_size=None):
+    """
+    Return the message store for a collection. The first time a process uses a collection in a mode, the
+    stored conversations are checked against it with check_layout().
+
+    Args:
+        db (Database): The database handle.
+        collection_name (str): The name of the MongoDB collection storing conversations.
+        mode (str, optional): "embedded" or "bucketed". Defaults to the MESSAGE_STORAGE environment variable.
+        bucket_size (int, optional): Messages per bucket. Defaults to the MESSAGE_BUCKET_SIZE environment variable.
+
+    Returns:
+        EmbeddedMessageStore | BucketedMessageStore: The message store.
+
+    Raises:
+        ValueError: If the mode is unknown, or conversations are stored in the other layout.
+    """
+    mode = mode or env("MESSAGE_STORAGE", "embedded")
+    collection = db[collection_name]
+    if mode == "embedded":
+        store = EmbeddedMessageStore(collection)
+    elif mode == "bucketed":
+        bucket_size = bucket_size or int(env("MESSAGE_BUCKET_SIZE", 100))
+        store = BucketedMessageStore(collection, db[f"messages_{collection_name}"], bucket_size)
+    else:
+        raise ValueError(f"Unknown message storage mode: {mode}")
+
+    key = (collection.full_name, mode)
+    with _checked_layouts_lock:
+        if key not in _checked_layouts:
+            check_layout(store)
+            _checked_layouts.add(key)
+    return store
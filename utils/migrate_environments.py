@@ -0,0 +1,94 @@
+import argparse
+
+from pymongo import UpdateOne
+
+from utils import settings
+from utils.environment_registry import description_fingerprint, normalize_place
+from utils.mongo_registry import resolve_database, close_all
+
+
+def find_conversation(db, collection_name, description):
+    """
+    Find the conversation a legacy environment was extracted from. Its description is the content of the
+    message it was extracted from, in either message layout.
+
+    Args:
+        db (Database): The database handle.
+        collection_name (str): The name of the MongoDB collection storing conversations.
+        description (str): The stored description of the environment.
+
+    Returns:
+        str: The conversation ID, or None if no message has that content.
+    """
+    for collection in (db[collection_name], db[f"messages_{collection_name}"]):
+        conversation = collection.find_one({"messages.content": description}, {"conversation_id": 1})
+        if conversation is not None:
+            return conversation["conversation_id"]
+    return None
+
+
+def migrate_environments(db, collection_name, default_conversation_id=None, dry_run=False):
+    """
+    Give environments stored before they were scoped per conversation a conversation_id, a normalized
+    env_key and description fingerprints, so the environment registry loads them instead of inserting the
+    same places again. A row whose place the conversation already has is left untouched and reported.
+
+    Args:
+        db (Database): The database handle.
+        collection_name (str): The name of the MongoDB collection storing conversations.
+        default_conversation_id (str, optional): The conversation given to rows whose message is not found.
+        dry_run (bool): If True, only report what would be written.
+
+    Returns:
+        dict: The number of rows migrated, left without a conversation and left as duplicates.
+    """
+    environments = db[f"environments_{collection_name}"]
+    taken = set()
+    operations = []
+    counts = {"migrated": 0, "unassigned": 0, "duplicates": 0}
+    for row in environments.find({"conversation_id": {"$exists": False}}).sort("_id", 1):
+        description = row.get("description_original") or row.get("description_updated")
+        conversation_id = find_conversation(db, collection_name, description) or default_conversation_id
+        key = normalize_place(row.get("env_name"))
+        if conversation_id is None or not key:
+            counts["unassigned"] += 1
+            continue
+        if (conversation_id, key) in taken or environments.find_one(
+            {"conversation_id": conversation_id, "env_key": key}, {"_id": 1}
+        ):
+            counts["duplicates"] += 1
+            continue
+        taken.add((conversation_id, key))
+        content_hash, simhash = description_fingerprint(row.get("description_updated") or description)
+        operations.append(UpdateOne({"_id": row["_id"]}, {"$set": {
+            "conversation_id": conversation_id,
+            "env_key": key,
+            "description_hash": content_hash,
+            "description_simhash": simhash
+        }}))
+        counts["migrated"] += 1
+
+    if operations and not dry_run:
+        environments.bulk_write(operations, ordered=False)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scope environments stored without a conversation to one.")
+    parser.add_argument("--db", default=settings.DATABASE_NAME, help="The MongoDB database name.")
+    parser.add_argument("--collection", default=settings.COLLECTION_NAME, help="The conversation collection name.")
+    parser.add_argument("--conversation-id", dest="default_conversation_id",
+                        help="The conversation given to environments whose source message is not found.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be migrated without writing.")
+    args = parser.parse_args()
+
+    db = resolve_database(args.db)
+    counts = migrate_environments(db, args.collection, args.default_conversation_id, args.dry_run)
+    verb = "Would migrate" if args.dry_run else "Migrated"
+    print(f"{verb} {counts['migrated']} environments. {counts['unassigned']} have no conversation, "
+          f"{counts['duplicates']} duplicate a place the conversation already has.")
+    close_all()
+
+
+if __name__ == "__main__":
+    main()
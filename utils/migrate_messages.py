@@ -0,0 +1,84 @@
+import argparse
+
+from pymongo import ReplaceOne
+
+from utils import settings
+from utils.settings import env
+from utils.mongo_registry import resolve_database, close_all
+from utils.message_store import BucketedMessageStore
+
+
+def migrate_conversation(store, conversation_id, dry_run=False):
+    """
+    Move the embedded messages of one conversation into bucket documents and drop the embedded array.
+    Buckets are written with upserts keyed by (conversation_id, seq), so re-running the migration is safe.
+
+    Args:
+        store (BucketedMessageStore): The store to migrate into.
+        conversation_id (str): The unique identifier for the conversation.
+        dry_run (bool): If True, only report what would be written.
+
+    Returns:
+        int: The number of messages migrated.
+    """
+    conversation = store.collection.find_one({"conversation_id": conversation_id}, {"messages": 1})
+    messages = conversation.get("messages", []) if conversation else []
+    if not messages:
+        return 0
+
+    operations = []
+    for seq, first_index in enumerate(range(0, len(messages), store.bucket_size)):
+        bucket_messages = [
+            {**message, "index": first_index + position}
+            for position, message in enumerate(messages[first_index:first_index + store.bucket_size])
+        ]
+        operations.append(ReplaceOne(
+            {"conversation_id": conversation_id, "seq": seq},
+            {
+                "conversation_id": conversation_id,
+                "seq": seq,
+                "first_index": first_index,
+                "count": len(bucket_messages),
+                "messages": bucket_messages
+            },
+            upsert=True
+        ))
+
+    if dry_run:
+        print(f"{conversation_id}: would write {len(messages)} messages into {len(operations)} buckets")
+        return len(messages)
+
+    store.bucket_collection.bulk_write(operations, ordered=True)
+    store.collection.update_one(
+        {"conversation_id": conversation_id},
+        {"$set": {"message_count": len(messages), "storage": store.mode}, "$unset": {"messages": ""}}
+    )
+    print(f"{conversation_id}: migrated {len(messages)} messages into {len(operations)} buckets")
+    return len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate embedded conversation messages into bucket documents.")
+    parser.add_argument("--db", default=settings.DATABASE_NAME, help="The MongoDB database name.")
+    parser.add_argument("--collection", default=settings.COLLECTION_NAME, help="The conversation collection name.")
+    parser.add_argument("--conversation-id", action="append", dest="conversation_ids",
+                        help="A conversation to migrate. Can be repeated. Defaults to every embedded conversation.")
+    parser.add_argument("--bucket-size", type=int, default=int(env("MESSAGE_BUCKET_SIZE", 100)),
+                        help="The number of messages per bucket.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be migrated without writing.")
+    args = parser.parse_args()
+
+    db = resolve_database(args.db)
+    store = BucketedMessageStore(db[args.collection], db[f"messages_{args.collection}"], args.bucket_size)
+    store.ensure_indexes()
+
+    conversation_ids = args.conversation_ids or store.collection.distinct(
+        "conversation_id", {"messages.0": {"$exists": True}}
+    )
+    total = sum(migrate_conversation(store, conversation_id, args.dry_run) for conversation_id in conversation_ids)
+    print(f"Migrated {total} messages from {len(conversation_ids)} conversations.")
+    close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import atexit
+import threading
+
+from pymongo import MongoClient
+
+from utils.settings import env
+from utils.telemetry import telemetry
+
+
+def _setting(value, env_name, default):
+    """
+    Return an explicit setting, falling back to an integer environment variable and then a default.
+    """
+    if value is not None:
+        return value
+    return int(env(env_name, default))
+
+
+class MongoConnectionRegistry:
+    """
+    Hand out one pooled MongoClient per URI so every manager in the process shares the same
+    connection pool and monitor threads.
+    """
+
+    def __init__(self, max_pool_size=None, min_pool_size=None, server_selection_timeout_ms=None,
+                 connect_timeout_ms=None, socket_timeout_ms=None):
+        """
+        Initialize the registry with the pool settings used for every client it creates.
+        Settings that are not given are read from the environment.
+
+        Args:
+            max_pool_size (int, optional): Maximum number of connections per client.
+            min_pool_size (int, optional): Minimum number of idle connections kept open.
+            server_selection_timeout_ms (int, optional): How long to wait for a suitable server.
+            connect_timeout_ms (int, optional): How long to wait when opening a connection.
+            socket_timeout_ms (int, optional): How long to wait for a reply on an open connection.
+        """
+        self.client_options = {
+            "maxPoolSize": _setting(max_pool_size, "MONGO_MAX_POOL_SIZE", 50),
+            "minPoolSize": _setting(min_pool_size, "MONGO_MIN_POOL_SIZE", 0),
+            "serverSelectionTimeoutMS": _setting(server_selection_timeout_ms, "MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+            "connectTimeoutMS": _setting(connect_timeout_ms, "MONGO_CONNECT_TIMEOUT_MS", 5000),
+            "socketTimeoutMS": _setting(socket_timeout_ms, "MONGO_SOCKET_TIMEOUT_MS", 30000),
+        }
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, uri=None):
+        """
+        Return the shared client for a URI, creating it on first use.
+
+        Args:
+            uri (str, optional): The MongoDB connection string. Defaults to MONGO_URI.
+
+        Returns:
+            MongoClient: The shared client.
+        """
+        uri = uri or env("MONGO_URI")
+        with self._lock:
+            client = self._clients.get(uri)
+            if client is None:
+                options = dict(self.client_options)
+                if telemetry.enabled:
+                    options["event_listeners"] = [telemetry.command_listener()]
+                client = MongoClient(uri, **options)
+                self._clients[uri] = client
+            return client
+
+    def get_database(self, db_name, uri=None):
+        """
+        Return a database handle backed by the shared client.
+
+        Args:
+            db_name (str): The name of the MongoDB database.
+            uri (str, optional): The MongoDB connection string. Defaults to MONGO_URI.
+
+        Returns:
+            Database: The database handle.
+        """
+        return self.get_client(uri)[db_name]
+
+    def close_all(self):
+        """
+        Close every client created by the registry.
+        """
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            client.close()
+
+
+registry = MongoConnectionRegistry()
+atexit.register(registry.close_all)
+
+
+def get_client(uri=None):
+    """
+    Return the process-wide shared MongoClient.
+    """
+    return registry.get_client(uri)
+
+
+def resolve_database(db_name, client=None, db=None):
+    """
+    Resolve the database a manager should use, preferring an injected database, then an injected client,
+    then the shared client.
+
+    Args:
+        db_name (str): The name of the MongoDB database.
+        client (MongoClient, optional): An injected client.
+        db (Database, optional): An injected database.
+
+    Returns:
+        Database: The database handle.
+    """
+    if db is not None:
+        return db
+    if client is not None:
+        return client[db_name]
+    return registry.get_database(db_name)
+
+
+def close_all():
+    """
+    Close every shared client. Registered with atexit, but can be called earlier for a clean shutdown.
+    """
+    registry.close_all()
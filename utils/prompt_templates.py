@@ -0,0 +1,137 @@
+import argparse
+import importlib
+import textwrap
+import threading
+
+from utils.context_builder import estimate_tokens
+
+# The modules that register the prompts, imported by the report
+PROMPT_MODULES = [
+    "utils.characteragent_manager",
+    "utils.environment_manager",
+    "utils.stats_manager",
+    "utils.world_extractor",
+    "utils.conversation_manager",
+]
+
+
+class PromptTemplate:
+    """
+    A prompt compiled once: a static system message holding the instructions and examples, and a template
+    for the user message holding everything that changes per call. The system message is byte-identical on
+    every call and comes first, so provider-side prompt caching can reuse it, and its token count is
+    computed once.
+    """
+
+    def __init__(self, name, static, dynamic="{input}"):
+        """
+        Initialize the PromptTemplate.
+
+        Args:
+            name (str): The name the prompt is reported under.
+            static (str): The instructions and examples. Common indentation and surrounding blank lines are
+                removed once.
+            dynamic (str): The format string of the user message.
+        """
+        self.name = name
+        self.static = textwrap.dedent(static).strip()
+        self.dynamic = textwrap.dedent(dynamic).strip()
+        self.static_tokens = estimate_tokens(self.static)
+        self.calls = 0
+        self.dynamic_tokens = 0
+        self._lock = threading.Lock()
+
+    def messages(self, **fields):
+        """
+        Render the prompt as chat messages and count the tokens it adds to the call.
+
+        Args:
+            **fields: The values of the user message's placeholders.
+
+        Returns:
+            list: The static system message and the rendered user message.
+        """
+        user = self.dynamic.format(**fields)
+        tokens = estimate_tokens(user)
+        with self._lock:
+            self.calls += 1
+            self.dynamic_tokens += tokens
+        return [{"role": "system", "content": self.static}, {"role": "user", "content": user}]
+
+    def stats(self):
+        """
+        Return the calls made with the prompt and its prompt tokens: the static prefix, the average per-call
+        part, and the share of each call taken up by the prefix.
+        """
+        with self._lock:
+            calls, dynamic_tokens = self.calls, self.dynamic_tokens
+        average_dynamic = dynamic_tokens / calls if calls else 0.0
+        return {
+            "calls": calls,
+            "static_tokens": self.static_tokens,
+            "dynamic_tokens_avg": average_dynamic,
+            "prompt_tokens_total": calls * self.static_tokens + dynamic_tokens,
+            "static_share": self.static_tokens / (self.static_tokens + average_dynamic) if calls else 1.0,
+        }
+
+
+class PromptRegistry:
+    """
+    The prompts of every component, by name, with their token accounting.
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, static, dynamic="{input}"):
+        """
+        Compile and register a prompt.
+
+        Args:
+            name (str): The unique name of the prompt.
+            static (str): The instructions and examples, sent as the system message.
+            dynamic (str): The format string of the user message.
+
+        Returns:
+            PromptTemplate: The compiled prompt.
+        """
+        template = PromptTemplate(name, static, dynamic)
+        with self._lock:
+            if name in self._templates:
+                raise ValueError(f"A prompt named {name} is already registered")
+            self._templates[name] = template
+        return template
+
+    def __getitem__(self, name):
+        return self._templates[name]
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._templates.values()))
+
+    def stats(self):
+        """
+        Return the stats of every prompt, keyed by prompt name.
+        """
+        return {template.name: template.stats() for template in self}
+
+
+prompts = PromptRegistry()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the static prompt tokens of every registered prompt.")
+    parser.parse_args()
+    for module in PROMPT_MODULES:
+        importlib.import_module(module)
+    # Run with -m, this file is __main__, and the modules registered their prompts on the imported copy
+    registry = importlib.import_module("utils.prompt_templates").prompts
+    templates = sorted(registry, key=lambda template: template.static_tokens, reverse=True)
+    print(f"{'prompt':<24}{'static tokens':>15}")
+    for template in templates:
+        print(f"{template.name:<24}{template.static_tokens:>15}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import os
+import threading
+
+# Settings resolved from the environment on first access, and the variables they are read from
+_SETTINGS = {
+    "GROQ_KEY": "GROQ",
+    "DATABASE_NAME": "DATABASE_NAME",
+    "COLLECTION_NAME": "TEST_COLLECTION",
+    "MONGO_URI": "MONGO_URI",
+}
+
+_lock = threading.RLock()
+_environment_loaded = False
+_llm_client = None
+
+
+def load_environment():
+    """
+    Load the .env file into the environment the first time it is needed. Variables that are already set
+    are not overridden.
+    """
+    global _environment_loaded
+    if _environment_loaded:
+        return
+    with _lock:
+        if not _environment_loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _environment_loaded = True
+
+
+def env(name, default=None):
+    """
+    Return an environment variable, loading the .env file first.
+
+    Args:
+        name (str): The variable name.
+        default (str, optional): The value returned if the variable is not set.
+
+    Returns:
+        str: The value of the variable.
+    """
+    load_environment()
+    return os.getenv(name, default)
+
+
+def get_llm_client():
+    """
+    Return the process-wide language model backend, used by managers that are not given one.
+    The backend, its tracing wrapper and its response cache are created on first use.
+    """
+    global _llm_client
+    if _llm_client is not None:
+        return _llm_client
+    with _lock:
+        if _llm_client is None:
+            from utils.llm_backend import create_backend_from_env
+            from utils.llm_cache import CachedLLMClient, LLMResponseCache
+            from utils.telemetry import TracedLLMClient, telemetry
+
+            client = TracedLLMClient(create_backend_from_env(env("GROQ")), telemetry)
+            if env("LLM_CACHE", "1") != "0":
+                client = CachedLLMClient(client, LLMResponseCache.from_env())
+                telemetry.register_stats("llm_cache", client.cache.stats)
+            _llm_client = client
+    return _llm_client
+
+
+def __getattr__(name):
+    """
+    Resolve settings such as DATABASE_NAME when they are first accessed.
+    """
+    if name in _SETTINGS:
+        return env(_SETTINGS[name])
+    if name == "llm_client":
+        return get_llm_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,122 @@
+from collections import deque
+import threading
+
+# The number of recent stats shown to the model as reference examples
+HISTORY_SIZE = 3
+# Bookkeeping fields of a character document that are left out of the examples
+_HIDDEN_FIELDS = ("_id", "timestamp", "stats_pending", "stats_claimed_at", "stats_attempts", "stats_failed")
+
+
+def history_entry(character, stats):
+    """
+    Merge a character document with its stats into a reference example for the stats prompt.
+
+    Args:
+        character (dict): The character document.
+        stats (dict): The stats generated for the character.
+
+    Returns:
+        dict: The example, without the bookkeeping fields.
+    """
+    entry = {"name": character["name"], "stats": stats, **character}
+    for field in _HIDDEN_FIELDS:
+        entry.pop(field, None)
+    return entry
+
+
+class StatsHistoryWindow:
+    """
+    The latest stats of one conversation merged with their character details, kept in memory and updated as
+    stats are inserted, so the stats prompt's reference examples cost no database read once loaded.
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def load(self, stats_collection, characters_collection, conversation_id):
+        """
+        Load the latest stats of a conversation, then their characters with one query on the conversation's
+        (conversation_id, name) index, so characters of other conversations with the same name are never read.
+
+        Args:
+            stats_collection (Collection): The collection storing stats.
+            characters_collection (Collection): The collection storing characters.
+            conversation_id (str): The unique identifier for the conversation.
+        """
+        stats = list(stats_collection.find(
+            {"conversation_id": conversation_id}, {"_id": 0, "name": 1, "stats": 1}
+        ).sort("created_at", -1).limit(self._entries.maxlen))
+        characters = {}
+        for character in characters_collection.find(
+            {"conversation_id": conversation_id, "name": {"$in": [stat["name"] for stat in stats]}}
+        ):
+            characters.setdefault(character["name"], character)
+        entries = [history_entry(characters.get(stat["name"], {"name": stat["name"]}), stat["stats"])
+                   for stat in stats]
+        with self._lock:
+            # Newest last, like the entries added afterwards
+            self._entries.extend(reversed(entries))
+
+    def add(self, character, stats):
+        """
+        Add the stats just inserted for a character, evicting the oldest entry once the window is full.
+
+        Args:
+            character (dict): The character document.
+            stats (dict): The stats generated for the character.
+        """
+        entry = history_entry(character, stats)
+        with self._lock:
+            self._entries.append(entry)
+
+    def entries(self):
+        """
+        Return the examples, newest first.
+
+        Returns:
+            list: The merged stats and character details.
+        """
+        with self._lock:
+            return list(reversed(self._entries))
+
+
+_windows = {}
+_windows_lock = threading.Lock()
+
+
+def get_stats_history(stats_collection, characters_collection, conversation_id):
+    """
+    Return the stats history window of a conversation, loading it from the database the first time it is
+    requested.
+
+    Args:
+        stats_collection (Collection): The collection storing stats.
+        characters_collection (Collection): The collection storing characters.
+        conversation_id (str): The unique identifier for the conversation.
+
+    Returns:
+        StatsHistoryWindow: The shared window.
+    """
+    key = (stats_collection.full_name, conversation_id)
+    with _windows_lock:
+        window = _windows.get(key)
+        if window is None:
+            window = StatsHistoryWindow()
+            window.load(stats_collection, characters_collection, conversation_id)
+            _windows[key] = window
+        return window
+
+
+def release_stats_history(stats_collection, conversation_id):
+    """
+    Drop the cached stats history window of a conversation, so the next request loads it from the database
+    again.
+
+    Args:
+        stats_collection (Collection): The collection storing stats.
+        conversation_id (str): The unique identifier for the conversation.
+    """
+    with _windows_lock:
+        _windows.pop((stats_collection.full_name, conversation_id), None)
+
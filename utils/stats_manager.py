@@ -1,138 +1,301 @@
-from utils.imports import *
+from datetime import datetime, timedelta
+import json
+import uuid
+
+from pymongo import UpdateOne
+
+from utils.settings import env, get_llm_client
+from utils.mongo_registry import resolve_database
+from utils.json_stream import completion_text, parse_json_stream
+from utils.llm_cache import discard_cached
+from utils.stats_history import get_stats_history, release_stats_history
+from utils.telemetry import traced
+from utils.prompt_templates import prompts
+
+STATS_PROMPT = prompts.register("stats", """
+    You are an expert in creating character stats for a role-playing game. The stats should align with the character's race, role, and description. The stat values can range from 0 to 100,000, allowing for unlimited growth. Do not be generous with stat points. Stat points above 10,000 are overpowered in this universe
+
+    For every character given by the user, generate a dictionary with the following attributes:
+    "strength": , "defense": , "agility": , "intelligence":, "magic":, "health":
+
+    Output only a dictionary mapping each character's name to its stats, nothing else. Examples:
+    { "Name": { "strength": number, "defense": number, "agility": number, "intelligence": number, "magic": number, "health": number } }
+
+    plain output below
+""", """
+    {history_context}Character Details:
+    {character_details}
+""")
+
 
 class StatsGenerator:
-    def __init__(self, db_name, collection_name):
-        self.client = MongoClient(MONGO_URI)
-        self.db = self.client[db_name]
+    def __init__(self, db_name, collection_name, client=None, db=None, batch_size=5, llm_client=None,
+                 claim_lease=None, max_attempts=None):
+        """
+        Initialize the StatsGenerator.
+
+        Args:
+            db_name (str): The name of the MongoDB database.
+            collection_name (str): The name of the MongoDB collection storing conversations.
+            client (MongoClient, optional): A client to use instead of the shared pooled client.
+            db (Database, optional): A database to use instead of opening one from the client.
+            batch_size (int): The characters sent to the language model per request.
+            llm_client (LLMBackend, optional): The language model backend. Defaults to the shared backend.
+            claim_lease (float, optional): The seconds after which a claim left by a crashed process is taken
+                back. Defaults to STATS_CLAIM_LEASE or 300.
+            max_attempts (int, optional): The claims after which a character is given up on. Defaults to
+                STATS_MAX_ATTEMPTS or 3.
+        """
+        self.db = resolve_database(db_name, client, db)
+        self.llm_client = llm_client or get_llm_client()
+        self.client = self.db.client
         self.characters_collection = self.db[f"characters_{collection_name}"]
         self.stats_collection = self.db[f"stats_{collection_name}"]
+        self.batch_size = batch_size
+        self.claim_lease = timedelta(seconds=float(claim_lease or env("STATS_CLAIM_LEASE", 300)))
+        self.max_attempts = max_attempts or int(env("STATS_MAX_ATTEMPTS", 3))
+        self._pending_flags_backfilled = False
 
-    def _generate_stats_prompt(self, character_data, history=None):
+    def _generate_stats_prompt(self, character_datas, history=None):
         """
-        Generate a prompt for creating character stats with both historical context and benchmark examples.
+        Generate the messages for creating the stats of several characters at once. The instructions and
+        output format come first and never change, while the historical context and the characters follow
+        in the user message.
 
         Args:
-            character_data (dict): Information about the character.
+            character_datas (list): Information about each character.
             history (list, optional): List of previously generated stats. Defaults to None.
 
         Returns:
-            str: The generated prompt.
+            list: The system and user messages.
         """
         # Create history context with merged stats and character data
         history_context = ""
         if history:
-            history_context = f"\nHere are some previously generated stats for reference:\n{json.dumps(history, indent=2)}\n"
-
-        # Build the prompt with the examples included
-        prompt = f"""
-        You are an expert in creating character stats for a role-playing game. The stats should align with the character's race, role, and description. The stat values can range from 0 to 100,000, allowing for unlimited growth. Do not be generous with stat points. Stat points above 10,000 are overpowered in this universe
+            history_context = f"Here are some previously generated stats for reference:\n{json.dumps(history, indent=2)}\n\n"
 
-        {history_context}
+        character_details = json.dumps([
+            {
+                "name": character_data["name"],
+                "alternate_names": character_data.get("alternate_names", []),
+                "race": character_data.get("race"),
+                "role": character_data.get("role"),
+                "owner": character_data.get("owner"),
+                "description": character_data.get("description")
+            }
+            for character_data in character_datas
+        ], indent=2)
 
-        Character Details:
-        Name: {character_data['name']}
-        Alternate Names: {character_data.get('alternate_names', [])}
-        Race: {character_data['race']}
-        Role: {character_data['role']}
-        Owner: {character_data.get('owner')}
-        Description: {character_data['description']}
+        return STATS_PROMPT.messages(history_context=history_context, character_details=character_details)
 
-        Generate a dictionary with the following attributes:
-        "strength": , "defense": , "agility": , "intelligence":, "magic":, "health":
+    def _get_stats_history(self, conversation_id):
+        """
+        Return the latest 3 stats of a conversation merged with their character details, used as reference
+        examples in the stats prompt. They are read from the conversation's cached window, which is loaded
+        with two indexed queries the first time.
 
-        Output only the dictionary, nothing else. Examples:
-        {{ "strength": number, "defense": number, "agility": number, "intelligence": number, "magic": number, "health": number }}
-        
-        
-        plain output below"""
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
 
-        return prompt
+        Returns:
+            list: The merged stats and character details, newest first.
+        """
+        return get_stats_history(self.stats_collection, self.characters_collection, conversation_id).entries()
 
+    def release(self, conversation_id):
+        """
+        Drop the cached stats history window of a conversation, once its session is no longer in memory.
 
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+        """
+        release_stats_history(self.stats_collection, conversation_id)
 
-    def generate_initial_stats(self, character_data):
+    def generate_stats_batch(self, character_datas):
         """
-        Generate initial stats for a character using a language model, taking into account the latest 3 existing stats.
+        Generate initial stats for several characters of the same conversation with a single language model
+        request, taking into account the latest 3 existing stats of that conversation.
         
         Args:
-            character_data (dict): Information about the character for which stats are to be generated.
+            character_datas (list): Information about the characters for which stats are to be generated.
         
         Returns:
-            dict: Generated stats for the character.
+            dict: Generated stats keyed by character name.
         """
-        # Fetch the latest 3 stats from the stats collection, sorted by creation time in descending order
-        previous_stats = list(
-            self.stats_collection.find({}, {"name": 1, "stats": 1, "_id": 0})
-            .sort("created_at", -1)  # Sort by 'created_at' in descending order
-            .limit(3)  # Limit to the latest 3 documents
-        )
-
-        # Fetch character details for the names in previous stats
-        character_names = [stat["name"] for stat in previous_stats]
-        character_details = list(
-            self.characters_collection.find({"name": {"$in": character_names}})
-        )
-
-        # Create a dictionary for quick lookup
-        character_details_dict = {character["name"]: character for character in character_details}
-
-        # Merge stats with character details
-        merged_data = []
-        for stat in previous_stats:
-            name = stat["name"]
-            character_info = character_details_dict.get(name, {})
-            merged_entry = {**stat, **character_info}  # Merge the two dictionaries
-            # Remove '_id' and 'timestamp' if present
-            merged_entry.pop("_id", None)
-            merged_entry.pop("timestamp", None)
-            merged_data.append(merged_entry)
-
+        merged_data = self._get_stats_history(character_datas[0]["conversation_id"])
         
         # Generate a prompt using character data and merged history
-        prompt = self._generate_stats_prompt(character_data, history=merged_data)
+        messages = self._generate_stats_prompt(character_datas, history=merged_data)
 
         # Request completion from the LLM
-        completion = llm_client.chat.completions.create(
+        params = dict(
             model="gemma2-9b-it",
-            messages=[{"role": "system", "content": prompt}],
+            messages=messages,
             temperature=0.7,
             max_tokens=1024,
             top_p=1,
             stream=True
         )
+        completion = self.llm_client.chat.completions.create(**params)
 
-        # Initialize an empty string to collect the streamed response
-        stats_data = ""
+        # Parse the streamed response as a dictionary keyed by name
+        try:
+            return parse_json_stream(completion_text(completion))
+        except ValueError:
+            discard_cached(self.llm_client, params)
+            raise
 
-        # Iterate over the streamed completion response and build the stats data
-        for chunk in completion:
-            stats_data += chunk.choices[0].delta.content or ""
+    def generate_initial_stats(self, character_data):
+        """
+        Generate initial stats for a single character.
+        
+        Args:
+            character_data (dict): Information about the character for which stats are to be generated.
+        
+        Returns:
+            dict: Generated stats for the character.
+        """
+        stats_by_name = self.generate_stats_batch([character_data])
+        stats = stats_by_name.get(character_data["name"]) if isinstance(stats_by_name, dict) else None
+        return stats if isinstance(stats, dict) else None
+
+    def _backfill_pending_flags(self):
+        """
+        Mark characters created before the stats_pending flag existed, once per process: pending if they have
+        no stats yet, done otherwise.
+        """
+        if self._pending_flags_backfilled:
+            return
+        operations = []
+        for character in self.characters_collection.find(
+            {"stats_pending": {"$exists": False}}, {"name": 1, "conversation_id": 1}
+        ):
+            has_stats = self.stats_collection.find_one(
+                {"conversation_id": character.get("conversation_id"), "name": character["name"]}, {"_id": 1}
+            ) is not None
+            operations.append(UpdateOne({"_id": character["_id"]}, {"$set": {"stats_pending": not has_stats}}))
+        if operations:
+            self.characters_collection.bulk_write(operations, ordered=False)
+        self._pending_flags_backfilled = True
 
-        print(stats_data)
-        # Return the generated stats as a dictionary
-        return json.loads(stats_data)
+    def _pending_update(self, character, done):
+        """
+        Return the update that releases a claimed character: done, back to pending, or given up on once it
+        has been claimed max_attempts times.
+        """
+        if done:
+            return {"$set": {"stats_pending": False}, "$unset": {"stats_claimed_at": ""}}
+        if character.get("stats_attempts", 0) >= self.max_attempts:
+            return {"$set": {"stats_pending": False, "stats_failed": True}, "$unset": {"stats_claimed_at": ""}}
+        return {"$set": {"stats_pending": True}, "$unset": {"stats_claimed_at": ""}}
 
-    def check_for_new_characters(self):
+    def _reclaim_expired_claims(self, scope):
         """
-        Check for new characters that don't have stats generated yet and generate stats for them.
+        Release the claims whose lease expired, left behind by a process that crashed or failed to store its
+        results. Characters whose stats were stored before the failure are marked done.
         """
-        # Find characters whose names are not in the stats collection
-        new_characters = self.characters_collection.find({
-            "name": {"$nin": self.stats_collection.distinct("name")}
-        })
+        expired = list(self.characters_collection.find(
+            {**scope, "stats_pending": {"$type": "string"},
+             "stats_claimed_at": {"$lt": datetime.utcnow() - self.claim_lease}},
+            {"name": 1, "conversation_id": 1, "stats_attempts": 1}
+        ))
+        operations = []
+        for character in expired:
+            has_stats = self.stats_collection.find_one(
+                {"conversation_id": character.get("conversation_id"), "name": character["name"]}, {"_id": 1}
+            ) is not None
+            operations.append(UpdateOne({"_id": character["_id"]}, self._pending_update(character, has_stats)))
+        if operations:
+            self.characters_collection.bulk_write(operations, ordered=False)
 
-        
+    def check_for_new_characters(self, conversation_id=None):
+        """
+        Generate stats for characters still marked stats_pending. Pending characters are claimed atomically, so
+        concurrent calls never process the same character twice, and are sent to the language model in batches.
+        A claim is a lease: one not released within claim_lease is taken back. A character is given up on, and
+        flagged stats_failed, after max_attempts claims.
 
-        # Iterate over each new character and generate their initial stats
-        for character in new_characters:
-            stats = self.generate_initial_stats(character)
-            # Insert the generated stats into the stats collection
-            self.stats_collection.insert_one({
-                "name": character["name"],
-                "conversation_id": character["conversation_id"],
-                "stats": stats,
-                "created_at": datetime.utcnow()
-        })
+        Args:
+            conversation_id (str, optional): Only process characters of this conversation. Defaults to all.
+        """
+        self._backfill_pending_flags()
+
+        scope = {} if conversation_id is None else {"conversation_id": conversation_id}
+        self._reclaim_expired_claims(scope)
+
+        claim = uuid.uuid4().hex
+        result = self.characters_collection.update_many(
+            {**scope, "stats_pending": True},
+            {"$set": {"stats_pending": claim, "stats_claimed_at": datetime.utcnow()}, "$inc": {"stats_attempts": 1}}
+        )
+        if result.modified_count == 0:
+            return
+
+        claimed = self.characters_collection.find({"stats_pending": claim})
+        by_conversation = {}
+        for character in claimed:
+            by_conversation.setdefault(character["conversation_id"], []).append(character)
+
+        for characters in by_conversation.values():
+            for start in range(0, len(characters), self.batch_size):
+                self._generate_and_store_stats(characters[start:start + self.batch_size])
+
+    @traced("stats.generate")
+    def _generate_and_store_stats(self, characters):
+        """
+        Generate the stats of a batch of claimed characters and store them. Characters the model left out or
+        gave stats that are not an object, or the whole batch if anything else fails, are released back to
+        pending until they run out of attempts.
+
+        Args:
+            characters (list): The claimed character documents, all from the same conversation.
+        """
+        done_ids = []
+        try:
+            stats_by_name = self.generate_stats_batch(characters)
+            if not isinstance(stats_by_name, dict):
+                # Valid JSON of the wrong shape, such as a list: no character got stats
+                stats_by_name = {}
+
+            created_at = datetime.utcnow()
+            stats_documents = []
+            generated = {}
+            for character in characters:
+                stats = stats_by_name.get(character["name"])
+                if not isinstance(stats, dict):
+                    continue
+                stats_documents.append({
+                    "name": character["name"],
+                    "conversation_id": character["conversation_id"],
+                    "stats": stats,
+                    "created_at": created_at
+                })
+                generated[character["_id"]] = stats
+
+            if stats_documents:
+                # Insert the generated stats into the stats collection
+                self.stats_collection.insert_many(stats_documents)
+                done_ids = list(generated)
+                # Keep the conversation's reference examples current without reading them back
+                history = get_stats_history(self.stats_collection, self.characters_collection,
+                                            characters[0]["conversation_id"])
+                for character in characters:
+                    if character["_id"] in generated:
+                        history.add(character, generated[character["_id"]])
+        except Exception:
+            self._release(characters, done_ids)
+            raise
+        # If this write fails, the claims expire and the characters with stored stats are marked done then
+        self._release(characters, done_ids)
+
+    def _release(self, characters, done_ids):
+        """
+        Release a batch of claimed characters with a single bulk write.
+        """
+        self.characters_collection.bulk_write([
+            UpdateOne({"_id": character["_id"]}, self._pending_update(character, character["_id"] in done_ids))
+            for character in characters
+        ], ordered=False)
 
 
 # Example usage
@@ -0,0 +1,270 @@
+from datetime import datetime
+
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+from utils.settings import env
+
+# Each level rolls a run of entries of the level below it into one
+LEVELS = ("chapter", "arc", "campaign")
+
+
+class SummaryConflict(Exception):
+    """
+    Raised when the summary head of a conversation was moved by another writer since it was read.
+    """
+
+
+def _entry(version, summary_text, first_message_index, last_message_index):
+    return {
+        "version": version,
+        "summary": summary_text,
+        "first_message_index": first_message_index,
+        "last_message_index": last_message_index,
+    }
+
+
+def empty_head(conversation_id):
+    """
+    Return the head of a conversation that has not been summarized yet.
+    """
+    return {"conversation_id": conversation_id, "version": 0, "last_message_index": None,
+            "campaign": None, "arcs": [], "chapters": []}
+
+
+def summary_context(head):
+    """
+    Join the summaries a head points to, oldest first: the campaign, then the arcs and chapters not yet
+    rolled up into it.
+
+    Args:
+        head (dict): The summary head of a conversation.
+
+    Returns:
+        str: The summary of the story so far, or None if there is none.
+    """
+    entries = ([head["campaign"]] if head["campaign"] else []) + head["arcs"] + head["chapters"]
+    return "\n\n".join(entry["summary"] for entry in entries) or None
+
+
+class SummaryStore:
+    """
+    Versioned, hierarchical summaries of each conversation. Every summary is stored as a version, with the
+    level and message range it covers. Chapters summarize consecutive runs of messages. Once enough chapters
+    accumulate they are rolled up into an arc, and enough arcs are folded into the campaign summary, so the
+    summary of a long campaign stays bounded in size.
+
+    A head document per conversation points to the current campaign summary and to the arcs and chapters
+    not rolled up yet, so the latest summary is a single indexed read. The head moves with a compare-and-set
+    on its version, so concurrent writers cannot lose a summary, and the writer that moved it owns the
+    version number.
+    """
+
+    def __init__(self, summary_collection, heads_collection, chapters_per_arc=None, arcs_per_campaign=None):
+        """
+        Initialize the SummaryStore.
+
+        Args:
+            summary_collection (Collection): The collection storing summary versions.
+            heads_collection (Collection): The collection storing one summary head per conversation.
+            chapters_per_arc (int, optional): The chapters rolled up into an arc. Defaults to
+                SUMMARY_CHAPTERS_PER_ARC or 4.
+            arcs_per_campaign (int, optional): The arcs folded into the campaign summary. Defaults to
+                SUMMARY_ARCS_PER_CAMPAIGN or 3.
+        """
+        self.summary_collection = summary_collection
+        self.heads_collection = heads_collection
+        self.chapters_per_arc = chapters_per_arc or int(env("SUMMARY_CHAPTERS_PER_ARC", 4))
+        self.arcs_per_campaign = arcs_per_campaign or int(env("SUMMARY_ARCS_PER_CAMPAIGN", 3))
+
+    def head(self, conversation_id):
+        """
+        Return the summary head of a conversation. A conversation summarized before heads existed starts
+        from its most recent summary, treated as the campaign summary.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+
+        Returns:
+            dict: The head, with version 0 if it has not been written yet.
+        """
+        head = self.heads_collection.find_one({"conversation_id": conversation_id}, {"_id": 0})
+        if head is not None:
+            return head
+
+        head = empty_head(conversation_id)
+        legacy = self.summary_collection.find_one(
+            {"conversation_id": conversation_id, "version": {"$exists": False}},
+            sort=[("timestamp", DESCENDING)]
+        )
+        if legacy is not None:
+            head["campaign"] = _entry(0, legacy["summary"], legacy.get("first_message_index"),
+                                      legacy.get("last_message_index"))
+            head["last_message_index"] = legacy.get("last_message_index")
+        return head
+
+    def pending_rollup(self, head):
+        """
+        Return the roll-up a head is due for, if any.
+
+        Args:
+            head (dict): The summary head of a conversation.
+
+        Returns:
+            tuple: The level to write, "arc" or "campaign", and the entries it replaces, or None.
+        """
+        if len(head["chapters"]) >= self.chapters_per_arc:
+            return "arc", head["chapters"]
+        if len(head["arcs"]) >= self.arcs_per_campaign:
+            return "campaign", head["arcs"]
+        return None
+
+    def _advance(self, head, level, entry, now):
+        """
+        Return the head moved to a new entry. An arc replaces the chapters and the campaign summary replaces
+        the arcs.
+        """
+        new_head = {**head, "version": entry["version"], "updated_at": now}
+        if level == "chapter":
+            new_head["chapters"] = head["chapters"] + [entry]
+        elif level == "arc":
+            new_head["chapters"] = []
+            new_head["arcs"] = head["arcs"] + [entry]
+        else:
+            new_head["arcs"] = []
+            new_head["campaign"] = entry
+        if entry["last_message_index"] is not None:
+            new_head["last_message_index"] = max(entry["last_message_index"], head["last_message_index"] or -1)
+        return new_head
+
+    def _move_head(self, head, new_head):
+        """
+        Replace the head with a compare-and-set on its version.
+
+        Raises:
+            SummaryConflict: If the head was moved since it was read.
+        """
+        conversation_id = head["conversation_id"]
+        if head["version"] == 0:
+            try:
+                self.heads_collection.insert_one(dict(new_head))
+            except DuplicateKeyError:
+                raise SummaryConflict(f"The summary head of {conversation_id} was already written")
+        else:
+            result = self.heads_collection.replace_one(
+                {"conversation_id": conversation_id, "version": head["version"]}, new_head
+            )
+            if result.matched_count == 0:
+                raise SummaryConflict(f"The summary head of {conversation_id} moved past version {head['version']}")
+
+    def _write_version(self, head, level, entry, now):
+        """
+        Write the version document of an entry the head was moved to. The head owns the version number, so
+        the write is an upsert that replaces a version left behind by an interrupted writer.
+        """
+        rolled_up = {"arc": head["chapters"], "campaign": head["arcs"]}.get(level, [])
+        self.summary_collection.update_one(
+            {"conversation_id": head["conversation_id"], "version": entry["version"]},
+            {"$set": {
+                "level": level,
+                **entry,
+                "rolled_up_versions": [rolled["version"] for rolled in rolled_up],
+                "timestamp": now
+            }},
+            upsert=True
+        )
+
+    def append(self, head, level, summary_text, first_message_index, last_message_index):
+        """
+        Move the head to a new summary and store it as a version. An arc replaces the chapters in the head and
+        the campaign summary replaces the arcs.
+
+        The head is written first, since it holds the summaries the prompt uses. If the version write is
+        interrupted, repair() writes it again from the head.
+
+        Args:
+            head (dict): The head the summary was written from.
+            level (str): "chapter", "arc" or "campaign".
+            summary_text (str): The summary.
+            first_message_index (int): The index of the first message the summary covers.
+            last_message_index (int): The index of the last message the summary covers.
+
+        Returns:
+            dict: The new head.
+
+        Raises:
+            SummaryConflict: If the head was moved since it was read.
+        """
+        if level not in LEVELS:
+            raise ValueError(f"Unknown summary level: {level}")
+        now = datetime.utcnow()
+        entry = _entry(head["version"] + 1, summary_text, first_message_index, last_message_index)
+        new_head = self._advance(head, level, entry, now)
+        self._move_head(head, new_head)
+        self._write_version(head, level, entry, now)
+        return new_head
+
+    def repair(self, conversation_id):
+        """
+        Bring the head and the versions of a conversation back in line after an interrupted write. Versions
+        above the head that follow on from it, as written before the head was moved, move the head forward.
+        Versions that do not are deleted. Entries of the head without a version document are written again.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+
+        Returns:
+            dict: The repaired head.
+        """
+        head = self.head(conversation_id)
+        orphans = self.summary_collection.find(
+            {"conversation_id": conversation_id, "version": {"$gt": head["version"]}}
+        ).sort("version", 1)
+        for orphan in orphans:
+            rolled_up = {"arc": head["chapters"], "campaign": head["arcs"]}.get(orphan.get("level"), [])
+            follows_on = (
+                orphan["version"] == head["version"] + 1
+                and orphan.get("level") in LEVELS
+                and orphan.get("rolled_up_versions", []) == [rolled["version"] for rolled in rolled_up]
+            )
+            if not follows_on:
+                self.summary_collection.delete_many(
+                    {"conversation_id": conversation_id, "version": {"$gte": orphan["version"]}}
+                )
+                break
+            entry = _entry(orphan["version"], orphan["summary"], orphan.get("first_message_index"),
+                           orphan.get("last_message_index"))
+            new_head = self._advance(head, orphan["level"], entry, datetime.utcnow())
+            self._move_head(head, new_head)
+            head = new_head
+
+        entries = ([("campaign", head["campaign"])] if head["campaign"] else []) + \
+            [("arc", entry) for entry in head["arcs"]] + [("chapter", entry) for entry in head["chapters"]]
+        stored = {version["version"] for version in self.summary_collection.find(
+            {"conversation_id": conversation_id, "version": {"$in": [entry["version"] for _, entry in entries]}},
+            {"version": 1}
+        )}
+        for level, entry in entries:
+            if entry["version"] and entry["version"] not in stored:
+                self.summary_collection.update_one(
+                    {"conversation_id": conversation_id, "version": entry["version"]},
+                    {"$set": {"level": level, **entry, "timestamp": datetime.utcnow()}},
+                    upsert=True
+                )
+        return head
+
+    def versions(self, conversation_id, level=None):
+        """
+        Return the summary versions of a conversation, newest first.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            level (str, optional): Only return versions of this level.
+
+        Returns:
+            list: The version documents.
+        """
+        query = {"conversation_id": conversation_id, "version": {"$exists": True}}
+        if level:
+            query["level"] = level
+        return list(self.summary_collection.find(query, {"_id": 0}).sort("version", DESCENDING))
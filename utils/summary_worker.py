@@ -0,0 +1,207 @@
+from datetime import datetime, timedelta
+import logging
+import queue
+import threading
+import uuid
+
+from pymongo import DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from utils.settings import env
+from utils.telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+
+class SummaryWorker:
+    """
+    Run summarization jobs on a background thread so the turn loop never waits on them.
+    Jobs are persisted in MongoDB, at most one job per conversation is pending at a time, and
+    pending jobs left over by a previous process are picked up again on start.
+
+    A claimed job records the worker that owns it and when its lease expires. Running jobs are only
+    requeued once their lease has expired, so workers of other processes sharing the collection keep
+    their jobs. Use get_summary_worker() to share one worker per jobs collection within a process.
+    """
+
+    def __init__(self, jobs_collection, summarize, lease=None):
+        """
+        Initialize the SummaryWorker.
+
+        Args:
+            jobs_collection (Collection): The collection storing summary jobs.
+            summarize (callable): Called with (conversation_id, upto_index) to fold the messages before
+                upto_index into the conversation summary.
+            lease (int, optional): The seconds a claimed job belongs to this worker. Defaults to
+                SUMMARY_JOB_LEASE or 600.
+        """
+        self.jobs_collection = jobs_collection
+        self.summarize = summarize
+        self.lease = timedelta(seconds=lease or int(env("SUMMARY_JOB_LEASE", 600)))
+        self.owner = uuid.uuid4().hex
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._users = 0
+
+    def start(self):
+        """
+        Start the worker thread, queue the pending jobs and requeue the jobs whose lease has expired.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._requeue_expired()
+            for job in self.jobs_collection.find({"status": "pending"}, {"conversation_id": 1}):
+                self._queue.put(job["conversation_id"])
+            self._thread = threading.Thread(target=self._run, name="summary-worker", daemon=True)
+            self._thread.start()
+
+    def _requeue_expired(self):
+        """
+        Return running jobs whose lease has expired, or that were claimed before leases existed, to pending.
+        If the conversation already has a pending job, the expired job's range is folded into it.
+        """
+        now = datetime.utcnow()
+        expired = self.jobs_collection.find({"status": "running", "$or": [
+            {"lease_expires_at": {"$lt": now}},
+            {"lease_expires_at": {"$exists": False}}
+        ]})
+        for job in expired:
+            claim = {"_id": job["_id"], "status": "running", "lease_expires_at": job.get("lease_expires_at")}
+            try:
+                result = self.jobs_collection.update_one(claim, {
+                    "$set": {"status": "pending", "updated_at": now},
+                    "$unset": {"owner": "", "lease_expires_at": ""}
+                })
+            except DuplicateKeyError:
+                self.enqueue(job["conversation_id"], job["upto_index"])
+                self.jobs_collection.update_one(claim, {"$set": {
+                    "status": "failed", "error": "Lease expired", "updated_at": now
+                }})
+                continue
+            if result.modified_count:
+                self._queue.put(job["conversation_id"])
+
+    def enqueue(self, conversation_id, upto_index):
+        """
+        Request a summary covering the messages before upto_index. If a job for the conversation is already
+        pending, it is extended to cover the new messages instead of adding a duplicate job.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+            upto_index (int): The index after the last message the summary should cover.
+        """
+        now = datetime.utcnow()
+        result = self.jobs_collection.update_one(
+            {"conversation_id": conversation_id, "status": "pending"},
+            {
+                "$max": {"upto_index": upto_index},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"created_at": now}
+            },
+            upsert=True
+        )
+        if result.upserted_id is not None:
+            self._queue.put(conversation_id)
+
+    def job_status(self, conversation_id):
+        """
+        Return the most recent summary job of a conversation.
+
+        Args:
+            conversation_id (str): The unique identifier for the conversation.
+
+        Returns:
+            dict: The job's status, message range and timestamps, or None if there is no job.
+        """
+        return self.jobs_collection.find_one(
+            {"conversation_id": conversation_id},
+            {"_id": 0},
+            sort=[("updated_at", DESCENDING)]
+        )
+
+    def _run(self):
+        """
+        Process queued jobs until a stop sentinel is received.
+        """
+        while True:
+            try:
+                conversation_id = self._queue.get(timeout=self.lease.total_seconds())
+            except queue.Empty:
+                # Pick up the jobs of workers that stopped while this one was idle
+                self._requeue_expired()
+                continue
+            if conversation_id is None:
+                return
+            now = datetime.utcnow()
+            job = self.jobs_collection.find_one_and_update(
+                {"conversation_id": conversation_id, "status": "pending"},
+                {"$set": {"status": "running", "started_at": now, "owner": self.owner,
+                          "lease_expires_at": now + self.lease}},
+                return_document=ReturnDocument.AFTER
+            )
+            if job is None:
+                continue
+            try:
+                self.summarize(conversation_id, job["upto_index"])
+                update = {"status": "done"}
+            except Exception as error:
+                telemetry.increment("summary_job_failures_total")
+                logger.error("Summary of %s failed: %r", conversation_id, error, exc_info=error)
+                update = {"status": "failed", "error": repr(error)}
+            update["updated_at"] = datetime.utcnow()
+            # A job whose lease expired may have been requeued, and then belongs to its new owner
+            self.jobs_collection.update_one({"_id": job["_id"], "owner": self.owner}, {
+                "$set": update,
+                "$unset": {"lease_expires_at": ""}
+            })
+
+    def close(self, wait=True):
+        """
+        Stop the worker thread once the queued jobs are done. Jobs still pending stay persisted. A worker
+        shared through get_summary_worker() only stops once every user has closed it.
+
+        Args:
+            wait (bool): If True, block until the worker thread exits.
+        """
+        with _workers_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            self._users = 0
+            if _workers.get(self.jobs_collection.full_name) is self:
+                del _workers[self.jobs_collection.full_name]
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(None)
+        if wait:
+            thread.join()
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def get_summary_worker(jobs_collection, summarize):
+    """
+    Return the summary worker of a jobs collection, started on first use, so a process runs one worker per
+    collection however many conversation managers it creates. Each caller closes it once.
+
+    Args:
+        jobs_collection (Collection): The collection storing summary jobs.
+        summarize (callable): Called with (conversation_id, upto_index). Only the first caller's is used.
+
+    Returns:
+        SummaryWorker: The shared, started worker.
+    """
+    with _workers_lock:
+        worker = _workers.get(jobs_collection.full_name)
+        if worker is None:
+            worker = SummaryWorker(jobs_collection, summarize)
+            _workers[jobs_collection.full_name] = worker
+        worker._users += 1
+    worker.start()
+    return worker
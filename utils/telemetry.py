@@ -0,0 +1,458 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+import bson
+from pymongo import monitoring
+
+from utils.context_builder import estimate_tokens
+from utils.llm_backend import LLMBackend
+from utils.settings import env
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _NullSpan:
+    """
+    The span handed out while telemetry is disabled. Entering and leaving it does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    A timed operation. Spans started on the same thread nest, and share the trace id of the outermost span.
+    """
+
+    def __init__(self, telemetry, name, attributes, parent=None):
+        self.telemetry = telemetry
+        self.name = name
+        self.attributes = attributes
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.start = time.time()
+        self.duration = None
+        self._started = None
+
+    def set(self, **attributes):
+        """
+        Add attributes to the span, such as token counts known only once the operation ends.
+        """
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        parent = self.telemetry.parent_span()
+        if parent is not None:
+            self.parent_id = parent.span_id
+            self.trace_id = parent.trace_id
+        self.telemetry._stack().append(self)
+        self.start = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._started
+        stack = self.telemetry._stack()
+        if self in stack:
+            stack.remove(self)
+        if exc_type is not None:
+            self.attributes["error"] = repr(exc_value)
+        self.telemetry._finish(self)
+        return False
+
+
+class Telemetry:
+    """
+    Collect timing spans, counters and histograms for the turn pipeline, and export them as Prometheus text
+    and JSON-lines traces. While disabled, every call returns immediately.
+    """
+
+    def __init__(self, enabled=False, trace_path=None, metrics_path=None, buckets=DEFAULT_BUCKETS):
+        """
+        Initialize the Telemetry.
+
+        Args:
+            enabled (bool): Whether spans and metrics are recorded.
+            trace_path (str, optional): The JSON-lines file finished spans are appended to. No traces if not given.
+            metrics_path (str, optional): The file the Prometheus metrics are written to on close.
+            buckets (tuple): The upper bounds of the histogram buckets, in seconds.
+        """
+        self.enabled = enabled
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._stats_sources = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._trace_file = None
+
+    @classmethod
+    def from_env(cls):
+        """
+        Create the telemetry configured by TELEMETRY, TELEMETRY_TRACE_PATH and TELEMETRY_METRICS_PATH.
+        """
+        return cls(
+            enabled=env("TELEMETRY", "0") == "1",
+            trace_path=env("TELEMETRY_TRACE_PATH", "telemetry/traces.jsonl") or None,
+            metrics_path=env("TELEMETRY_METRICS_PATH", "telemetry/metrics.prom") or None,
+        )
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def parent_span(self):
+        """
+        Return the span new spans on the calling thread are children of: the innermost open span, or the span
+        a bound function was submitted from. None if there is neither.
+        """
+        stack = self._stack()
+        return stack[-1] if stack else getattr(self._local, "inherited", None)
+
+    def span(self, name, **attributes):
+        """
+        Return a context manager timing an operation.
+
+        Args:
+            name (str): The span name, such as "mongo.find" or "llm.chat".
+            **attributes: Attributes recorded with the span.
+
+        Returns:
+            Span: The span, or a no-op span while disabled.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, attributes)
+
+    def record_span(self, name, duration, start=None, parent=None, **attributes):
+        """
+        Record an operation that has already finished.
+
+        Args:
+            name (str): The span name.
+            duration (float): The duration in seconds.
+            start (float, optional): The wall-clock start time. Defaults to now minus the duration.
+            parent (Span, optional): The parent span. Defaults to the calling thread's open span.
+            **attributes: Attributes recorded with the span.
+        """
+        if not self.enabled:
+            return
+        span = Span(self, name, attributes, parent=parent or self.parent_span())
+        span.duration = duration
+        span.start = start if start is not None else time.time() - duration
+        self._finish(span)
+
+    def bind(self, fn):
+        """
+        Wrap a function about to run on another thread so its spans join the trace of the current span.
+        """
+        parent = self.parent_span() if self.enabled else None
+        if parent is None:
+            return fn
+
+        def bound(*args, **kwargs):
+            previous = getattr(self._local, "inherited", None)
+            self._local.inherited = parent
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.inherited = previous
+        return bound
+
+    def _finish(self, span):
+        """
+        Record the duration of a finished span and append it to the trace file.
+        """
+        self.observe("span_duration_seconds", span.duration, span=span.name)
+        if not self.trace_path:
+            return
+        record = {
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "name": span.name,
+            "start": span.start,
+            "duration_ms": span.duration * 1000,
+            "thread": threading.current_thread().name,
+            "attributes": span.attributes,
+        }
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            if self._trace_file is None:
+                directory = os.path.dirname(self.trace_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._trace_file = open(self.trace_path, "a", encoding="utf-8")
+            self._trace_file.write(line)
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add to a counter.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Add an observation, in seconds, to a histogram.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][position] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def register_stats(self, prefix, stats, label=None):
+        """
+        Export the counters of a component's stats() method as gauges, read when the metrics are rendered.
+
+        Args:
+            prefix (str): The prefix of the gauge names, such as "llm_cache".
+            stats (callable): Returns a dict of numbers, or of dicts of numbers keyed by the label value.
+            label (str, optional): The label name used for nested dicts.
+        """
+        with self._lock:
+            self._stats_sources.append((prefix, stats, label))
+
+    def render_prometheus(self):
+        """
+        Render every counter, histogram and registered stats gauge in the Prometheus text format.
+
+        Returns:
+            str: The metrics.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+                          for key, value in self._histograms.items()}
+            stats_sources = list(self._stats_sources)
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+        gauges = {}
+        for prefix, stats, label in stats_sources:
+            for key, value in stats().items():
+                if isinstance(value, dict) and label:
+                    for inner_key, inner_value in value.items():
+                        gauges.setdefault(f"{prefix}_{inner_key}", []).append((((label, key),), inner_value))
+                elif isinstance(value, (int, float)):
+                    gauges.setdefault(f"{prefix}_{key}", []).append(((), value))
+        for name in sorted(gauges):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in gauges[name]:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path=None):
+        """
+        Write the Prometheus metrics to a file, for the node exporter's textfile collector or a later scrape.
+
+        Args:
+            path (str, optional): The file to write. Defaults to the configured metrics path.
+        """
+        path = path or self.metrics_path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(self.render_prometheus())
+
+    def command_listener(self):
+        """
+        Return a pymongo command listener that records a span for every database command.
+        """
+        return MongoCommandTracer(self)
+
+    def close(self):
+        """
+        Flush the trace file and write the metrics file.
+        """
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+        if self.enabled and self.metrics_path:
+            self.write_metrics()
+
+
+def traced(name):
+    """
+    Decorate a function so each call is recorded as a span of the shared telemetry.
+
+    Args:
+        name (str): The span name.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not telemetry.enabled:
+                return fn(*args, **kwargs)
+            with telemetry.span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _format_labels(labels):
+    """
+    Format label pairs as a Prometheus label set, escaping backslashes, quotes and newlines.
+    """
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class MongoCommandTracer(monitoring.CommandListener):
+    """
+    Record a span, a duration and the reply size of every MongoDB command. pymongo calls listeners on the
+    thread that runs the command, so command spans nest under the operation that issued them.
+    """
+
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, failed=False)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+    def _record(self, event, failed):
+        if not self.telemetry.enabled:
+            return
+        duration = event.duration_micros / 1e6
+        attributes = {"database": event.database_name}
+        if failed:
+            attributes["error"] = str(event.failure)
+            self.telemetry.increment("mongo_command_failures_total", command=event.command_name)
+        else:
+            reply_bytes = len(bson.encode(event.reply))
+            attributes["reply_bytes"] = reply_bytes
+            self.telemetry.increment("mongo_reply_bytes_total", reply_bytes, command=event.command_name)
+        self.telemetry.increment("mongo_commands_total", command=event.command_name)
+        self.telemetry.record_span(f"mongo.{event.command_name}", duration, **attributes)
+
+
+class TracedLLMClient(LLMBackend):
+    """
+    Wrap a language model client to record a span per request, with time to first token and estimated
+    tokens in and out per model.
+    """
+
+    def __init__(self, client, telemetry):
+        """
+        Initialize the TracedLLMClient.
+
+        Args:
+            client (obj): The language model client to wrap.
+            telemetry (Telemetry): Where spans and metrics are recorded.
+        """
+        super().__init__()
+        self.client = client
+        self.telemetry = telemetry
+
+    def create(self, **params):
+        if not self.telemetry.enabled:
+            return self.client.chat.completions.create(**params)
+
+        model = params.get("model", "unknown")
+        tokens_in = sum(estimate_tokens(message.get("content")) for message in params.get("messages", []))
+        self.telemetry.increment("llm_requests_total", model=model)
+        self.telemetry.increment("llm_tokens_in_total", tokens_in, model=model)
+
+        if params.get("stream"):
+            start = time.time()
+            started = time.perf_counter()
+            completion = self.client.chat.completions.create(**params)
+            return self._trace_stream(completion, model, tokens_in, start, started, self.telemetry.parent_span())
+
+        with self.telemetry.span("llm.chat", model=model, tokens_in=tokens_in) as span:
+            completion = self.client.chat.completions.create(**params)
+            tokens_out = estimate_tokens(completion.choices[0].message.content)
+            span.set(tokens_out=tokens_out)
+        self.telemetry.increment("llm_tokens_out_total", tokens_out, model=model)
+        self.telemetry.observe("llm_request_duration_seconds", span.duration, model=model)
+        return completion
+
+    def _trace_stream(self, completion, model, tokens_in, start, started, parent):
+        """
+        Pass the chunks of a stream through, recording the time to first token and, once the stream ends,
+        a span for the whole request.
+        """
+        output_parts = []
+        first_token = None
+        try:
+            for chunk in completion:
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                    self.telemetry.observe("llm_time_to_first_token_seconds", first_token, model=model)
+                output_parts.append(chunk.choices[0].delta.content or "")
+                yield chunk
+        finally:
+            duration = time.perf_counter() - started
+            tokens_out = estimate_tokens("".join(output_parts))
+            self.telemetry.increment("llm_tokens_out_total", tokens_out, model=model)
+            self.telemetry.observe("llm_request_duration_seconds", duration, model=model)
+            # The stream is consumed between yields, so the span is recorded under the span that started it
+            self.telemetry.record_span(
+                "llm.chat", duration, start=start, parent=parent, model=model, stream=True, tokens_in=tokens_in,
+                tokens_out=tokens_out, ttft_ms=first_token * 1000 if first_token is not None else None,
+            )
+
+
+telemetry = Telemetry.from_env()
+atexit.register(telemetry.close)
@@ -0,0 +1,226 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import threading
+
+from utils import json_stream
+from utils.prompt_templates import prompts
+from utils.settings import env
+from utils.telemetry import telemetry, traced
+from utils.world_extractor import WorldStateExtractor
+
+telemetry.register_stats("json_stream", json_stream.shared_stats.stats)
+telemetry.register_stats("prompt", prompts.stats, label="prompt")
+
+logger = logging.getLogger(__name__)
+
+
+class TurnPipeline:
+    """
+    Run a game turn: the narrative reply is generated and stored in the foreground, while environment,
+    character and stats extraction run in the background on the same assistant message.
+    """
+
+    def __init__(self, conversation_manager, environment_manager, character_manager, stats_agent,
+                 conversation_id, llm_client, max_workers=4, extraction_mode=None, world_extractor=None, executor=None):
+        """
+        Initialize the TurnPipeline with the managers used on every turn.
+
+        Args:
+            conversation_manager (ConversationManager): Stores messages and generates replies.
+            environment_manager (EnvironmentManager): Extracts environments from the latest message.
+            character_manager (CharacterAgent): Extracts characters from the latest message.
+            stats_agent (StatsGenerator): Generates stats for newly inserted characters.
+            conversation_id (str): The unique identifier for the conversation.
+            llm_client (obj): The client object for interacting with the language model.
+            max_workers (int): The number of background worker threads.
+            extraction_mode (str, optional): "unified" to extract the environment and characters with one call,
+                or "separate" to call each manager's extractor. Defaults to EXTRACTION_MODE.
+            world_extractor (WorldStateExtractor, optional): The extractor used in unified mode.
+            executor (ThreadPoolExecutor, optional): An executor shared with other pipelines. It is not shut down
+                when this pipeline is closed. Defaults to a new executor with max_workers threads.
+        """
+        self.conversation_manager = conversation_manager
+        self.environment_manager = environment_manager
+        self.character_manager = character_manager
+        self.stats_agent = stats_agent
+        self.conversation_id = conversation_id
+        self.llm_client = llm_client
+        self.extraction_mode = extraction_mode or env("EXTRACTION_MODE", "unified")
+        self.world_extractor = world_extractor or WorldStateExtractor(llm_client=character_manager.llm_client)
+        self.extraction_fallbacks = 0
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="turn")
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def _submit(self, fn, *args, **kwargs):
+        """
+        Submit a background task and keep track of it so it can be joined later.
+        """
+        future = self.executor.submit(telemetry.bind(fn), *args, **kwargs)
+        with self._lock:
+            self._pending.append(future)
+        return future
+
+    def _on_characters_inserted(self, characters):
+        """
+        Start stats generation as soon as new characters have been inserted.
+        """
+        self._submit(self.stats_agent.check_for_new_characters, self.conversation_id)
+
+    def has_pending(self):
+        """
+        Return whether background extraction work is still running or queued.
+        """
+        with self._lock:
+            return any(not future.done() for future in self._pending)
+
+    def join(self):
+        """
+        Wait for all background extraction work, including stats jobs started while waiting.
+
+        Returns:
+            list: The exceptions raised by background tasks, if any.
+        """
+        errors = []
+        while True:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return errors
+            wait(pending)
+            errors.extend(error for error in (future.exception() for future in pending) if error)
+
+    def report_errors(self, errors):
+        """
+        Log the errors of background extraction and count them.
+        """
+        for error in errors:
+            telemetry.increment("background_errors_total")
+            logger.error("Background extraction failed for %s: %r", self.conversation_id, error, exc_info=error)
+
+    def stream_turn(self, user_input):
+        """
+        Run a turn: store the user message, stream the reply as it is generated, then start background
+        extraction once the reply is stored.
+
+        Args:
+            user_input (str): The content of the user's message.
+
+        Yields:
+            str: The next piece of the assistant's response.
+        """
+        # Extraction from the previous turn must finish before this turn touches the same data
+        self.report_errors(self.join())
+
+        with telemetry.span("turn", conversation_id=self.conversation_id):
+            self.conversation_manager.add_user_message(self.conversation_id, user_input)
+            response_parts = []
+            for delta in self.conversation_manager.stream_assistant_response(self.conversation_id, self.llm_client):
+                response_parts.append(delta)
+                yield delta
+            self._dispatch_extraction({"role": "assistant", "content": "".join(response_parts)})
+
+    def run_turn(self, user_input):
+        """
+        Run a turn: store the user message, generate and store the reply, then start background extraction.
+        Control returns as soon as the reply is stored.
+
+        Args:
+            user_input (str): The content of the user's message.
+
+        Returns:
+            str: The assistant's generated response.
+        """
+        return "".join(self.stream_turn(user_input))
+
+    def _dispatch_extraction(self, latest_message):
+        """
+        Extract the world state of the message, with one unified call or with the environment and character
+        extractors running in parallel.
+
+        Args:
+            latest_message (dict): The message to extract from.
+        """
+        if self.extraction_mode == "unified":
+            self._submit(self._extract_world_state, latest_message)
+        else:
+            self._dispatch_separate_extraction(latest_message)
+
+    @traced("extraction.world_state")
+    def _extract_world_state(self, latest_message):
+        """
+        Extract the location and characters with a single call and hand each part to its manager as it
+        streams in. Falls back to the separate extractors for the parts not stored if the result does not
+        validate.
+
+        Args:
+            latest_message (dict): The message to extract from.
+        """
+        if not self.character_manager.gate.should_extract("world_state", latest_message["content"], self._is_known_entity):
+            # Nothing new, but the story may have moved back to a known place
+            self.environment_manager.set_current_location(
+                self.environment_manager.known_mention(latest_message["content"])
+            )
+            return
+
+        # The place is stored and each character resolved as soon as the model has written it
+        characters = self.character_manager.batch()
+        location_stored = False
+        try:
+            for part, value in self.world_extractor.iter_extract(latest_message["content"]):
+                if part == "location":
+                    self.environment_manager.store_extracted_environment(value["name"] if value else False,
+                                                                         latest_message)
+                    location_stored = True
+                elif part == "character":
+                    characters.add(value)
+                else:
+                    characters.add_relationships(value)
+        except ValueError as error:
+            self.extraction_fallbacks += 1
+            telemetry.increment("extraction_fallbacks_total")
+            logger.warning("Unified extraction failed for %s, falling back to separate extractors: %s",
+                           self.conversation_id, error)
+            if not location_stored:
+                self._submit(self.environment_manager.process_latest_environment_description, latest_message)
+            self._submit(self.character_manager.process_latest_message_for_characters, latest_message,
+                         on_characters_inserted=self._on_characters_inserted)
+            return
+        characters.commit(on_characters_inserted=self._on_characters_inserted)
+
+    def _is_known_entity(self, name):
+        """
+        Check whether a name belongs to a stored character or environment.
+        """
+        return self.character_manager.is_known_character(name) or self.environment_manager.is_known_environment(name)
+
+    def _dispatch_separate_extraction(self, latest_message):
+        """
+        Run the environment and character extractors in parallel on the same message.
+
+        Args:
+            latest_message (dict): The message to extract from.
+        """
+        self._submit(self.environment_manager.process_latest_environment_description, latest_message)
+        self._submit(self.character_manager.process_latest_message_for_characters, latest_message,
+                     on_characters_inserted=self._on_characters_inserted)
+
+    def release(self):
+        """
+        Drop everything cached for this conversation by the managers and the shared registries. Called once
+        the pipeline is idle and its session is evicted.
+        """
+        self.conversation_manager.release(self.conversation_id)
+        self.environment_manager.release()
+        self.character_manager.release()
+        self.stats_agent.release(self.conversation_id)
+
+    def close(self):
+        """
+        Join any outstanding background work and shut the worker threads and summary worker down.
+        """
+        self.report_errors(self.join())
+        if self._owns_executor:
+            self.executor.shutdown(wait=True)
+        self.conversation_manager.close()
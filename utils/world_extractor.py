@@ -0,0 +1,222 @@
+from utils.settings import get_llm_client
+from utils.json_stream import StreamingJSONParser, completion_text
+from utils.llm_cache import discard_cached
+from utils.prompt_templates import prompts
+
+WORLD_STATE_PROMPT = prompts.register("world_state", """
+    You are an expert in understanding role-playing game narration. Given a text, extract the place it describes, the characters (people or animals) in it and the relationships between those characters.
+    Output only a single JSON object with the keys "location", "characters" and "relationships", nothing else.
+    "location" is an object with the name of the place, or null if the text does not describe a named place.
+    Every character has "name", "titles", "race", "role", "owner" and "description". Description is mandatory, short and sweet.
+    Every relationship has "source", "target" and "type".
+
+    Example 1:
+    Input: "The kingdom of Avalon was ruled by Queen Elaine, who had a fierce tiger named Rajah."
+    Output: {"location": {"name": "Avalon"},
+    "characters": [{"name": "Elaine", "titles": [], "race": "Human", "role": "Queen of Avalon", "owner": null, "description": "Ruler of the kingdom of Avalon."},
+    {"name": "Rajah", "titles": [], "race": "Tiger", "role": null, "owner": "Elaine", "description": "Elaine's fierce tiger."}],
+    "relationships": [{"source": "Rajah", "target": "Elaine", "type": "pet of"}]}
+
+    Example 2:
+    Input: "The Night Killer, The Archangel, Weilder of Susanoo, Sasonki, is the heavenly King of Eden."
+    Output: {"location": {"name": "Eden"},
+    "characters": [{"name": "Sasonki", "titles": ["The Night Killer", "The Archangel", "Weilder of Susanoo"], "race": "Angel", "role": "King of Eden", "owner": null, "description": "The heavenly King of Eden, known by many titles."}],
+    "relationships": []}
+
+    Example 3:
+    Input: "She walked through the bustling city streets, admiring the architecture."
+    Output: {"location": null, "characters": [], "relationships": []}
+""")
+
+
+def _optional_string(value, field):
+    if value is None or isinstance(value, str):
+        return value
+    raise ValueError(f"{field} must be a string or null")
+
+
+def _required_string(value, field):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"{field} must be a non-empty string")
+    return value.strip()
+
+
+def _validate_location(location):
+    if isinstance(location, str):
+        location = {"name": location}
+    if location is None:
+        return None
+    if not isinstance(location, dict):
+        raise ValueError("location must be an object or null")
+    location = {"name": _required_string(location.get("name"), "location.name")}
+    return None if location["name"].lower() == "false" else location
+
+
+def _validate_character(character, field):
+    if not isinstance(character, dict):
+        raise ValueError(f"{field} must be an object")
+    titles = character.get("titles") or []
+    if not isinstance(titles, list) or not all(isinstance(title, str) for title in titles):
+        raise ValueError(f"{field}.titles must be a list of strings")
+    return {
+        "name": _required_string(character.get("name"), f"{field}.name"),
+        "titles": titles,
+        "race": _optional_string(character.get("race"), f"{field}.race"),
+        "role": _optional_string(character.get("role"), f"{field}.role"),
+        "owner": _optional_string(character.get("owner"), f"{field}.owner"),
+        "description": _optional_string(character.get("description"), f"{field}.description"),
+    }
+
+
+def _validate_characters(characters):
+    characters = characters or []
+    if not isinstance(characters, list):
+        raise ValueError("characters must be a list")
+    return [_validate_character(character, f"characters[{position}]") for position, character in enumerate(characters)]
+
+
+def _validate_relationships(relationships):
+    relationships = relationships or []
+    if not isinstance(relationships, list):
+        raise ValueError("relationships must be a list")
+    validated_relationships = []
+    for position, relationship in enumerate(relationships):
+        field = f"relationships[{position}]"
+        if not isinstance(relationship, dict):
+            raise ValueError(f"{field} must be an object")
+        validated_relationships.append({
+            "source": _required_string(relationship.get("source"), f"{field}.source"),
+            "target": _required_string(relationship.get("target"), f"{field}.target"),
+            "type": _required_string(relationship.get("type"), f"{field}.type"),
+        })
+    return validated_relationships
+
+
+def validate_world_state(data):
+    """
+    Validate an extraction result and return it normalized, with unknown keys dropped. The location is an
+    object with a name, or null. Characters need a name and may have titles, a race, a role, an owner and a
+    description. Relationships need a source, a target and a type. Optional fields may be null or missing.
+
+    Args:
+        data (dict): The decoded model output.
+
+    Returns:
+        dict: The location (or None), characters and relationships.
+
+    Raises:
+        ValueError: If the result does not match the schema.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("world state must be an object")
+    return {
+        "location": _validate_location(data.get("location")),
+        "characters": _validate_characters(data.get("characters")),
+        "relationships": _validate_relationships(data.get("relationships")),
+    }
+
+
+class WorldStateExtractor:
+    """
+    Extract the location, characters and relationships of a message with a single language model call,
+    replacing the separate environment and character extraction calls.
+    """
+
+    def __init__(self, model="gemma2-9b-it", llm_client=None):
+        """
+        Initialize the WorldStateExtractor.
+
+        Args:
+            model (str): The language model used for extraction.
+            llm_client (LLMBackend, optional): The language model backend. Defaults to the shared backend.
+        """
+        self.model = model
+        self.llm_client = llm_client or get_llm_client()
+        self.calls = 0
+        self.invalid_results = 0
+
+    def iter_extract(self, message_content):
+        """
+        Stream the world state of a message as the model writes it. Each part is validated and yielded as soon
+        as it is complete: ("location", location), ("character", character) for every character, and
+        ("relationships", relationships). A location or relationships the model left out are yielded last,
+        empty.
+
+        Args:
+            message_content (str): The content of the message.
+
+        Yields:
+            tuple: The part and its validated value.
+
+        Raises:
+            ValueError: If the model output contains no JSON object or a part does not match the schema. The
+                parts yielded before it were valid.
+        """
+        self.calls += 1
+        params = dict(
+            model=self.model,
+            messages=WORLD_STATE_PROMPT.messages(input=message_content),
+            temperature=0.7,
+            max_tokens=1024,
+            top_p=1,
+            stream=True,
+            stop=None,
+        )
+        completion = self.llm_client.chat.completions.create(**params)
+
+        characters = []
+        parser = StreamingJSONParser(stream_keys=("characters",),
+                                     on_element=lambda key, character: characters.append(character))
+        streamed = 0
+        seen = set()
+        try:
+            for chunk in completion_text(completion):
+                members = parser.feed(chunk)
+                if parser.container == "[":
+                    raise ValueError("world state must be an object")
+                for character in characters[streamed:]:
+                    yield "character", _validate_character(character, f"characters[{streamed}]")
+                    streamed += 1
+                for key, value in members:
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    if key == "location":
+                        yield "location", _validate_location(value)
+                    elif key == "characters":
+                        # Characters the streamed elements missed, or all of them if the value was not an array
+                        for character in _validate_characters(value)[streamed:]:
+                            yield "character", character
+                    elif key == "relationships":
+                        yield "relationships", _validate_relationships(value)
+            parser.close()
+        except ValueError:
+            self.invalid_results += 1
+            # An invalid reply must not be served from the cache on the next attempt
+            discard_cached(self.llm_client, params)
+            raise
+        if "location" not in seen:
+            yield "location", None
+        if "relationships" not in seen:
+            yield "relationships", []
+
+    def extract(self, message_content):
+        """
+        Extract the world state of a message.
+
+        Args:
+            message_content (str): The content of the message.
+
+        Returns:
+            dict: The validated location (or None), characters and relationships.
+
+        Raises:
+            ValueError: If the model output contains no JSON object or does not match the schema.
+        """
+        world_state = {"location": None, "characters": [], "relationships": []}
+        for part, value in self.iter_extract(message_content):
+            if part == "character":
+                world_state["characters"].append(value)
+            else:
+                world_state[part] = value
+        return world_state